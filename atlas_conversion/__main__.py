@@ -1,39 +1,83 @@
 import argparse
 import sys
 
-from atlas_conversion.atlas import Atlas
-from atlas_conversion.loaders import png_loader, dicom_loader, nrrd_loader, raw_loader
+from atlas_conversion.cache import DEFAULT_CACHE_SIZE
+from atlas_conversion.registry import get_loader, loader_names
 
 
 ######################################
 # Main program - CLI with argparse - #
 ######################################
-def main():
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "batch":
+        from atlas_conversion.batch import main as batch_main
+        return batch_main(argv[1:])
+    if argv and argv[0] == "serve":
+        from atlas_conversion.server import main as serve_main
+        return serve_main(argv[1:])
+
     parser = create_parser()
-    arguments = check_and_parse_args(parser)
+    arguments = check_and_parse_args(parser, argv)
+    return run(arguments)
 
-    loaders_map = {
-        "png": png_loader,
-        "dicom": dicom_loader,
-        "nrrd": nrrd_loader,
-        "raw": raw_loader
-    }
 
-    loader = loaders_map[arguments.format]
+def run(arguments, callback=None, layout=None):
+    """
+    Convert one input as described by the parsed command line arguments.
+
+    callback, if given, is called with the profiling record of every stage and step of the conversion as soon as it
+    ends, e.g. to report the progress of the conversion. layout is a precomputed tiling.Layout of the atlas, e.g. the
+    layout shared by the frames of a time series.
+    """
+    if arguments.frames:
+        from atlas_conversion.series import run_series
+        return run_series(arguments, callback)
+
+    # the conversion modules are only imported here, which keeps --help and argument errors fast
+    from atlas_conversion.atlas import Atlas
+    from atlas_conversion.cache import Cache
+    from atlas_conversion.incremental import IncrementalAtlas
+    from atlas_conversion.profiling import Profiler
+
+    loader = get_loader(arguments.format)
+
+    cache = None
+    if arguments.cache_dir:
+        cache = Cache(arguments.cache_dir, arguments.cache_size * 2 ** 20)
+
+    profiler = Profiler(callback) if arguments.profile or callback else None
 
     print("Loading images...")
-    atlas_obj = Atlas(loader, **arguments.loader_options)
+    atlas_class = IncrementalAtlas if arguments.incremental else Atlas
+    atlas_obj = atlas_class(loader, cache=cache, profiler=profiler, **arguments.loader_options)
     atlas_obj.load(arguments.input)
 
-    print("Converting images...")
-    atlas_obj.convert()
+    if arguments.max_voxels or arguments.max_atlas_size:
+        print("Resampling volume...")
+        atlas_obj.resample(max_voxels=arguments.max_voxels, max_atlas_size=arguments.max_atlas_size,
+                           workers=arguments.workers)
+
+    if arguments.stream_output or (arguments.packed and not arguments.stream):
+        # the atlas is tiled while it is written, a packed atlas does not need the color atlas
+        atlas_obj.plan(max_texture_size=arguments.max_texture_size, layout=layout)
+    else:
+        print("Converting images...")
+        atlas_obj.convert(max_texture_size=arguments.max_texture_size, layout=layout)
 
     if arguments.gradient:
         print("Calculating gradient and writing images... (this may take a while)")
     else:
         print("Writing images...")
-    atlas_obj.write(arguments.output, gradient=arguments.gradient, scaled_outputs=arguments.scaled_outputs)
+    atlas_obj.write(arguments.output, gradient=arguments.gradient,
+                    scaled_outputs=arguments.scaled_outputs or bool(arguments.levels),
+                    gradient_options=arguments.gradient_options, levels=arguments.levels, resample=arguments.resample,
+                    workers=arguments.workers, backend=arguments.backend, output_format=arguments.output_format,
+                    format_options=arguments.format_options, streaming=arguments.stream_output,
+                    packed=arguments.packed)
 
+    if arguments.profile:
+        profiler.write(arguments.profile)
     print("Done!")
     return 0
 
@@ -48,7 +92,10 @@ This application converts the slices found in a folder into a tiled 2D texture
 image in PNG format.
 It uses Python 3 with Pillow, numpy, pydicom, nrrd, scipy, and dask.
 
-Note: this version does not process several folders recursively.''',
+Note: this version does not process several folders recursively. To convert
+many inputs at once, use "atlas_conversion batch <manifest>", see
+"atlas_conversion batch --help". To keep warm worker processes converting the
+jobs posted to a local service, use "atlas_conversion serve".''',
                                      epilog='''
 This code was created by Luis Kabongo.
 Modified by Ander Arbelaiz to add gradient calculation.
@@ -63,12 +110,39 @@ Contact mailto:volumerendering@vicomtech.org''',
                         help='path and base name of the desired output file, extension added automatically')
     parser.add_argument('--resize', '-r', type=int, nargs=2, metavar=('x', 'y'),
                         help='resize the input images x y before processing')
+    parser.add_argument('--z-range', type=int, nargs=2, metavar=('first', 'stop'),
+                        help='only load the slices first to stop - 1, negative values count from the last slice. '
+                             'The other slices are not decoded, and not read when the format allows it')
+    parser.add_argument('--z-stride', type=int, metavar='N',
+                        help='only load every Nth slice (of the --z-range), e.g. for previews')
+    parser.add_argument('--roi', type=int, nargs=4, metavar=('x', 'y', 'width', 'height'),
+                        help='only load this region of interest of the slices, in pixels of the input images before '
+                             '--resize')
     parser.add_argument('--gradient', '-g', action='store_true',
                         help='calculate and generate the gradient atlas')
     parser.add_argument('--standard_deviation', '-std', type=int, default=2,
                         help='standard deviation for the gaussian kernel used for the gradient computation')
-    parser.add_argument('--format', '-f', type=str, default="png", choices=["png", "dicom", "nrrd", "raw"],
-                        help='format of the input images, default is png')
+    parser.add_argument('--packed', action='store_true',
+                        help='write one RGBA atlas holding the gradient in RGB and the grayscale intensity in alpha '
+                             'instead of the atlas and the gradient atlas, implies --gradient. The normalization of '
+                             'the gradient is described in <output>_atlas.json.')
+    parser.add_argument('--gradient-kernel', type=str, choices=["gaussian", "central", "sobel"],
+                        help='compute the gradient with the fused single-pass engine using this derivative kernel, '
+                             'default is the dask gaussian gradient')
+    parser.add_argument('--gradient-memory', type=int, metavar='MB',
+                        help='compute the gradient out of core in slabs using about this many megabytes, the result '
+                             'is the same as the default in-memory computation')
+    parser.add_argument('--dask-scheduler', type=str, choices=["threads", "processes", "distributed"],
+                        help='dask scheduler of the dask gradient: threads (the default), processes, or distributed '
+                             'for a local cluster of single threaded worker processes, which needs dask.distributed')
+    parser.add_argument('--dask-workers', type=int, metavar='N',
+                        help='number of threads or processes of the dask gradient, default is the number of cores')
+    parser.add_argument('--dask-chunks', nargs=3, type=int, metavar=('height', 'width', 'slices'),
+                        help='dask chunk shape of the gradient volume, -1 for a whole axis, default is whole slices '
+                             'split in about 4 chunks per worker')
+    parser.add_argument('--format', '-f', type=str, default="png", choices=loader_names(),
+                        help='format of the input images, default is png. Installed packages may add formats '
+                             'through the "atlas_conversion.loaders" entry points.')
     parser.add_argument('--raw-size', nargs=2, metavar=('width', 'height'), type=int,
                         help='Size of the raw image, required if format is raw, otherwise ignored.')
     parser.add_argument('--raw-slices', type=int,
@@ -76,24 +150,165 @@ Contact mailto:volumerendering@vicomtech.org''',
     parser.add_argument('--raw-channels', type=int, choices=[1, 3],
                         help='Number of channels (1 for grayscale, 3 for RGB) in the raw data, required if format is '
                              'raw, otherwise ignored.')
+    parser.add_argument('--raw-mmap', action='store_true',
+                        help='Memory map the raw file and tile straight from the mapping instead of decoding it slice '
+                             'by slice, not compatible with --resize and --stream.')
+    parser.add_argument('--raw-offset', type=int, default=0,
+                        help='Number of header bytes to skip at the start of the raw file, default is 0.')
+    parser.add_argument('--raw-dtype', type=str, default="uint8",
+                        help='Numpy data type of the raw samples (e.g. uint8, uint16, int16, float32), default is '
+                             'uint8. Other types than uint8 are rescaled to 8 bits over the volume range.')
+    parser.add_argument('--raw-endianness', type=str, choices=["little", "big"],
+                        help='Byte order of the raw samples, default is the native byte order.')
+    parser.add_argument('--max-voxels', type=int,
+                        help='Downsample the volume along x, y and z with a box filter so that it has at most this '
+                             'many voxels, not compatible with --stream.')
+    parser.add_argument('--max-atlas-size', type=int, metavar='PIXELS',
+                        help='Downsample the volume along x, y and z with a box filter so that its atlas is at most '
+                             'this wide and high, e.g. the maximum WebGL texture size, not compatible with --stream.')
+    parser.add_argument('--max-texture-size', type=int, metavar='PIXELS',
+                        help='Split the atlas into pages of at most this width and height, e.g. the maximum texture '
+                             'size of the clients (8192 or 16384). The pages are written as separate images and listed '
+                             'in <output>_atlas.json, by default the atlas is a single page.')
+    parser.add_argument('--window', type=float, nargs=2, metavar=('center', 'width'),
+                        help='Window/level mapped to the 8 bit range for dicom and nrrd data, in the units of the data '
+                             '(e.g. Hounsfield units after the dicom rescale slope and intercept). By default high bit '
+                             'depth data is mapped over its whole range.')
+    parser.add_argument('--percentiles', type=float, nargs=2, metavar=('low', 'high'),
+                        help='Map the values between these percentiles (0-100) of a sample of the dicom or nrrd data '
+                             'to the 8 bit range, e.g. 1 99, not compatible with --window.')
+    parser.add_argument('--dicom-series', type=str, metavar='UID',
+                        help='SeriesInstanceUID of the dicom series to convert when the folder holds several series, '
+                             'by default the series with the most slices.')
     parser.add_argument('--scaled-outputs', action='store_true',
                         help='Generate scaled outputs at resolutions [8192, 4096, 2048, 1024, 512] if the full atlas'
                              'dimensions are  larger')
+    parser.add_argument('--levels', type=int, nargs='+', metavar='SIZE',
+                        help='Sizes of the scaled outputs, implies --scaled-outputs. Sizes larger than the full atlas '
+                             'are skipped.')
+    parser.add_argument('--resample', type=str, default="bicubic",
+                        choices=["box", "nearest", "bilinear", "bicubic", "lanczos"],
+                        help='Resampling filter of the scaled outputs, default is bicubic.')
+    parser.add_argument('--output-format', type=str, default="png", choices=["png", "raw", "container"],
+                        help='Format of the output images: png, raw (uncompressed .bin files with a .json sidecar) or '
+                             'container (all levels of an atlas in one .atlas file), default is png. The layout and '
+                             'the files written are described in <output>_atlas.json.')
+    parser.add_argument('--png-compression', type=int, choices=range(10), metavar='[0-9]',
+                        help='zlib compression level of the png files, lower is faster, default is 6.')
+    parser.add_argument('--png-strategy', type=str, default="default",
+                        choices=["default", "filtered", "huffman", "rle", "fixed"],
+                        help='zlib compression strategy of the png files, default is default.')
+    parser.add_argument('--workers', '-w', type=int,
+                        help='Number of parallel workers used to decode png and dicom slices and to build and encode '
+                             'the output images, default is serial.')
+    parser.add_argument('--backend', type=str, default="thread", choices=["thread", "process"],
+                        help='Kind of worker pool used with --workers, default is thread.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Copy every slice into the atlas as soon as it is decoded instead of loading the whole '
+                             'volume first, lowers peak memory.')
+    parser.add_argument('--stream-output', action='store_true',
+                        help='Encode the full size png atlases one row of tiles at a time, producing every row from '
+                             'the volume and from gradient slabs (see --gradient-memory) when it is encoded, so the '
+                             'atlases are never held in memory. Not compatible with --scaled-outputs, --levels, '
+                             'other output formats than png, and --stream with --gradient.')
+    parser.add_argument('--cache-dir', type=str,
+                        help='Cache the decoded volume, the atlas and the gradient atlas in this folder, keyed by the '
+                             'content of the input and the loader options, and reuse them when the same input is '
+                             'converted again, e.g. to add --gradient or other scaled outputs.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Keep the conversion in the --cache-dir folder under the input path rather than its '
+                             'content, and when the input is converted again only tile the slices that changed, and '
+                             'only compute the gradient again around them. Not compatible with --stream, '
+                             '--stream-output and --gradient-memory.')
+    parser.add_argument('--frames', action='store_true',
+                        help='The input is a folder of the frames of a time series, volumes of the same geometry, one '
+                             'input of --format per file or folder sorted by name. They are converted with the '
+                             'layout of the first frame into <output>_frame<N> atlases, listed in '
+                             '<output>_series.json.')
+    parser.add_argument('--frame-workers', type=int,
+                        help='Number of frames converted in parallel processes with --frames, default is the number '
+                             'of cores.')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE // 2 ** 20, metavar='MB',
+                        help='Maximum size of the cache folder, the least recently used entries are deleted beyond '
+                             'it, default is %(default)s.')
+    parser.add_argument('--profile', type=str, metavar='FILE',
+                        help='Write the wall time, cpu time, bytes read and written and peak memory of every stage of '
+                             'the conversion and of its steps (decoded files, gradient chunks, encoded files) to this '
+                             'json file.')
 
     return parser
 
 
-def check_and_parse_args(parser):
-    arguments = parser.parse_args()
+def check_and_parse_args(parser, argv=None):
+    arguments = parser.parse_args(argv)
     loader_options = {}
     if arguments.resize:
         loader_options["resize"] = arguments.resize
+    if arguments.z_stride is not None and arguments.z_stride < 1:
+        parser.error("--z-stride must be at least 1")
+    if arguments.roi and (arguments.roi[2] < 1 or arguments.roi[3] < 1):
+        parser.error("the --roi width and height must be at least 1")
+    if arguments.z_range:
+        loader_options["z_range"] = tuple(arguments.z_range)
+    if arguments.z_stride:
+        loader_options["z_stride"] = arguments.z_stride
+    if arguments.roi:
+        loader_options["roi"] = tuple(arguments.roi)
+    if arguments.workers and arguments.format in ("png", "dicom"):
+        loader_options["workers"] = arguments.workers
+        loader_options["backend"] = arguments.backend
+    if arguments.stream:
+        loader_options["stream"] = True
+    if arguments.stream and (arguments.max_voxels or arguments.max_atlas_size):
+        parser.error("--max-voxels and --max-atlas-size cannot be combined with --stream")
+    if arguments.stream_output and (arguments.scaled_outputs or arguments.levels or arguments.output_format != "png"):
+        parser.error("--stream-output only writes the full size png atlases")
+    if arguments.packed:
+        arguments.gradient = True
+    if arguments.stream_output and arguments.stream and arguments.gradient:
+        parser.error("--stream-output cannot compute the gradient of --stream slices")
+    if arguments.incremental and not arguments.cache_dir:
+        parser.error("--incremental keeps the previous conversion in the --cache-dir folder")
+    if arguments.incremental and (arguments.stream or arguments.stream_output or arguments.gradient_memory):
+        parser.error("--incremental cannot be combined with --stream, --stream-output and --gradient-memory")
+    if arguments.window and arguments.percentiles:
+        parser.error("--window cannot be combined with --percentiles")
+    if arguments.format in ("dicom", "nrrd"):
+        if arguments.window:
+            loader_options["window"] = tuple(arguments.window)
+        if arguments.percentiles:
+            loader_options["percentiles"] = tuple(arguments.percentiles)
+    if arguments.format == "dicom" and arguments.dicom_series:
+        loader_options["series"] = arguments.dicom_series
     if arguments.format == "raw":
         check_raw_format_requirements(arguments, parser)
-        loader_options["size"] = arguments.raw_size
-        loader_options["num_slices"] = arguments.raw_slices
-        loader_options["num_channels"] = arguments.raw_channels
+        # the loader expects (height, width) while the cli takes width height
+        loader_options["size_of_raw"] = tuple(reversed(arguments.raw_size))
+        loader_options["slices"] = arguments.raw_slices
+        loader_options["channels"] = arguments.raw_channels
+        loader_options["mmap"] = arguments.raw_mmap
+        loader_options["offset"] = arguments.raw_offset
+        loader_options["dtype"] = arguments.raw_dtype
+        loader_options["endianness"] = arguments.raw_endianness
     arguments.loader_options = loader_options
+    gradient_options = {"sigma": arguments.standard_deviation}
+    if arguments.gradient_kernel:
+        gradient_options["kernel"] = arguments.gradient_kernel
+    if arguments.gradient_memory:
+        gradient_options["memory_budget"] = arguments.gradient_memory * 2 ** 20
+    if arguments.gradient_kernel and (arguments.dask_scheduler or arguments.dask_workers or arguments.dask_chunks):
+        parser.error("--dask-scheduler, --dask-workers and --dask-chunks only apply to the dask gradient, "
+                     "not to --gradient-kernel")
+    if arguments.dask_scheduler:
+        gradient_options["scheduler"] = arguments.dask_scheduler
+    if arguments.dask_workers:
+        gradient_options["workers"] = arguments.dask_workers
+    if arguments.dask_chunks:
+        gradient_options["chunks"] = tuple(arguments.dask_chunks)
+    arguments.gradient_options = gradient_options
+    arguments.format_options = {}
+    if arguments.output_format == "png":
+        arguments.format_options = {"compress_level": arguments.png_compression, "strategy": arguments.png_strategy}
     return arguments
 
 
@@ -107,6 +322,8 @@ def check_raw_format_requirements(arguments, parser):
     for arg, error_msg in required_args.items():
         if getattr(arguments, arg) is None:
             parser.error(error_msg)
+    if arguments.raw_mmap and (arguments.resize or arguments.stream):
+        parser.error("--raw-mmap cannot be combined with --resize or --stream")
 
 
 if __name__ == "__main__":
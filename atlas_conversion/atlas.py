@@ -1,9 +1,30 @@
-import math
-import dask.array as da
+from functools import partial
+from itertools import islice
+
 import numpy as np
 from PIL import Image
 
-from atlas_conversion.utils import normalize_rgb, calculate_gradient
+from atlas_conversion.cache import volume_key
+from atlas_conversion.gradient import budget_chunk_depth, fused_gradient, iter_gradient_chunks, quantize_gradient
+from atlas_conversion.loaders import SliceStream
+from atlas_conversion.formats import (KIND_SUFFIXES, encode_images, file_entry, output_base_name, write_container,
+                                      write_metadata, write_png_strips)
+from atlas_conversion.intensity import map_to_uint8
+from atlas_conversion.profiling import profiled_iter, stage
+from atlas_conversion.pyramid import build_pyramids, pyramid_levels
+from atlas_conversion.resample import budget_shape, resample_volume
+from atlas_conversion.tiling import plan_layout, tile_view, tile_volume, untile_atlas
+from atlas_conversion.utils import (normalize_rgb, calculate_gradient, calculate_gradient_out_of_core, luminance,
+                                    volume_range, rescale_to_uint8, gradient_chunks)
+
+# Bytes of the gradient slabs computed at once by streaming writes when no memory budget is given
+STREAMING_MEMORY_BUDGET = 2 ** 28
+
+# Constants of the normalization of the gradient to uint8, see Atlas.gradient_atlas
+NORMALIZATION = ["minimum", "maximum", "background"]
+
+# Content of the channels of a packed atlas, recorded in the metadata
+PACKED_CHANNELS = {"rgb": "gradient", "alpha": "intensity"}
 
 
 class Atlas:
@@ -11,63 +32,470 @@ class Atlas:
     Atlas class
 
     This is a generic class for atlas conversion. It takes a loader function that loads the specific file types and
-    returns them as RGB8 numpy arrays.
+    returns the whole volume as one contiguous (slices, height, width[, channels]) array with the native channels of
+    the data, e.g. single channel for grayscale scans, or a read-only memory map of that shape. The volume is tiled
+    directly, single channel slices are only expanded to RGB when they are placed into the atlas, and volumes of
+    another dtype than uint8 are rescaled to 8 bits over their value range while tiling. A loader may also return a
+    SliceStream, in which case every slice is copied into the preallocated atlas as soon as it is decoded and is not
+    kept in memory afterwards, or a list of slice arrays.
+
+    The grid of the atlas is chosen by tiling.plan_layout, which avoids the empty tiles of a square grid and, beyond a
+    maximum texture size, splits the atlas into pages. The pages are held one below the other in the atlas array and
+    are written as separate images. An atlas that is only planned, not converted, can be written in streaming mode:
+    every row of tiles of the atlas and of its gradient is then produced when the png encoder needs it, so neither
+    atlas is ever held in memory. Instead of the atlas and the gradient atlas, a single packed RGBA atlas holding the
+    gradient in RGB and the grayscale intensity in alpha can be written.
+
+    With a cache, the decoded volume, the atlas and the gradient atlases are stored under the hash of the input content
+    and the loader options, and are reused by load, convert and gradient_atlas when the same input is converted again.
+
+    With a profiler, load, convert, the gradient computation and write are recorded as stages, together with their
+    sub-steps such as the decoding of every slice file, every gradient chunk and the encoding of every output file.
 
     Attributes:
-        loader: a loader function that loads the atlas slices as list of RGB8 numpy arrays
+        loader: a loader function that loads the atlas slices as a volume array, a SliceStream or a list of arrays
+        cache: optional cache.Cache reused across conversions
+        profiler: optional profiling.Profiler recording the stages of the conversion
         **loader_options: additional options that are passed to the loader function as keyword arguments
     """
 
-    def __init__(self, loader, **loader_options):
+    def __init__(self, loader, cache=None, profiler=None, **loader_options):
         self.atlas = None
         self.slices = None
         self.loader = loader
-        self.size = None
+        self.layout = None
+        self.cache = cache
+        self.cache_key = None
+        self.profiler = profiler
         self.loader_options = loader_options
+        # minimum, maximum and uint8 background of the last computed gradient, see gradient_atlas
+        self.gradient_normalization = None
 
     def load(self, path):
-        self.slices = self.loader(path, **self.loader_options)
-
-    def convert(self):
-        # create a square array large enough to hold all the slices
-        self.size = int(math.ceil(math.sqrt(len(self.slices))))
-        self.atlas = np.zeros((self.size * self.slices[0].shape[0], self.size * self.slices[0].shape[1], 3),
-                              dtype=np.uint8)
-        # copy the slices into the atlas taking into account the data shape
+        with stage("load", self.profiler, input=str(path)):
+            if self.cache is None:
+                self.slices = self.loader(path, **self.loader_options)
+                return
+            self.cache_key = volume_key(path, self.loader, self.loader_options)
+            self.slices = self.cache.get(self.cache_key + "-volume")
+            if self.slices is not None:
+                return
+            self.slices = self.loader(path, **self.loader_options)
+            if isinstance(self.slices, list) and self.slices:
+                self.slices = np.stack(self.slices)
+            # decoded volumes are cached; streams are not kept in memory and memory maps need no decoding, for those
+            # only the atlas is cached (a stream is not decoded at all when the atlas is cached)
+            if isinstance(self.slices, np.ndarray) and not isinstance(self.slices, np.memmap):
+                self.cache.put(self.cache_key + "-volume", self.slices)
+
+    def resample(self, shape=None, max_voxels=None, max_atlas_size=None, method="area", workers=None):
+        """
+        Downsample the loaded volume along x, y and z before it is converted, see resample.resample_volume.
+
+        Args:
+            shape: (Z, H, W) target shape, computed from the budgets when None
+            max_voxels: maximum number of voxels of the resampled volume
+            max_atlas_size: maximum width and height in pixels of the atlas of the resampled volume
+            method: "area" or "nearest"
+            workers: number of parallel threads
+        """
+        if isinstance(self.slices, SliceStream):
+            raise ValueError("Streamed slices cannot be resampled")
+        if isinstance(self.slices, list):
+            self.slices = np.stack(self.slices)
+        shape = tuple(shape or budget_shape(self.slices.shape[:3], max_voxels, max_atlas_size))
+        if shape == self.slices.shape[:3]:
+            return
+        with stage("resample", self.profiler, shape=list(shape)):
+            self.slices = resample_volume(self.slices, shape, method, workers)
+        if self.cache_key is not None:
+            # the atlas and the gradients are derived from the resampled volume
+            self.cache_key += "-{}-{}".format(method, "x".join(str(size) for size in shape))
+
+    def convert(self, max_texture_size=None, layout=None):
+        """
+        Tile the loaded slices into the atlas.
+
+        Args:
+            max_texture_size: maximum width and height in pixels of an atlas page, e.g. the maximum texture size of
+                the clients; the atlas is split into several pages when it does not fit in one
+            layout: a precomputed tiling.Layout to use instead, see plan
+        """
+        with stage("convert", self.profiler):
+            self.plan(max_texture_size, layout)
+            if self.cache_key is not None:
+                # the pages are bands of the same atlas array, only the number of columns changes its content
+                key = "{}-atlas-{}".format(self.cache_key, self.layout.columns)
+                self.atlas = self.cache.get(key)
+                if self.atlas is not None:
+                    return
+            self._convert()
+            if self.cache_key is not None:
+                self.cache.put(key, self.atlas)
+
+    def plan(self, max_texture_size=None, layout=None):
+        """
+        Choose the layout of the atlas without tiling it, see convert.
+
+        A planned atlas can be written with write(streaming=True), which tiles it one row of tiles at a time. A layout
+        computed once can be given instead, e.g. the layout of the first frame of a time series for all its frames.
+
+        Raises:
+            ValueError: if the given layout does not hold the number and size of the slices
+        """
+        if isinstance(self.slices, list):
+            # a list of slices is stacked once (replacing the list) and tiled like a volume
+            self.slices = np.stack(self.slices)
+        slice_shape = self.slices.shape if isinstance(self.slices, SliceStream) else self.slices.shape[1:]
+        if layout is None:
+            layout = plan_layout(len(self.slices), slice_shape, max_texture_size)
+        elif (layout.num_slices, layout.slice_shape) != (len(self.slices), tuple(slice_shape[:2])):
+            raise ValueError("The layout of {} slices of {} does not match the {} slices of {}".format(
+                layout.num_slices, layout.slice_shape, len(self.slices), tuple(slice_shape[:2])))
+        self.layout = layout
+
+    def _convert(self):
+        self.atlas = np.zeros(self.layout.shape + (3,), dtype=np.uint8)
+        if isinstance(self.slices, np.ndarray):
+            # whole volumes are tiled in one vectorized pass, high bit depth data is rescaled row by row
+            tile_volume(self.slices, self.layout.columns, out=self.atlas, transform=self._rescale_transform())
+            return
+        # streams are copied slice by slice, so a streamed slice can be dropped as soon as it is placed
         for i, image_slice in enumerate(self.slices):
-            row = int((math.floor(i / self.size)) * self.slices[0].shape[0])
-            col = int((i % self.size) * self.slices[0].shape[1])
-            row_dim, col_dim = self.slices[0].shape[0], self.slices[0].shape[1]
-            self.atlas[row:row + row_dim, col:col + col_dim, :] = image_slice
-
-    def write(self, output_filename, gradient=False, scaled_outputs=False):
-        with open(str(output_filename) + "_AtlasDim.txt", 'w') as f:
-            f.write(str((len(self.slices), (self.size, self.size))))
-        im = Image.fromarray(self.atlas)
-        im.save(output_filename + "_full.png", "PNG")
-        if gradient:
-            gradient = self.compute_gradient()
-            gradient.save(output_filename + "_gradient_full.png", "PNG")
-        for dimension in [x for x in [8192, 4096, 2048, 1024, 512] if x < self.atlas.shape[0]] if scaled_outputs else []:
-            print("Writing image with size: " + str(dimension) + "...")
-            im = im.resize((dimension, dimension), Image.BICUBIC)
-            im.save(output_filename + "_" + str(dimension) + ".png")
+            tile = tile_view(self.atlas, i, self.layout.columns, self.layout.slice_shape)
+            tile[...] = image_slice.reshape(*tile.shape[:2], -1)
+
+    def _rescale_transform(self):
+        """Return the transform rescaling blocks of a volume of another dtype than uint8 to 8 bits, or None."""
+        if self.slices.dtype == np.uint8:
+            return None
+        minimum, maximum = volume_range(self.slices)
+        return partial(rescale_to_uint8, minimum=minimum, maximum=maximum)
+
+    def _tile_rows(self, images, fill=0):
+        """Place a sequence of (H, W, 3 or 1) slice images into rows of tiles and yield every row once it is full."""
+        columns, (height, width) = self.layout.columns, self.layout.slice_shape
+        strip = np.empty((height, columns * width, 3), dtype=np.uint8)
+        for i, image in enumerate(images):
+            tile_view(strip, i % columns, columns, (height, width))[...] = image
+            if i % columns == columns - 1 or i == self.layout.num_slices - 1:
+                strip[:, (i % columns + 1) * width:] = fill
+                yield strip
+
+    def _atlas_rows(self, atlas):
+        """Yield the rows of tiles of an atlas array held in memory."""
+        height = self.layout.slice_shape[0]
+        for row in range(self.layout.rows):
+            yield atlas[row * height:(row + 1) * height]
+
+    def _color_strips(self):
+        """Yield the rows of tiles of the atlas, tiled on demand from the slices when the atlas is not converted."""
+        columns, height = self.layout.columns, self.layout.slice_shape[0]
+        if self.atlas is not None:
+            yield from self._atlas_rows(self.atlas)
+            return
+        if isinstance(self.slices, np.ndarray):
+            strip = np.empty((height, self.layout.shape[1], 3), dtype=np.uint8)
+            transform = self._rescale_transform()
+            for first in range(0, len(self.slices), columns):
+                yield tile_volume(self.slices[first:first + columns], columns, out=strip, transform=transform)
+            return
+        yield from self._tile_rows(image_slice.reshape(*self.layout.slice_shape, -1) for image_slice in self.slices)
+
+    def write(self, output_filename, gradient=False, scaled_outputs=False, gradient_options=None, levels=None,
+              resample="bicubic", workers=None, backend="thread", output_format="png", format_options=None,
+              streaming=False, packed=False):
+        """
+        Write the atlas, and optionally its gradient and scaled versions, with a description in a JSON metadata file.
+
+        The metadata describes the layout of the atlas (grid, slice size and pages) and every written file. The pages of
+        an atlas of several pages are written as separate images, and their scaled versions all have the scale of the
+        first page. With the gradient, it also holds the normalization of the gradient (see gradient_atlas), and with
+        packed the content of the channels of the packed atlas.
+
+        Args:
+            output_filename: base name of the output files
+            gradient: also compute and write the gradient atlas
+            scaled_outputs: also write downsampled versions of the atlases
+            gradient_options: keyword arguments passed to compute_gradient
+            levels: sizes of the longest side of the scaled outputs, defaults to [8192, 4096, 2048, 1024, 512], only
+                sizes smaller than the full atlas (its first page) are written
+            resample: resampling filter of the scaled outputs, one of "box", "nearest", "bilinear", "bicubic" and
+                "lanczos"
+            workers: number of parallel workers building the pyramids and encoding the files
+            backend: kind of worker pool encoding the files, "thread" (default, the png encoder releases the GIL) or
+                "process"
+            output_format: "png", "raw" (uncompressed .bin files with a JSON sidecar) or "container" (all levels of
+                an atlas in one .atlas file)
+            format_options: keyword arguments of the png encoder, compress_level (0-9) and strategy
+            streaming: encode the full size png pages one row of tiles at a time, producing every row from the
+                slices (unless the atlas is converted) and from out of core gradient slabs, so the peak memory depends
+                on the height of a row of tiles and not on the size of the atlas. Scaled outputs and other formats
+                are not supported.
+            packed: write one RGBA atlas of the gradient and the intensity instead of the atlas and the gradient atlas,
+                see packed_atlas, which implies gradient
+        """
+        if streaming and (scaled_outputs or output_format != "png"):
+            raise ValueError("Streaming writes only support the full size png outputs")
+        gradient = gradient or packed
+        with stage("write", self.profiler, output=str(output_filename)):
+            if streaming:
+                files = self._write_strips(output_filename, gradient, gradient_options, format_options, packed)
+            else:
+                files = self._write_images(output_filename, gradient, scaled_outputs, gradient_options, levels,
+                                           resample, workers, backend, output_format, format_options, packed)
+            metadata = dict(self.metadata(), format=output_format, files=files)
             if gradient:
-                print("Writing gradient with size: " + str(dimension) + "...")
-                output_filename__resized_gradient = output_filename + "_" + str(dimension) + "_gradient.png"
-                gradient.resize((dimension, dimension), Image.BICUBIC).save(output_filename__resized_gradient)
-
-    def compute_gradient(self):
-        slice_shape = self.slices[0].shape
-        slices = [Image.fromarray(slice_).convert('L') for slice_ in self.slices]
-        data = da.stack(slices, axis=-1).rechunk().astype(np.float32)
-        gradient_data, g_background = calculate_gradient(data)
-        g_background, gradient_data = normalize_rgb(g_background, gradient_data)
-
-        atlas_array = np.full((slice_shape[0] * self.size, slice_shape[1] * self.size, 3), g_background)
-        for i, _ in enumerate(self.slices):
-            row = (i // self.size) * slice_shape[0]
-            col = (i % self.size) * slice_shape[1]
-            atlas_array[row:row + slice_shape[0], col:col + slice_shape[1], :] = gradient_data[:, :, i]
-
-        return Image.fromarray(atlas_array.astype(np.uint8))
+                metadata["gradient"] = self.gradient_normalization
+            if packed:
+                metadata["channels"] = PACKED_CHANNELS
+            write_metadata(str(output_filename) + "_atlas.json", metadata)
+
+    def _write_images(self, output_filename, gradient, scaled_outputs, gradient_options, levels, resample, workers,
+                      backend, output_format, format_options, packed):
+        """Write the atlases held in memory and their scaled versions, see write, and return the file entries."""
+        if packed:
+            atlases = {"packed": self.packed_atlas(**(gradient_options or {}))}
+        else:
+            atlases = {"color": self.atlas}
+            if gradient:
+                atlases["gradient"] = self.gradient_atlas(**(gradient_options or {}))
+        level_names = ["full"]
+        # images[kind][page] lists the levels of a page, starting with the full page
+        images = {kind: [[page] for page in self.layout.split(atlas)] for kind, atlas in atlases.items()}
+        if scaled_outputs:
+            full_size = max(next(iter(images.values()))[0][0].shape[:2])
+            dimensions = pyramid_levels(full_size, levels)
+            pages = [page_images[0] for kind_pages in images.values() for page_images in kind_pages]
+            with stage("pyramids", levels=dimensions):
+                pyramids = iter(build_pyramids(pages, dimensions, resample, workers, full_size))
+            for kind_pages in images.values():
+                for page_images in kind_pages:
+                    page_images += next(pyramids)
+            level_names += dimensions
+            if dimensions:
+                print("Writing images with sizes: " + ", ".join(str(dimension) for dimension in dimensions) + "...")
+
+        # (kind, page, level, image) of every output image, pages are only numbered in the names of several pages
+        outputs = [(kind, page, level, image) for kind, kind_pages in images.items()
+                   for page, page_images in enumerate(kind_pages) for level, image in zip(level_names, page_images)]
+        paged = self.layout.pages > 1
+        files = []
+        if output_format == "container":
+            for kind in images:
+                filename = output_filename + KIND_SUFFIXES[kind] + ".atlas"
+                entries = [(str(level) + ("_page" + str(page) if paged else ""), page, level, image)
+                           for image_kind, page, level, image in outputs if image_kind == kind]
+                with stage("encode", file=filename):
+                    write_container([(entry, image) for entry, _, _, image in entries], filename)
+                files += [dict(file_entry(filename, kind, level, image, page), entry=entry)
+                          for entry, page, level, image in entries]
+        else:
+            jobs = [(image, output_base_name(output_filename, kind, level, page if paged else None))
+                    for kind, page, level, image in outputs]
+            written = encode_images(jobs, output_format, workers, backend, **(format_options or {}))
+            files = [file_entry(filenames[0], kind, level, image, page)
+                     for (kind, page, level, image), filenames in zip(outputs, written)]
+        return files
+
+    def _write_strips(self, output_filename, gradient, gradient_options, format_options, packed):
+        """Write the full size png pages of the atlases one row of tiles at a time, see write."""
+        if packed:
+            strips = {"packed": self._packed_strips(self._gradient_strips(**(gradient_options or {})))}
+        else:
+            strips = {"color": self._color_strips()}
+            if gradient:
+                strips["gradient"] = self._gradient_strips(**(gradient_options or {}))
+        paged = self.layout.pages > 1
+        files = []
+        for kind, kind_strips in strips.items():
+            channels = 4 if kind == "packed" else 3
+            for page in range(self.layout.pages):
+                first, last = self.layout.page_rows_range(page)
+                shape = ((last - first) * self.layout.slice_shape[0], self.layout.shape[1], channels)
+                filename = output_base_name(output_filename, kind, "full", page if paged else None) + ".png"
+                with stage("encode", file=filename):
+                    write_png_strips(islice(kind_strips, last - first), shape, filename, **(format_options or {}))
+                # a zero strided array describes the page, which is never held in memory
+                files.append(file_entry(filename, kind, "full", np.broadcast_to(np.uint8(0), shape), page))
+        return files
+
+    def metadata(self):
+        """Describe the layout of the converted atlas for the metadata file."""
+        return self.layout.describe()
+
+    def grayscale_volume(self):
+        """
+        Return the converted slices as a (Z, H, W) uint8 grayscale volume.
+
+        A single channel uint8 volume is returned as is, RGB volumes are converted to luminance. Slices that were
+        streamed or rescaled while tiling are read back from the atlas, or rescaled again when the atlas is only
+        planned.
+        """
+        volume = self.slices
+        if not isinstance(volume, np.ndarray) or volume.dtype != np.uint8:
+            if self.atlas is not None:
+                volume = untile_atlas(self.atlas, len(self.slices), self.layout.slice_shape)
+            elif isinstance(volume, np.ndarray):
+                volume = map_to_uint8(volume, *volume_range(volume))
+            else:
+                raise ValueError("Streamed slices must be converted before their gradient is computed")
+        if volume.ndim == 4 and volume.shape[3] == 1:
+            volume = volume[..., 0]
+        return luminance(volume) if volume.ndim == 4 else volume
+
+    def compute_gradient(self, **gradient_options):
+        """Compute the gradient atlas as an RGB image, see gradient_atlas for the options."""
+        return Image.fromarray(self.gradient_atlas(**gradient_options))
+
+    def gradient_atlas(self, memory_budget=None, kernel=None, sigma=2, scheduler=None, workers=None, chunks=None):
+        """
+        Compute the gradient atlas as an RGB uint8 array.
+
+        The gradient is normalized between its minimum and maximum, so a component of the gradient is
+        minimum + value / 255 * (maximum - minimum). Both are kept in gradient_normalization, together with the uint8
+        background of the atlas, the value of a zero gradient.
+
+        Args:
+            memory_budget: if given, the gradient is computed out of core in z slabs that need about this many bytes,
+                and every slab is quantized and written into the atlas straight away. The result is identical to the
+                in-memory computation, at the cost of computing the gradient twice.
+            kernel: None for the dask gaussian gradient, or one of the fused engine kernels ("gaussian", "central",
+                "sobel"), which compute all three components in one pass per chunk
+            sigma: standard deviation of the gaussian kernels
+            scheduler: dask scheduler of the dask gradient, "threads" (the default), "processes" or "distributed" for a
+                local cluster of single threaded processes, see utils.dask_scheduler
+            workers: number of dask workers, defaults to the number of cores
+            chunks: (x, y, z) dask chunks of the transposed (H, W, Z) volume, -1 for a whole axis, defaults to
+                utils.gradient_chunks
+        """
+        dask_options = {"scheduler": scheduler, "workers": workers, "chunks": chunks}
+        with stage("gradient", self.profiler, kernel=kernel or "dask", scheduler=scheduler, workers=workers):
+            if self.cache_key is None:
+                return self._gradient_atlas(memory_budget, kernel, sigma, dask_options)
+            atlas_array = self._cached_gradient(kernel, sigma)
+            if atlas_array is None:
+                atlas_array = self._gradient_atlas(memory_budget, kernel, sigma, dask_options)
+                key, normalization = self._gradient_key(kernel, sigma), self.gradient_normalization
+                self.cache.put(key, atlas_array)
+                self.cache.put(key + "-normalization", np.array([normalization[name] for name in NORMALIZATION]))
+            return atlas_array
+
+    def _gradient_key(self, kernel, sigma):
+        """Return the cache key of the gradient atlas."""
+        # the out of core computation gives the same result, so the memory budget is not part of the key, and neither
+        # are the chunks and scheduler
+        return "{}-gradient-{}-{}-{}".format(self.cache_key, kernel or "dask", sigma, self.layout.columns)
+
+    def _cached_gradient(self, kernel, sigma):
+        """Return the cached gradient atlas and restore its normalization, or None when either is not cached."""
+        key = self._gradient_key(kernel, sigma)
+        atlas_array, normalization = self.cache.get(key), self.cache.get(key + "-normalization")
+        if atlas_array is None or normalization is None:
+            return None
+        self._set_gradient_normalization(*normalization)
+        return atlas_array
+
+    def _set_gradient_normalization(self, minimum, maximum, background):
+        """Keep the normalization of the computed gradient in plain types, as written to the metadata."""
+        self.gradient_normalization = dict(zip(NORMALIZATION, (float(minimum), float(maximum), int(background))))
+
+    def _gradient_atlas(self, memory_budget, kernel, sigma, dask_options):
+        """Compute the gradient atlas without the cache, see gradient_atlas."""
+        # the gradient engines take (x, y, z) volumes, a transposed view of the (Z, H, W) slices
+        volume = self.grayscale_volume().transpose(1, 2, 0)
+        atlas_array = np.empty(self.layout.shape + (3,), dtype=np.uint8)
+        if memory_budget is None:
+            if kernel is None:
+                gradient_data, g_background, (minimum, maximum) = calculate_gradient(
+                    self._dask_volume(volume, sigma, dask_options), sigma, return_range=True, **dask_options)
+                g_background, gradient_data = normalize_rgb(g_background, gradient_data)
+            else:
+                gradient, minimum, maximum = fused_gradient(volume, kernel, sigma)
+                gradient_data, g_background = quantize_gradient(gradient, minimum, maximum)
+            self._set_gradient_normalization(minimum, maximum, g_background)
+            tile_volume(gradient_data.transpose(2, 0, 1, 3), self.layout.columns, fill=g_background, out=atlas_array)
+            return atlas_array
+
+        g_background, slabs = self._gradient_slabs(volume, kernel, sigma, memory_budget, dask_options)
+        atlas_array[...] = g_background
+        for start, slab in slabs:
+            for i in range(slab.shape[2]):
+                tile_view(atlas_array, start + i, self.layout.columns, slab.shape[:2])[...] = slab[:, :, i]
+        return atlas_array
+
+    @staticmethod
+    def _dask_volume(volume, sigma, dask_options):
+        """Wrap a (x, y, z) grayscale volume in a float32 dask array of the chunks of the dask gradient."""
+        import dask.array as da
+
+        chunks = dask_options["chunks"] or gradient_chunks(volume.shape, dask_options["workers"], sigma)
+        return da.from_array(volume, chunks=chunks).astype(np.float32)
+
+    def _gradient_slabs(self, volume, kernel, sigma, memory_budget, dask_options):
+        """
+        Compute the gradient of a (x, y, z) grayscale volume out of core, in z slabs of about memory_budget bytes.
+
+        Returns:
+            the uint8 background value of the gradient atlas and an iterator of (first slice, uint8 (x, y, z, 3) slab)
+        """
+        if kernel is None:
+            with stage("gradient range"):
+                g_background, slabs, (minimum, maximum) = calculate_gradient_out_of_core(
+                    self._dask_volume(volume, sigma, dask_options), memory_budget, sigma, return_range=True,
+                    **dask_options)
+            self._set_gradient_normalization(minimum, maximum, g_background)
+            return g_background, profiled_iter(slabs, "gradient slab")
+
+        # the chunks of the fused engine are computed twice, first for the value range and then to be quantized
+        chunk_depth = budget_chunk_depth(volume.shape, memory_budget)
+        minimum, maximum = np.float32(np.inf), np.float32(-np.inf)
+        for _, chunk in profiled_iter(iter_gradient_chunks(volume, kernel, sigma, chunk_depth), "gradient range chunk"):
+            minimum, maximum = min(minimum, chunk.min()), max(maximum, chunk.max())
+        chunks = profiled_iter(iter_gradient_chunks(volume, kernel, sigma, chunk_depth), "gradient chunk")
+        # the background is the quantized value of a zero gradient
+        g_background = quantize_gradient(np.zeros(3, dtype=np.float32), minimum, maximum)[1]
+        self._set_gradient_normalization(minimum, maximum, g_background)
+        return g_background, ((start, quantize_gradient(chunk, minimum, maximum)[0]) for start, chunk in chunks)
+
+    def _gradient_strips(self, memory_budget=None, kernel=None, sigma=2, scheduler=None, workers=None, chunks=None):
+        """
+        Yield the rows of tiles of the gradient atlas, see write(streaming=True).
+
+        A cached gradient atlas is read row by row, otherwise the rows are filled from out of core gradient slabs of
+        memory_budget bytes, STREAMING_MEMORY_BUDGET by default, as they are computed.
+        """
+        cached = None if self.cache_key is None else self._cached_gradient(kernel, sigma)
+        if cached is not None:
+            yield from self._atlas_rows(cached)
+            return
+        volume = self.grayscale_volume().transpose(1, 2, 0)
+        g_background, slabs = self._gradient_slabs(volume, kernel, sigma, memory_budget or STREAMING_MEMORY_BUDGET,
+                                                   {"scheduler": scheduler, "workers": workers, "chunks": chunks})
+        images = (slab[:, :, i] for _, slab in slabs for i in range(slab.shape[2]))
+        yield from self._tile_rows(images, fill=g_background)
+
+    def packed_atlas(self, **gradient_options):
+        """
+        Compute the packed atlas as an RGBA uint8 array, the gradient atlas in RGB and the intensity in alpha.
+
+        The intensity is the grayscale volume (see grayscale_volume) tiled with the layout of the atlas. Both are placed
+        one row of tiles at a time, so a viewer fetches a single texture and the pyramids and encoding run once. The
+        color atlas is not needed, a planned atlas can be packed. See gradient_atlas for the options.
+        """
+        gradient = self.gradient_atlas(**gradient_options)
+        packed = np.empty(self.layout.shape + (4,), dtype=np.uint8)
+        for row, strip in enumerate(self._packed_strips(self._atlas_rows(gradient))):
+            packed[row * strip.shape[0]:(row + 1) * strip.shape[0]] = strip
+        return packed
+
+    def _packed_strips(self, gradient_strips):
+        """Yield the rows of tiles of the packed atlas from the rows of tiles of the gradient atlas."""
+        columns, height = self.layout.columns, self.layout.slice_shape[0]
+        strip = np.empty((height, self.layout.shape[1], 4), dtype=np.uint8)
+        intensity = np.empty(strip.shape[:2], dtype=np.uint8)
+        volume = self.grayscale_volume()
+        for row, gradient_strip in enumerate(gradient_strips):
+            strip[..., :3] = gradient_strip
+            strip[..., 3] = tile_volume(volume[row * columns:(row + 1) * columns], columns, out=intensity)
+            yield strip
@@ -0,0 +1,237 @@
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import shlex
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from atlas_conversion.utils import worker_context
+
+try:
+    import resource
+except ImportError:  # not available on windows, memory limits are then ignored
+    resource = None
+
+# Columns of a csv manifest, only input and output are required
+MANIFEST_COLUMNS = ["input", "output", "format", "options", "memory_limit"]
+
+
+def read_manifest(path):
+    """
+    Read the jobs of a batch manifest.
+
+    A csv manifest has a header with the MANIFEST_COLUMNS, a json manifest is a list of objects with the same keys.
+    options holds extra command line options of the job, either as a string ("--gradient --resize 256 256"), a list
+    of arguments or, in json, an object such as {"gradient": true, "resize": [256, 256]}. memory_limit is the
+    maximum memory of the job in megabytes.
+
+    Returns:
+        a list of job dicts
+    """
+    with open(path, newline="") as f:
+        if path.lower().endswith(".json"):
+            jobs = json.load(f)
+        else:
+            jobs = [{key: value for key, value in row.items() if value not in (None, "")} for row in csv.DictReader(f)]
+    for i, job in enumerate(jobs):
+        if "input" not in job or "output" not in job:
+            raise ValueError("Job {} of {} needs an input and an output".format(i, path))
+    return jobs
+
+
+def options_to_arguments(options):
+    """Convert the options of a manifest job into command line arguments."""
+    if not options:
+        return []
+    if isinstance(options, str):
+        return shlex.split(options)
+    if isinstance(options, dict):
+        arguments = []
+        for key, value in options.items():
+            if value is None or value is False:
+                continue
+            arguments.append("--" + key.replace("_", "-"))
+            if value is not True:
+                arguments += [str(v) for v in value] if isinstance(value, (list, tuple)) else [str(value)]
+        return arguments
+    return [str(option) for option in options]
+
+
+def job_arguments(job):
+    """Return the command line arguments converting a manifest job."""
+    arguments = [job["input"], job["output"]]
+    if job.get("format"):
+        arguments += ["--format", job["format"]]
+    return arguments + options_to_arguments(job.get("options"))
+
+
+@contextlib.contextmanager
+def memory_limit(megabytes):
+    """Limit the address space of the current process while the context is active."""
+    if not megabytes or resource is None:
+        yield
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = int(float(megabytes) * 2 ** 20)
+    resource.setrlimit(resource.RLIMIT_AS, (limit if hard == resource.RLIM_INFINITY else min(limit, hard), hard))
+    try:
+        yield
+    finally:
+        resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+
+
+class ProgressLog(io.StringIO):
+    """Captured output of a conversion that also reports every complete line to a progress function."""
+
+    def __init__(self, progress):
+        super().__init__()
+        self.progress = progress
+        self.pending = ""
+
+    def write(self, text):
+        *lines, self.pending = (self.pending + text).split("\n")
+        for line in lines:
+            self.progress({"event": "log", "line": line})
+        return super().write(text)
+
+
+def run_job(job, default_memory_limit=None, progress=None):
+    """
+    Convert one manifest job in the current process and report how it went.
+
+    Errors, including running out of the memory limit, are caught and reported instead of raised, so one failing job
+    does not stop the batch. The output of the conversion is captured in the report.
+
+    Args:
+        job: job dict, see read_manifest
+        default_memory_limit: memory limit in megabytes if the job does not set its own
+        progress: optional function called with the progress events of the conversion, {"event": "log", "line": ...}
+            for every printed line and {"event": "stage", ...} with the profiling record of every stage and step
+
+    Returns:
+        a dict with the input, output, status ("ok" or "failed"), wall and cpu seconds, output log and error
+    """
+    from atlas_conversion.__main__ import create_parser, check_and_parse_args, run
+
+    report = {"input": job["input"], "output": job["output"], "status": "ok", "error": None}
+    start, cpu_start = time.perf_counter(), time.process_time()
+    log = io.StringIO() if progress is None else ProgressLog(progress)
+    callback = None if progress is None else (lambda record: progress(dict(record, event="stage")))
+    try:
+        with contextlib.redirect_stdout(log), memory_limit(job.get("memory_limit", default_memory_limit)):
+            run(check_and_parse_args(create_parser(), job_arguments(job)), callback)
+    except (Exception, SystemExit) as e:
+        report["status"] = "failed"
+        report["error"] = "".join(traceback.format_exception_only(type(e), e)).strip()
+    report["seconds"] = time.perf_counter() - start
+    report["cpu_seconds"] = time.process_time() - cpu_start
+    report["log"] = log.getvalue()
+    return report
+
+
+def _run_pool(jobs, indices, workers, default_memory_limit, runner, reports, callback):
+    """
+    Run the jobs at indices in one pool of worker processes, filling reports as they finish.
+
+    Returns:
+        the indices of the unfinished jobs, in submission order, if a worker process died and broke the pool
+    """
+    with ProcessPoolExecutor(max_workers=workers, mp_context=worker_context()) as executor:
+        futures = {executor.submit(runner, jobs[i], default_memory_limit): i for i in indices}
+        for future in as_completed(futures):
+            try:
+                report = future.result()
+            except BrokenProcessPool:
+                return [i for i in indices if reports[i] is None]
+            reports[futures[future]] = report
+            if callback:
+                callback(report)
+    return []
+
+
+def run_batch(jobs, workers=None, default_memory_limit=None, callback=None, runner=run_job):
+    """
+    Convert the jobs of a manifest in a shared pool of worker processes.
+
+    A worker process that dies, e.g. killed by the system when it runs out of memory or crashed by a native decoder,
+    breaks the pool. The jobs that were running at that time are then rerun one at a time to find the one that
+    crashed, which is reported as failed, and the other unfinished jobs continue in a fresh pool.
+
+    Args:
+        jobs: job dicts as returned by read_manifest
+        workers: number of worker processes, defaults to the number of cores
+        default_memory_limit: memory limit in megabytes of jobs that do not set their own
+        callback: called with every job report as soon as the job finishes
+        runner: module level function running one job in a worker, run_job by default
+
+    Returns:
+        the job reports, in manifest order
+    """
+    workers = workers or os.cpu_count()
+    reports = [None] * len(jobs)
+    remaining = list(range(len(jobs)))
+    while remaining:
+        remaining = _run_pool(jobs, remaining, workers, default_memory_limit, runner, reports, callback)
+        # jobs are started in submission order, so the job that crashed is one of the first unfinished ones
+        suspects, remaining = remaining[:workers], remaining[workers:]
+        while suspects:
+            suspects = _run_pool(jobs, suspects, 1, default_memory_limit, runner, reports, callback)
+            if suspects:
+                crashed = suspects.pop(0)
+                reports[crashed] = {"input": jobs[crashed]["input"], "output": jobs[crashed]["output"],
+                                    "status": "failed", "error": "the worker process running the job died",
+                                    "seconds": None, "cpu_seconds": None, "log": ""}
+                if callback:
+                    callback(reports[crashed])
+    return reports
+
+
+def print_report(report):
+    if report["status"] == "ok":
+        print("ok     {:8.2f} s  {} -> {}".format(report["seconds"], report["input"], report["output"]))
+    else:
+        print("failed            {} -> {}: {}".format(report["input"], report["output"], report["error"]))
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog='atlas_conversion batch',
+                                     description='''
+Convert every volume listed in a manifest with a shared pool of worker
+processes. A csv manifest has the columns input, output, format, options and
+memory_limit; a json manifest is a list of objects with the same keys. Only
+input and output are required, options are extra command line options of the
+conversion, e.g. "--gradient --resize 256 256".''',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('manifest', type=str, help='csv or json manifest of the conversions')
+    parser.add_argument('--workers', '-w', type=int,
+                        help='Number of worker processes, default is the number of cores.')
+    parser.add_argument('--memory-limit', type=float, metavar='MB',
+                        help='Memory limit of every job that does not set its own memory_limit.')
+    parser.add_argument('--report', type=str,
+                        help='Write the per job status, timings and logs to this json file.')
+    return parser
+
+
+def main(argv=None):
+    arguments = create_parser().parse_args(argv)
+    jobs = read_manifest(arguments.manifest)
+    print("Converting {} volumes...".format(len(jobs)))
+    start = time.perf_counter()
+    reports = run_batch(jobs, arguments.workers, arguments.memory_limit, callback=print_report)
+    failed = [report for report in reports if report["status"] != "ok"]
+    print("Done in {:.2f} s, {} converted, {} failed".format(time.perf_counter() - start, len(reports) - len(failed),
+                                                            len(failed)))
+    if arguments.report:
+        with open(arguments.report, "w") as f:
+            json.dump(reports, f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
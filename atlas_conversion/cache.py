@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+# Default maximum size of a cache directory, in bytes
+DEFAULT_CACHE_SIZE = 10 * 2 ** 30
+
+# Loader options that change how a volume is decoded but not the decoded data, left out of the cache keys
+NEUTRAL_LOADER_OPTIONS = {"workers", "backend", "stream"}
+
+# Extension of the cache entries, every entry is a numpy .npy file
+ENTRY_EXTENSION = ".npy"
+
+
+def _hash_file(digest, filename, block_size=2 ** 20):
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+
+
+def content_hash(path):
+    """
+    Return a hash of the content of an input file, or of the names and contents of the files in an input folder.
+
+    Folders are hashed like the loaders read them: the files directly in the folder, sorted by name.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            filename = os.path.join(path, name)
+            if os.path.isfile(filename):
+                digest.update(name.encode() + b"\0")
+                _hash_file(digest, filename)
+    else:
+        _hash_file(digest, path)
+    return digest.hexdigest()
+
+
+def volume_key(path, loader, loader_options):
+    """Return the cache key of the volume decoded from path by a loader called with loader_options."""
+    options = {key: value for key, value in loader_options.items() if key not in NEUTRAL_LOADER_OPTIONS}
+    description = json.dumps({
+        "content": content_hash(path),
+        "loader": loader.__module__ + "." + loader.__qualname__,
+        "options": options,
+    }, sort_keys=True, default=str)
+    return hashlib.blake2b(description.encode(), digest_size=20).hexdigest()
+
+
+def source_key(path, loader, loader_options):
+    """
+    Return the key of an input path read by a loader called with loader_options, independent of the input content.
+
+    Unlike volume_key, the key does not change when the input is edited, e.g. to find the previous conversion of an
+    input some slices of which were corrected.
+    """
+    options = {key: value for key, value in loader_options.items() if key not in NEUTRAL_LOADER_OPTIONS}
+    description = json.dumps({
+        "path": os.path.abspath(path),
+        "loader": loader.__module__ + "." + loader.__qualname__,
+        "options": options,
+    }, sort_keys=True, default=str)
+    return hashlib.blake2b(description.encode(), digest_size=20).hexdigest()
+
+
+def slice_hashes(volume, salt=b""):
+    """
+    Return the hashes of the slices of a (Z, H, W[, C]) volume as a (Z, 16) uint8 array.
+
+    The salt is hashed with every slice, e.g. the value range a slice is rescaled with, so that the hash also changes
+    when a slice is converted differently.
+    """
+    hashes = np.empty((len(volume), 16), dtype=np.uint8)
+    for i in range(len(volume)):
+        digest = hashlib.blake2b(salt, digest_size=16)
+        digest.update(np.ascontiguousarray(volume[i]).data)
+        hashes[i] = np.frombuffer(digest.digest(), dtype=np.uint8)
+    return hashes
+
+
+class Cache:
+    """
+    On-disk cache of decoded volumes, atlases and gradient atlases
+
+    Every entry is an array stored as a .npy file named after its key, which is loaded back as a read-only memory map,
+    so a cache hit costs no decoding and no copy. Reading an entry marks it as recently used; when the entries grow
+    larger than max_size bytes the least recently used ones are deleted. Entries are written to a temporary file and
+    renamed, so several processes can share a cache directory.
+
+    Attributes:
+        directory: folder holding the entries, created if needed
+        max_size: maximum total size of the entries in bytes, None for no limit
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE):
+        self.directory = str(directory)
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ENTRY_EXTENSION)
+
+    def get(self, key):
+        """Return the array stored under key as a read-only memory map, or None if it is not cached."""
+        path = self.path(key)
+        try:
+            array = np.load(path, mmap_mode="r")
+            now = time.time()
+            os.utime(path, (now, now))
+        except (FileNotFoundError, ValueError):
+            # missing, or evicted or truncated by another process while being read
+            return None
+        return array
+
+    def put(self, key, array):
+        """Store an array under key and evict the least recently used entries beyond max_size."""
+        fd, temporary = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, np.asarray(array), allow_pickle=False)
+            os.replace(temporary, self.path(key))
+        except BaseException:
+            os.remove(temporary)
+            raise
+        self.evict()
+
+    def entries(self):
+        """Return (last use time, size, path) of every entry, least recently used first."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(ENTRY_EXTENSION):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def size(self):
+        """Return the total size of the entries in bytes."""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """Delete the least recently used entries until the cache fits in max_size bytes."""
+        if self.max_size is None:
+            return
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
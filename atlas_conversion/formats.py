@@ -0,0 +1,258 @@
+import json
+import os
+import struct
+import zlib
+from functools import partial
+
+import numpy as np
+from PIL import Image
+
+from atlas_conversion.profiling import files_written, profiled_map
+
+# zlib strategies usable to compress png files, by name
+PNG_STRATEGIES = {
+    "default": zlib.Z_DEFAULT_STRATEGY,
+    "filtered": zlib.Z_FILTERED,
+    "huffman": zlib.Z_HUFFMAN_ONLY,
+    "rle": zlib.Z_RLE,
+    "fixed": zlib.Z_FIXED,
+}
+
+# Output formats writing one file per image, see ENCODERS; "container" writes all levels of an atlas into one file
+OUTPUT_FORMATS = ["png", "raw", "container"]
+
+# Magic bytes and alignment of the level data of container files
+CONTAINER_MAGIC = b"ATLASCNT"
+CONTAINER_ALIGNMENT = 256
+
+# png color types by number of channels
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+# Number of rows filtered at once by write_png_strips
+PNG_FILTER_ROWS = 64
+
+# Version of the metadata file layout, 2 added the atlas pages and grids that are not square, 3 the normalization of
+# the gradient and the packed atlases
+METADATA_VERSION = 3
+
+# Suffixes of the output file names by kind of atlas: the color atlas, the gradient atlas and the packed RGBA atlas of
+# the gradient and the intensity
+KIND_SUFFIXES = {"color": "", "gradient": "_gradient", "packed": "_packed"}
+
+
+def png_options(compress_level=None, strategy="default"):
+    """Return the Pillow png save options for a zlib compression level (0-9) and a strategy of PNG_STRATEGIES."""
+    if strategy not in PNG_STRATEGIES:
+        raise ValueError("Unknown png compression strategy: " + str(strategy))
+    options = {"compress_type": PNG_STRATEGIES[strategy]}
+    if compress_level is not None:
+        options["compress_level"] = compress_level
+    return options
+
+
+def encode_png(image, base_name, compress_level=None, strategy="default"):
+    """Write an image array as base_name.png and return the written filenames."""
+    filename = base_name + ".png"
+    Image.fromarray(image).save(filename, "PNG", **png_options(compress_level, strategy))
+    return [filename]
+
+
+def _png_chunk(f, chunk_type, data):
+    f.write(struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+
+def _filter_rows(rows, previous, bpp):
+    """
+    Filter uint8 scanlines with the png filter that suits every row best.
+
+    Every filter (none, sub, up, average and paeth) is applied to all rows at once, and each row keeps the filtered
+    bytes with the smallest sum of absolute values as signed bytes, the heuristic of libpng.
+
+    Args:
+        rows: (n, stride) uint8 scanlines
+        previous: the scanline above the first row, zeros for the first row of the image
+        bpp: bytes per pixel
+
+    Returns:
+        the (n, stride + 1) filtered scanlines, starting with their filter type
+    """
+    # uint8 arithmetic wraps around like the png filters do, only the paeth distances need more bits
+    up = np.concatenate([previous[np.newaxis], rows[:-1]])
+    left, up_left = np.zeros_like(rows), np.zeros_like(rows)
+    left[:, bpp:], up_left[:, bpp:] = rows[:, :-bpp], up[:, :-bpp]
+    up_distance = up.astype(np.int16) - up_left
+    left_distance = left.astype(np.int16) - up_left
+    # distances of the paeth estimate left + up - up_left to left, up and up_left
+    to_left, to_up, to_up_left = np.abs(up_distance), np.abs(left_distance), np.abs(up_distance + left_distance)
+    # select the nearest of up_left, up and left with 0/1 multipliers, much faster than np.where on random data
+    paeth = up_left + (to_up <= to_up_left).view(np.uint8) * (up - up_left)
+    paeth += ((to_left <= to_up) & (to_left <= to_up_left)).view(np.uint8) * (left - paeth)
+    average = (left >> 1) + (up >> 1) + (left & up & 1)
+    filtered = np.stack([rows, rows - left, rows - up, rows - average, rows - paeth])
+    # the absolute value of a byte as a signed byte
+    costs = np.minimum(filtered, -filtered).sum(axis=2, dtype=np.uint32)
+    choice = costs.argmin(axis=0)
+    lines = np.empty((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+    lines[:, 0] = choice
+    lines[:, 1:] = filtered[choice, np.arange(len(rows))]
+    return lines
+
+
+def write_png_strips(strips, shape, filename, compress_level=None, strategy="default"):
+    """
+    Write a uint8 image given as strips of rows to a png file, filtering and compressing every strip as it arrives.
+
+    Only the current strip and the compressor state are held in memory, so the image does not need to fit in memory,
+    e.g. an atlas whose rows of tiles are produced on demand. A strip can be reused for the next one once it is
+    written.
+
+    Args:
+        strips: iterable of (rows, W[, C]) uint8 arrays, whose rows add up to the height of the image
+        shape: (H, W[, C]) shape of the image, C being 1 to 4 channels
+        filename: path of the png file
+        compress_level: zlib compression level (0-9), 6 by default like Pillow
+        strategy: one of PNG_STRATEGIES
+
+    Returns:
+        the list of written filenames
+    """
+    if strategy not in PNG_STRATEGIES:
+        raise ValueError("Unknown png compression strategy: " + str(strategy))
+    height, width = shape[:2]
+    channels = shape[2] if len(shape) == 3 else 1
+    compressor = zlib.compressobj(6 if compress_level is None else compress_level, zlib.DEFLATED, 15, 9,
+                                  PNG_STRATEGIES[strategy])
+    previous = np.zeros(width * channels, dtype=np.uint8)
+    written = 0
+    with open(filename, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        _png_chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, PNG_COLOR_TYPES[channels], 0, 0, 0))
+        for strip in strips:
+            rows = np.ascontiguousarray(strip).reshape(len(strip), width * channels)
+            for start in range(0, len(rows), PNG_FILTER_ROWS):
+                block = rows[start:start + PNG_FILTER_ROWS]
+                data = compressor.compress(_filter_rows(block, previous, channels).data)
+                if data:
+                    _png_chunk(f, b"IDAT", data)
+                previous = block[-1].copy()
+            written += len(rows)
+        if written != height:
+            raise ValueError("The strips of {} have {} rows instead of {}".format(filename, written, height))
+        _png_chunk(f, b"IDAT", compressor.flush())
+        _png_chunk(f, b"IEND", b"")
+    return [filename]
+
+
+def encode_raw(image, base_name):
+    """Write the uncompressed bytes of an image array as base_name.bin with a base_name.json sidecar."""
+    filename = base_name + ".bin"
+    with open(filename, "wb") as f:
+        f.write(np.ascontiguousarray(image).data)
+    with open(base_name + ".json", "w") as f:
+        json.dump(array_description(image), f, indent=2)
+    return [filename, base_name + ".json"]
+
+
+# Encoders of the formats that write one file per image
+ENCODERS = {"png": encode_png, "raw": encode_raw}
+
+
+def array_description(image):
+    """Describe the layout of an (H, W[, C]) image array for the metadata files."""
+    return {
+        "width": image.shape[1],
+        "height": image.shape[0],
+        "channels": image.shape[2] if image.ndim == 3 else 1,
+        "dtype": image.dtype.name,
+    }
+
+
+def _encode_job(job, output_format="png", **options):
+    image, base_name = job
+    return ENCODERS[output_format](image, base_name, **options)
+
+
+def encode_images(jobs, output_format="png", workers=None, backend="thread", **options):
+    """
+    Encode (image array, base name) pairs in parallel with one of the ENCODERS.
+
+    Returns:
+        the list of written filenames of every job
+    """
+    if output_format not in ENCODERS:
+        raise ValueError("Unknown output format: " + str(output_format))
+    encode = partial(_encode_job, output_format=output_format, **options)
+    return list(profiled_map(encode, jobs, workers, backend, "encode", files_written))
+
+
+def _aligned(size):
+    """Round size up to a multiple of CONTAINER_ALIGNMENT."""
+    return -(-size // CONTAINER_ALIGNMENT) * CONTAINER_ALIGNMENT
+
+
+def write_container(levels, filename):
+    """
+    Write several image arrays, e.g. all pyramid levels of an atlas, into one container file.
+
+    The file starts with CONTAINER_MAGIC, the little endian uint32 length of a JSON header and the header itself. The
+    header lists every level with its name, layout, length in bytes and offset from the start of the data section,
+    which begins at the first multiple of CONTAINER_ALIGNMENT bytes after the header. Every level is stored
+    uncompressed and aligned the same way, so it can be memory mapped and uploaded to a texture as is.
+
+    Args:
+        levels: list of (name, image array) pairs
+        filename: path of the container file
+    """
+    entries, offset = [], 0
+    for name, image in levels:
+        entries.append(dict(array_description(image), name=str(name), offset=offset, length=image.nbytes))
+        offset += _aligned(image.nbytes)
+    header = json.dumps({"levels": entries}).encode()
+    data_start = _aligned(len(CONTAINER_MAGIC) + 4 + len(header))
+    with open(filename, "wb") as f:
+        f.write(CONTAINER_MAGIC + struct.pack("<I", len(header)) + header)
+        for entry, (_, image) in zip(entries, levels):
+            f.seek(data_start + entry["offset"])
+            f.write(np.ascontiguousarray(image).data)
+        f.truncate(data_start + offset)
+    return [filename]
+
+
+def read_container(filename):
+    """Return the levels of a container file as a dict of read-only memory mapped arrays by level name."""
+    with open(filename, "rb") as f:
+        if f.read(len(CONTAINER_MAGIC)) != CONTAINER_MAGIC:
+            raise ValueError("Not an atlas container file: " + str(filename))
+        header_length = struct.unpack("<I", f.read(4))[0]
+        header = json.loads(f.read(header_length))
+    data_start = _aligned(len(CONTAINER_MAGIC) + 4 + header_length)
+    levels = {}
+    for entry in header["levels"]:
+        shape = (entry["height"], entry["width"]) + ((entry["channels"],) if entry["channels"] > 1 else ())
+        levels[entry["name"]] = np.memmap(filename, dtype=entry["dtype"], mode="r", offset=data_start + entry["offset"],
+                                          shape=shape)
+    return levels
+
+
+def write_metadata(filename, metadata):
+    """Write the machine readable description of an atlas conversion as JSON."""
+    with open(filename, "w") as f:
+        json.dump(dict(metadata, version=METADATA_VERSION), f, indent=2)
+
+
+def output_base_name(output_filename, kind, level, page=None):
+    """
+    Return the base name of an output file of a kind of KIND_SUFFIXES and level "full" or a pyramid size.
+
+    The page number is appended for the pages of atlases written as several pages.
+    """
+    suffix = KIND_SUFFIXES[kind]
+    page_suffix = "" if page is None else "_page" + str(page)
+    if level == "full":
+        return output_filename + suffix + "_full" + page_suffix
+    return output_filename + "_" + str(level) + suffix + page_suffix
+
+
+def file_entry(path, kind, level, image, page=0):
+    """Describe an output file of an atlas conversion for the metadata, path being stored relative to its folder."""
+    return dict(array_description(image), path=os.path.basename(path), kind=kind, level=level, page=page)
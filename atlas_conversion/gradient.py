@@ -0,0 +1,156 @@
+from functools import partial
+
+import numpy as np
+
+from atlas_conversion.profiling import profiled_iter
+
+# Order of the derivative axes in the gradient components, the same as calculate_gradient in utils
+GRADIENT_AXES = [1, 0, 2]
+
+# Axis along which the volume is split into chunks
+CHUNK_AXIS = 2
+
+# Kernels available to the fused gradient engine
+KERNELS = ["gaussian", "central", "sobel"]
+
+# float32 values held per voxel of a chunk: the halo-padded input, two intermediate buffers and three components
+VALUES_PER_VOXEL = 6
+
+# Voxels repeated at the borders of the volume before filtering, per kernel: the gaussian kernel pads the volume like
+# calculate_gradient in utils, so both compute the same gradient
+BORDER_PADDING = {"gaussian": 1}
+
+
+def _kernel_passes(kernel, axis, sigma):
+    """
+    Return the separable 1-d passes computing the derivative along axis, as (pass axis, filter) pairs.
+
+    Every filter is called as filter(input, axis=..., output=...). The pass along the chunk axis comes first, so the
+    following passes can be restricted to the core of the chunk without its halo.
+    """
+    from scipy import ndimage
+
+    if kernel == "gaussian":
+        passes = [(axis, partial(ndimage.gaussian_filter1d, sigma=sigma, order=1))]
+    elif kernel == "central":
+        passes = [(axis, partial(ndimage.correlate1d, weights=[-0.5, 0, 0.5]))]
+    elif kernel == "sobel":
+        passes = [(axis, partial(ndimage.correlate1d, weights=[-1, 0, 1]))]
+        passes += [(other, partial(ndimage.correlate1d, weights=[1, 2, 1])) for other in range(3) if other != axis]
+    else:
+        raise ValueError("Unknown gradient kernel: " + str(kernel))
+    return sorted(passes, key=lambda pass_: pass_[0] != CHUNK_AXIS)
+
+
+def kernel_halo(kernel, sigma=2):
+    """Return the number of neighbouring slices a kernel reads on each side along the chunk axis."""
+    if kernel == "gaussian":
+        # the radius scipy uses for its gaussian kernels (truncate=4.0)
+        return int(4.0 * sigma + 0.5)
+    return 1
+
+
+def budget_chunk_depth(shape, memory_budget):
+    """Return the number of z slices of a (x, y, z) volume whose chunk buffers fit in memory_budget bytes."""
+    return max(1, int(memory_budget // (shape[0] * shape[1] * VALUES_PER_VOXEL * 4)))
+
+
+def _pad_borders(block, axis, lead, trail):
+    """Fill the first lead and the last trail planes of block along axis with the planes they mirror."""
+    planes = np.moveaxis(block, axis, 0)
+    for i in range(lead):
+        planes[lead - 1 - i] = planes[lead + i]
+    for i in range(trail):
+        planes[len(planes) - trail + i] = planes[len(planes) - trail - 1 - i]
+
+
+def iter_gradient_chunks(volume, kernel="gaussian", sigma=2, chunk_depth=64, out=None, z_range=None):
+    """
+    Compute the gradient of a (x, y, z) volume chunk by chunk along z.
+
+    All three derivative components of a chunk are computed in one pass over a halo-padded copy of the chunk, so the
+    result is the same as filtering the whole volume at once (with reflected borders), without seams between chunks.
+    The halo-padded input and the intermediate buffers are allocated once and reused for every chunk. The gaussian
+    kernel first repeats the border voxels of the volume (see BORDER_PADDING), like calculate_gradient in utils.
+
+    Args:
+        volume: (x, y, z) array of any numeric dtype
+        kernel: one of KERNELS, the gaussian derivative gives the same gradient as calculate_gradient in utils
+        sigma: standard deviation of the gaussian kernel
+        chunk_depth: number of z slices computed per chunk
+        out: optional float32 (x, y, z, 3) array receiving the gradient, otherwise a chunk buffer is reused
+        z_range: optional (first, stop) z slices to compute, e.g. around changed slices. Their halo is still read from
+            the neighbouring slices, so they get the same gradient as when the whole volume is computed.
+
+    Yields:
+        (first z index, float32 (x, y, depth, 3) chunk), a view into out or into the reused chunk buffer, which is
+        overwritten by the next chunk
+    """
+    depth = volume.shape[CHUNK_AXIS]
+    z_first, z_stop = z_range or (0, depth)
+    chunk_depth = max(1, min(chunk_depth, z_stop - z_first))
+    halo, pad = kernel_halo(kernel, sigma), BORDER_PADDING.get(kernel, 0)
+    component_passes = [_kernel_passes(kernel, axis, sigma) for axis in GRADIENT_AXES]
+    plane = (slice(pad, pad + volume.shape[0]), slice(pad, pad + volume.shape[1]))
+    block = np.empty((volume.shape[0] + 2 * pad, volume.shape[1] + 2 * pad, chunk_depth + 2 * (halo + pad)),
+                     dtype=np.float32)
+    buffers = [np.empty_like(block), np.empty_like(block)]
+    chunk_buffer = None if out is not None else np.empty(volume.shape[:2] + (chunk_depth, 3), dtype=np.float32)
+
+    for start in range(z_first, z_stop, chunk_depth):
+        end = min(start + chunk_depth, z_stop)
+        # the halo is cut at the borders of the volume, where the filters reflect the chunk itself instead
+        first, last = max(start - halo, 0), min(end + halo, depth)
+        lead, trail = pad if first == 0 else 0, pad if last == depth else 0
+        padded = block[:, :, :lead + last - first + trail]
+        padded[plane + (slice(lead, lead + last - first),)] = volume[:, :, first:last]
+        for axis, (axis_lead, axis_trail) in enumerate([(pad, pad), (pad, pad), (lead, trail)]):
+            _pad_borders(padded, axis, axis_lead, axis_trail)
+        core = slice(start - first + lead, end - first + lead)
+        chunk = out[:, :, start:end] if out is not None else chunk_buffer[:, :, :end - start]
+
+        for component, passes in enumerate(component_passes):
+            source, written = padded, False
+            for i, (axis, filter_) in enumerate(passes):
+                if axis != CHUNK_AXIS and source.shape[CHUNK_AXIS] != end - start:
+                    # the remaining passes do not mix z slices, so the halo can be dropped
+                    source = source[:, :, core]
+                written = not pad and i == len(passes) - 1 and axis != CHUNK_AXIS
+                target = chunk[..., component] if written else buffers[i % 2][:, :, :source.shape[CHUNK_AXIS]]
+                filter_(source, axis=axis, output=target)
+                source = target
+            if not written:
+                if source.shape[CHUNK_AXIS] != end - start:
+                    source = source[:, :, core]
+                chunk[..., component] = source[plane]
+        yield start, chunk
+
+
+def fused_gradient(volume, kernel="gaussian", sigma=2, chunk_depth=64, out=None):
+    """
+    Compute the gradient of a (x, y, z) volume into one float32 (x, y, z, 3) array.
+
+    Returns:
+        the gradient array and its minimum and maximum, which are tracked while the chunks are written
+    """
+    if out is None:
+        out = np.empty(volume.shape + (3,), dtype=np.float32)
+    minimum, maximum = np.float32(np.inf), np.float32(-np.inf)
+    for _, chunk in profiled_iter(iter_gradient_chunks(volume, kernel, sigma, chunk_depth, out), "gradient chunk"):
+        minimum, maximum = min(minimum, chunk.min()), max(maximum, chunk.max())
+    return out, minimum, maximum
+
+
+def quantize_gradient(gradient, minimum, maximum):
+    """
+    Normalize a float32 gradient block in place between minimum and maximum and return it as uint8.
+
+    Returns:
+        the uint8 gradient and the uint8 value of a zero gradient, i.e. the background of the gradient atlas
+    """
+    # the same operations as utils.normalize and normalize_rgb, so the fused gaussian kernel quantizes like the dask one
+    value_range = max(maximum - minimum, np.finfo(np.float32).tiny)
+    gradient -= minimum
+    gradient /= value_range
+    gradient *= 255
+    return gradient.astype(np.uint8), int(-minimum / value_range * 255)
@@ -0,0 +1,183 @@
+import numpy as np
+
+from atlas_conversion.atlas import Atlas
+from atlas_conversion.cache import slice_hashes, source_key
+from atlas_conversion.gradient import iter_gradient_chunks, kernel_halo, quantize_gradient
+from atlas_conversion.loaders import SliceStream
+from atlas_conversion.profiling import stage
+from atlas_conversion.tiling import tile_view, tile_volume
+from atlas_conversion.utils import calculate_gradient_slices, volume_range
+
+
+def changed_slices(previous, hashes):
+    """
+    Return the indices of the slices whose hash differs from their previous hash.
+
+    All the slices changed when there are no previous hashes, or hashes of another number of slices.
+    """
+    if previous is None or previous.shape != hashes.shape:
+        return np.arange(len(hashes))
+    return np.flatnonzero((previous != hashes).any(axis=1))
+
+
+def affected_ranges(changed, num_slices, radius):
+    """Return the merged (first, stop) ranges of the slices within radius of a changed slice, in slice order."""
+    ranges = []
+    for index in changed:
+        first, stop = max(int(index) - radius, 0), min(int(index) + radius + 1, num_slices)
+        if ranges and first <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], stop)
+        else:
+            ranges.append((first, stop))
+    return ranges
+
+
+def complement_ranges(z_ranges, num_slices):
+    """Return the (first, stop) ranges of the slices that are not in the sorted, disjoint z_ranges."""
+    complement, first = [], 0
+    for start, stop in list(z_ranges) + [(num_slices, num_slices)]:
+        if start > first:
+            complement.append((first, start))
+        first = stop
+    return complement
+
+
+class IncrementalAtlas(Atlas):
+    """
+    Atlas converting again only the slices that changed since the previous conversion of the same input
+
+    The hashes of the slices and the atlas, and once computed the gradient atlas with the value range of the gradient
+    of every slice, are kept in the cache under the cache.source_key of the input, which does not depend on its
+    content. When the input is converted again after some of its slices changed, e.g. were corrected, only the tiles
+    of the changed slices are placed into the previous atlas, and the gradient is only computed again for the slices
+    within the kernel radius of a changed slice (the halo of the gaussian kernel, see gradient.kernel_halo). These are
+    quantized into the previous gradient atlas, unless the value range of the whole gradient changed, in which case
+    the whole gradient is computed and quantized again. The result is the same as a full conversion.
+
+    An input found in the cache with the same content is reused as a whole, see Atlas. The slices are held in memory:
+    streams are not supported, and the gradient is always computed in memory.
+
+    Attributes:
+        changed: indices of the slices tiled by the last conversion, None when the atlas was found in the cache
+        recomputed: (first, stop) ranges of the slices whose gradient was computed by the last gradient_atlas, None
+            when the gradient atlas was found in the cache
+    """
+
+    def __init__(self, loader, cache, profiler=None, **loader_options):
+        if cache is None:
+            raise ValueError("Incremental conversions keep the previous conversion in a cache")
+        super().__init__(loader, cache=cache, profiler=profiler, **loader_options)
+        self.source_key = None
+        self.changed = None
+        self.recomputed = None
+        self._hashes = None
+
+    def load(self, path):
+        super().load(path)
+        if isinstance(self.slices, SliceStream):
+            raise ValueError("Incremental conversions need the whole volume, not a stream of slices")
+        self.source_key = source_key(path, self.loader, self.loader_options)
+        self._hashes = None
+
+    def slice_hashes(self):
+        """Return the hashes of the slices (see cache.slice_hashes), which change with the range of 16 bit data."""
+        if self._hashes is None:
+            salt = b"" if self.slices.dtype == np.uint8 else np.array(volume_range(self.slices)).tobytes()
+            with stage("hash slices"):
+                self._hashes = slice_hashes(self.slices, salt)
+        return self._hashes
+
+    def _previous(self, key, shape):
+        """Return the previous hashes and array stored under key, None for both when the array is not of shape."""
+        previous, array = self.cache.get(key + "-hashes"), self.cache.get(key)
+        if previous is None or array is None or array.shape != shape:
+            return None, None
+        return previous, array
+
+    def _convert(self):
+        key = "{}-incremental-atlas-{}".format(self.source_key, self.layout.columns)
+        hashes = self.slice_hashes()
+        previous, atlas = self._previous(key, self.layout.shape + (3,))
+        self.changed = changed_slices(previous, hashes)
+        if previous is None:
+            super()._convert()
+        else:
+            self.atlas = np.array(atlas)
+            transform = self._rescale_transform()
+            for i in self.changed:
+                block = self.slices[i:i + 1] if transform is None else transform(self.slices[i:i + 1])
+                tile = tile_view(self.atlas, i, self.layout.columns, self.layout.slice_shape)
+                tile[...] = block[0].reshape(*tile.shape[:2], -1)
+        self.cache.put(key, self.atlas)
+        self.cache.put(key + "-hashes", hashes)
+
+    def _gradient_atlas(self, memory_budget, kernel, sigma, dask_options):
+        """Compute the gradient atlas, only around the slices changed since the previous one, see gradient_atlas."""
+        volume = self.grayscale_volume().transpose(1, 2, 0)
+        key = "{}-incremental-gradient-{}-{}-{}".format(self.source_key, kernel or "dask", sigma, self.layout.columns)
+        hashes = self.slice_hashes()
+        num_slices = len(hashes)
+        previous, atlas_array = self._previous(key, self.layout.shape + (3,))
+        ranges = None if previous is None else self.cache.get(key + "-ranges")
+        if ranges is None or len(ranges) != num_slices:
+            previous, ranges = None, np.empty((num_slices, 2), dtype=np.float32)
+        else:
+            previous_range = ranges[:, 0].min(), ranges[:, 1].max()
+            ranges = np.array(ranges)
+
+        # the dask gradient is the gradient of the fused gaussian kernel, with the same radius
+        self.recomputed = affected_ranges(changed_slices(previous, hashes), num_slices,
+                                          kernel_halo(kernel or "gaussian", sigma))
+        gradients = self._gradient_ranges(volume, self.recomputed, kernel, sigma, dask_options, ranges)
+        minimum, maximum = ranges[:, 0].min(), ranges[:, 1].max()
+        requantized = previous is None or (minimum, maximum) != previous_range
+        if previous is not None and requantized:
+            # the value range of the whole gradient changed, so the other slices are quantized again as well
+            gradients += self._gradient_ranges(volume, complement_ranges(self.recomputed, num_slices), kernel, sigma,
+                                               dask_options, ranges)
+            self.recomputed = [(0, num_slices)]
+
+        # the dask gradient is quantized like the fused kernels, see gradient.quantize_gradient
+        g_background = quantize_gradient(np.zeros(3, dtype=np.float32), minimum, maximum)[1]
+        if requantized:
+            atlas_array = np.empty(self.layout.shape + (3,), dtype=np.uint8)
+            atlas_array[...] = g_background
+        else:
+            atlas_array = np.array(atlas_array)
+        for first, gradient in gradients:
+            gradient_data = quantize_gradient(gradient, minimum, maximum)[0]
+            if first == 0 and gradient_data.shape[2] == num_slices:
+                tile_volume(gradient_data.transpose(2, 0, 1, 3), self.layout.columns, fill=g_background,
+                            out=atlas_array)
+                continue
+            for i in range(gradient_data.shape[2]):
+                tile_view(atlas_array, first + i, self.layout.columns, self.layout.slice_shape)[...] = \
+                    gradient_data[:, :, i]
+        self._set_gradient_normalization(minimum, maximum, g_background)
+        self.cache.put(key, atlas_array)
+        self.cache.put(key + "-hashes", hashes)
+        self.cache.put(key + "-ranges", ranges)
+        return atlas_array
+
+    def _gradient_ranges(self, volume, z_ranges, kernel, sigma, dask_options, ranges):
+        """
+        Compute the gradient of the (first, stop) ranges of slices of a (x, y, z) grayscale volume.
+
+        Returns:
+            the (first slice, float32 (x, y, z, 3) gradient) of every range, whose value range per slice is written
+            into the (Z, 2) ranges array
+        """
+        gradients = []
+        for first, stop in z_ranges:
+            with stage("gradient slices", first=int(first), stop=int(stop)):
+                if kernel is None:
+                    gradient = calculate_gradient_slices(self._dask_volume(volume, sigma, dask_options), first, stop,
+                                                         sigma, dask_options["scheduler"], dask_options["workers"])
+                else:
+                    gradient = np.empty(volume.shape[:2] + (stop - first, 3), dtype=np.float32)
+                    for start, chunk in iter_gradient_chunks(volume, kernel, sigma, z_range=(first, stop)):
+                        gradient[:, :, start - first:start - first + chunk.shape[2]] = chunk
+            ranges[first:stop, 0] = gradient.min(axis=(0, 1, 3))
+            ranges[first:stop, 1] = gradient.max(axis=(0, 1, 3))
+            gradients.append((first, gradient))
+        return gradients
@@ -0,0 +1,108 @@
+import numpy as np
+
+from atlas_conversion.utils import rescale_to_uint8, volume_range
+
+# Number of values sampled from a volume to estimate its percentiles
+SAMPLE_SIZE = 2 ** 20
+
+# Number of slices decoded by the pre-pass of streamed volumes
+SAMPLE_SLICES = 16
+
+
+def sample_values(volume, sample_size=SAMPLE_SIZE, rescale=None):
+    """
+    Return about sample_size values of a volume, taken at a regular stride over all its voxels.
+
+    rescale is an optional (Z, 2) array of the (slope, intercept) of every slice, applied to the sampled values of
+    the slice, see rescale_slices.
+    """
+    if isinstance(volume, np.ndarray):
+        # the values of a rescaled volume are sampled in slice order, to find the slice of every value
+        values = volume.ravel(order="K" if rescale is None else "C")
+    else:
+        values = np.concatenate([np.ravel(slice_) for slice_ in volume])
+    step = max(1, values.size // sample_size)
+    sample = np.asarray(values[::step])
+    if rescale is None:
+        return sample
+    slices = np.arange(0, values.size, step) // (values.size // len(volume))
+    return sample.astype(np.float32) * rescale[slices, 0] + rescale[slices, 1]
+
+
+def modality_rescale(pixels, slope=1, intercept=0):
+    """Apply the RescaleSlope and RescaleIntercept of a dicom slice, the values are float32 unless they are 1 and 0."""
+    slope, intercept = float(slope), float(intercept)
+    if slope == 1 and intercept == 0:
+        return pixels
+    return pixels.astype(np.float32) * np.float32(slope) + np.float32(intercept)
+
+
+def rescale_slices(chunk, rescale):
+    """Apply a float32 (Z, 2) array of (slope, intercept) to the Z slices of a chunk, like modality_rescale."""
+    shape = (-1,) + (1,) * (chunk.ndim - 1)
+    return chunk.astype(np.float32) * rescale[:, 0].reshape(shape) + rescale[:, 1].reshape(shape)
+
+
+def _chunks(volume, rescale=None, chunk_size=16):
+    """Yield (first slice, chunk) of chunk_size slices of a volume, with the rescale of their slices applied."""
+    for start in range(0, len(volume), chunk_size):
+        chunk = volume[start:start + chunk_size]
+        yield start, chunk if rescale is None else rescale_slices(chunk, rescale[start:start + chunk_size])
+
+
+def needs_mapping(dtype, window=None, percentiles=None):
+    """Return whether data of dtype is mapped to uint8, i.e. it has a higher bit depth or a window is requested."""
+    return np.dtype(dtype) != np.uint8 or window is not None or percentiles is not None
+
+
+def intensity_range(volume, window=None, percentiles=None, sample=None, rescale=None):
+    """
+    Return the (low, high) values mapped to 0 and 255.
+
+    Args:
+        volume: the volume array, used for the exact minimum and maximum when neither window nor percentiles is given
+        window: (center, width) of a window/level, in the units of the data (e.g. Hounsfield units)
+        percentiles: (low, high) percentiles, in [0-100], estimated on a sample of the volume
+        sample: values to estimate the percentiles, or the minimum and maximum if volume is None, taken from the volume
+            with sample_values by default
+        rescale: optional (Z, 2) array of the (slope, intercept) of every slice of the volume, see rescale_slices
+    """
+    if window is not None:
+        center, width = window
+        return center - width / 2, center + width / 2
+    if percentiles is not None:
+        sample = sample_values(volume, rescale=rescale) if sample is None else sample
+        low, high = np.percentile(sample, percentiles)
+        return low, high
+    if volume is None:
+        return sample.min(), sample.max()
+    if rescale is None:
+        return volume_range(volume)
+    ranges = [(chunk.min(), chunk.max()) for _, chunk in _chunks(volume, rescale)]
+    return min(low for low, _ in ranges), max(high for _, high in ranges)
+
+
+def map_to_uint8(volume, low, high, chunk_size=16, rescale=None):
+    """
+    Linearly map the values of a volume between low and high to [0-255], a chunk of its first axis at a time.
+
+    The (slope, intercept) of the slices in the optional (Z, 2) rescale array are applied to every chunk first.
+    """
+    out = np.empty(volume.shape, dtype=np.uint8)
+    for start, chunk in _chunks(volume, rescale, chunk_size):
+        out[start:start + chunk_size] = rescale_to_uint8(chunk, low, high)
+    return out
+
+
+def map_intensity(volume, window=None, percentiles=None, rescale=None):
+    """
+    Map a whole volume to uint8 with intensity_range, volumes already in uint8 without a window are unchanged.
+
+    rescale is an optional (Z, 2) array of the (slope, intercept) of every slice, applied a chunk of slices at a time,
+    so the volume keeps its stored integer samples.
+    """
+    if rescale is not None and np.all(rescale == (1, 0)):
+        rescale = None
+    if rescale is None and not needs_mapping(volume.dtype, window, percentiles):
+        return volume
+    return map_to_uint8(volume, *intensity_range(volume, window, percentiles, rescale=rescale), rescale=rescale)
@@ -1,59 +1,542 @@
 import os
-import pydicom
+from functools import partial
+
 import numpy as np
-import nrrd
 from PIL import Image
 
+from atlas_conversion.intensity import (SAMPLE_SLICES, intensity_range, map_intensity, modality_rescale,
+                                        needs_mapping, sample_values)
+from atlas_conversion.profiling import file_read, profiled_iter, profiled_map, stage
+from atlas_conversion.utils import rescale_to_uint8, volume_range
+
+
+class SliceStream:
+    """
+    Stream of volume slices
+
+    A loader called with stream=True returns a SliceStream instead of a list. The number of slices and their shape are
+    known up front, so the consumer can preallocate its output and drop every slice once it has been placed. The
+    slices can only be iterated once.
+
+    Attributes:
+        num_slices: number of slices the stream yields
+        shape: shape of every slice, as a numpy array shape
+        slices: iterable that decodes and yields the slices in order
+    """
+
+    def __init__(self, num_slices, shape, slices):
+        self.num_slices = num_slices
+        self.shape = tuple(shape)
+        self.slices = slices
+
+    def __len__(self):
+        return self.num_slices
+
+    def __iter__(self):
+        return iter(self.slices)
+
+
+# Pillow modes kept as decoded, other modes are converted to "L" (single channel modes) or "RGB"
+NATIVE_MODES = {"L", "RGB", "I", "I;16", "F"}
+
+# Native modes of more than 8 bits per sample, mapped to uint8 by the atlas or, when streamed, by the loader
+HIGH_BIT_DEPTH_MODES = {"I", "I;16", "F"}
+
+
+def native_mode(mode):
+    """Return the Pillow mode a slice decoded in mode is kept in, preserving single channel images."""
+    if mode in NATIVE_MODES:
+        return mode
+    return "L" if mode in ("1", "LA") else "RGB"
+
+
+def volume_mode(filenames, modes):
+    """
+    Return the Pillow mode all the slices of a volume are converted to, from the native modes of its files.
+
+    A volume mixing single channel 8 bit and RGB slices is converted to RGB.
+
+    Raises:
+        ValueError: if slices of more than 8 bits per sample are mixed with slices of another mode
+    """
+    if len(set(modes)) == 1:
+        return modes[0]
+    if set(modes) <= {"L", "RGB"}:
+        return "RGB"
+    high = next(i for i, mode in enumerate(modes) if mode in HIGH_BIT_DEPTH_MODES)
+    other = next(i for i, mode in enumerate(modes) if mode != modes[high])
+    raise ValueError("{} is a {} image but {} is a {} image, high bit depth slices cannot be mixed with slices of "
+                     "another mode".format(filenames[high], modes[high], filenames[other], modes[other]))
+
+
+def resized_shape(shape, resize):
+    """Return the slice shape after resize, where resize is (width, height) as given to resize_image."""
+    if not resize:
+        return tuple(shape)
+    return (resize[1], resize[0]) + tuple(shape[2:])
+
+
+def slice_selection(num_slices, z_range=None, z_stride=None):
+    """
+    Return the indices of the slices of a volume of num_slices slices that are loaded, as a range.
+
+    z_range is the (first, stop) range of the slices, as a python slice, and z_stride keeps every z_stride-th slice of
+    it, e.g. for previews.
+    """
+    first, stop = z_range or (None, None)
+    selected = range(num_slices)[first:stop:z_stride or 1]
+    if not selected:
+        raise ValueError("z range {} selects none of the {} slices".format(tuple(z_range), num_slices))
+    return selected
+
+
+def crop_window(shape, roi=None):
+    """
+    Return the (rows, columns) slices of the region of interest of slices of shape (H, W[, C]).
+
+    roi is (x, y, width, height) in pixels of the decoded slices, before any resize, clipped to the slices.
+    """
+    if roi is None:
+        return slice(0, shape[0]), slice(0, shape[1])
+    x, y, width, height = roi
+    rows, columns = slice(max(y, 0), min(y + height, shape[0])), slice(max(x, 0), min(x + width, shape[1]))
+    if rows.start >= rows.stop or columns.start >= columns.stop:
+        raise ValueError("region of interest {} is outside of the {}x{} slices".format(tuple(roi), shape[1], shape[0]))
+    return rows, columns
+
+
+def cropped_shape(shape, roi=None):
+    """Return the slice shape after cropping the region of interest, see crop_window."""
+    rows, columns = crop_window(shape, roi)
+    return (rows.stop - rows.start, columns.stop - columns.start) + tuple(shape[2:])
+
 
 def resize_image(image, size, interpolation):
     """Resize an image using the specified interpolation."""
     return image.resize(size, interpolation)
 
 
-def png_loader(path, resize=None, interpolation=Image.BICUBIC):
-    filenames = sorted([os.path.join(path, f) for f in os.listdir(path)])
-    images = [Image.open(f).convert('RGB') for f in filenames if f.lower().endswith(".png")]
+def resize_array(array, size, interpolation):
+    """Resize a (H, W[, C]) slice array with resize_image."""
+    return np.array(resize_image(Image.fromarray(array), size, interpolation))
 
-    if resize:
-        images = [resize_image(img, resize, interpolation) for img in images]
 
-    return [np.array(img) for img in images]
+def stack_slices(slices, max_slices, path):
+    """
+    Copy decoded slices into one contiguous (Z, H, W[, C]) volume, allocated for max_slices slices.
+
+    Slices that are None (files that are not part of the volume) are skipped, every other slice is dropped as soon as
+    it is copied. The volume has the dtype of the first slice, and is promoted to hold the values of any later slice
+    of another dtype, e.g. a 16 bit slice in a series of 8 bit slices.
+    """
+    volume, count = None, 0
+    for slice_ in slices:
+        if slice_ is None:
+            continue
+        if volume is None:
+            volume = np.empty((max_slices,) + slice_.shape, dtype=slice_.dtype)
+        elif not np.can_cast(slice_.dtype, volume.dtype):
+            volume = volume.astype(np.result_type(volume.dtype, slice_.dtype))
+        volume[count] = slice_
+        count += 1
+    if volume is None:
+        raise ValueError("no slices found in " + str(path))
+    return volume[:count]
+
 
+def _png_header(filename):
+    """Return the (height, width) and the native mode of a png file, reading only its header."""
+    with Image.open(filename) as image:
+        return (image.height, image.width), native_mode(image.mode)
 
-def nrrd_loader(path, resize=None, interpolation=Image.BICUBIC):
-    data, header = nrrd.read(path)
-    slices = [Image.fromarray(data[:, :, i]).convert('RGB') for i in range(data.shape[2])]
 
+def _decode_png(filename, resize=None, interpolation=Image.BICUBIC, roi=None, value_range=None, mode=None):
+    """
+    Decode a single png file into a numpy array, cropping and resizing it if requested.
+
+    The image is converted to mode, by default its native mode (see native_mode). If value_range is given, the
+    (minimum, maximum) sample values are mapped to [0-255] after resizing.
+    """
+    with Image.open(filename) as image:
+        if roi is not None:
+            rows, columns = crop_window((image.height, image.width), roi)
+            image = image.crop((columns.start, rows.start, columns.stop, rows.stop))
+        image = image.convert(mode or native_mode(image.mode))
     if resize:
-        slices = [resize_image(slice_, resize, interpolation) for slice_ in slices]
+        image = resize_image(image, resize, interpolation)
+    if value_range is not None:
+        return rescale_to_uint8(np.array(image), *value_range)
+    return np.array(image)
+
 
-    return [np.array(slice_) for slice_ in slices]
+def _png_sample_range(filenames, decode, workers=None, backend="thread"):
+    """Return the (minimum, maximum) of a png stack from a pre-pass decoding SAMPLE_SLICES evenly spaced files."""
+    step = max(1, len(filenames) // SAMPLE_SLICES)
+    return volume_range(list(profiled_map(decode, filenames[::step], workers, backend, "sample", file_read)))
 
 
-def dicom_loader(path, resize=None, interpolation=Image.BICUBIC):
+def png_loader(path, resize=None, interpolation=Image.BICUBIC, workers=None, backend="thread", stream=False,
+               z_range=None, z_stride=None, roi=None):
+    """
+    Load the png files of a folder, sorted by name, as slices.
+
+    Only the files of the slices selected by z_range and z_stride (see slice_selection) are opened, and the region of
+    interest roi (x, y, width, height) is cropped before the slices are converted and resized. All the slices are
+    converted to one mode, which the headers of the files decide, see volume_mode.
+
+    Slices of more than 8 bits per sample (16 bit, 32 bit integer and float images) keep their values, the atlas maps
+    the whole volume to uint8. The slices of a stream are mapped as they are decoded instead, over the range of a
+    sample of the slices, which is the range of the whole volume when it has at most SAMPLE_SLICES slices.
+    """
     filenames = sorted([os.path.join(path, f) for f in os.listdir(path)])
-    dicom_files = [pydicom.dcmread(f, force=True) for f in filenames if f.lower().endswith(".dcm")]
-    slices = [Image.fromarray(f.pixel_array) for f in dicom_files if hasattr(f, "SliceLocation")]
+    filenames = [f for f in filenames if f.lower().endswith(".png")]
+    if not filenames:
+        raise ValueError("no slices found in " + str(path))
+    filenames = [filenames[i] for i in slice_selection(len(filenames), z_range, z_stride)]
+    # only the headers are read to choose one mode for all the slices, and the slice shape from the first file
+    with stage("scan"):
+        headers = list(profiled_map(_png_header, filenames, workers, backend, "header"))
+    mode = volume_mode(filenames, [header_mode for _, header_mode in headers])
+    decode = partial(_decode_png, resize=resize, interpolation=interpolation, roi=roi, mode=mode)
+    if stream:
+        shape = headers[0][0] + ((3,) if mode == "RGB" else ())
+        if mode in HIGH_BIT_DEPTH_MODES:
+            with stage("intensity"):
+                decode = partial(decode, value_range=_png_sample_range(filenames, decode, workers, backend))
+        return SliceStream(len(filenames), resized_shape(cropped_shape(shape, roi), resize),
+                           profiled_map(decode, filenames, workers, backend, "decode", file_read))
+    return stack_slices(profiled_map(decode, filenames, workers, backend, "decode", file_read), len(filenames), path)
+
+
+# numpy dtypes of the sample types of nrrd headers, by the names the nrrd format allows for them
+NRRD_TYPES = {
+    "i1": ["signed char", "int8", "int8_t"],
+    "u1": ["uchar", "unsigned char", "uint8", "uint8_t"],
+    "i2": ["short", "short int", "signed short", "signed short int", "int16", "int16_t"],
+    "u2": ["ushort", "unsigned short", "unsigned short int", "uint16", "uint16_t"],
+    "i4": ["int", "signed int", "int32", "int32_t"],
+    "u4": ["uint", "unsigned int", "uint32", "uint32_t"],
+    "i8": ["longlong", "long long", "long long int", "signed long long", "signed long long int", "int64", "int64_t"],
+    "u8": ["ulonglong", "unsigned long long", "unsigned long long int", "uint64", "uint64_t"],
+    "f4": ["float"],
+    "f8": ["double"],
+}
+NRRD_DTYPES = {name: dtype for dtype, names in NRRD_TYPES.items() for name in names}
 
+
+def nrrd_dtype(header):
+    """Return the numpy dtype of the raw samples described by a nrrd header, or None for an unknown type."""
+    if header["type"] not in NRRD_DTYPES:
+        return None
+    dtype = np.dtype(NRRD_DTYPES[header["type"]])
+    if dtype.itemsize == 1:
+        return dtype
+    if header.get("endian") not in ("little", "big"):
+        raise ValueError("nrrd header needs an endian of little or big, not " + str(header.get("endian")))
+    return raw_dtype(dtype, header["endian"])
+
+
+def nrrd_mmap(path):
+    """
+    Map the samples of an uncompressed nrrd file as a read-only array, in the axis order of nrrd.read.
+
+    Returns:
+        the memory map, or None if the samples are compressed, written as text, split across several files or of a
+        type without a numpy dtype (blocks)
+    """
+    import nrrd
+
+    with open(path, "rb") as f:
+        header = nrrd.read_header(f)
+        offset = f.tell()
+    data_file = header.get("datafile", header.get("data file"))
+    if header["encoding"] != "raw" or (data_file and (data_file.startswith("LIST") or " " in data_file)):
+        return None
+    dtype = nrrd_dtype(header)
+    if dtype is None:
+        return None
+    if data_file:
+        path, offset = os.path.join(os.path.dirname(path), data_file), 0
+    line_skip = header.get("lineskip", header.get("line skip", 0))
+    if line_skip:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for _ in range(line_skip):
+                f.readline()
+            offset = f.tell()
+    shape = tuple(int(size) for size in header["sizes"])
+    byte_skip = header.get("byteskip", header.get("byte skip", 0))
+    if byte_skip == -1:
+        offset = os.path.getsize(path) - dtype.itemsize * int(np.prod(shape))
+    else:
+        offset += byte_skip
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape, order="F")
+
+
+def _read_nrrd(path, window=None, percentiles=None, z_range=None, z_stride=None, roi=None):
+    """
+    Read the selected slices and region of interest of a nrrd volume, mapped to uint8 if it has a higher bit depth
+    or a window is requested.
+
+    Uncompressed files are memory mapped, so only the selected samples are read; compressed files are decompressed
+    as a whole.
+    """
+    import nrrd
+
+    with stage("read", file=path):
+        data = nrrd_mmap(path)
+        if data is None:
+            data, _ = nrrd.read(path)
+        indices = slice_selection(data.shape[2], z_range, z_stride)
+        rows, columns = crop_window(data.shape, roi)
+        data = data[rows, columns, indices.start:indices.stop:indices.step]
+    with stage("intensity"):
+        return map_intensity(data, window, percentiles)
+
+
+def _nrrd_slices(path, resize=None, interpolation=Image.BICUBIC, window=None, percentiles=None, z_range=None,
+                 z_stride=None, roi=None):
+    """Read a nrrd volume and yield its slices along the third axis as numpy arrays with their native channels."""
+    data = _read_nrrd(path, window, percentiles, z_range, z_stride, roi)
+    for i in range(data.shape[2]):
+        yield resize_array(data[:, :, i], resize, interpolation) if resize else data[:, :, i]
+
+
+def nrrd_loader(path, resize=None, interpolation=Image.BICUBIC, stream=False, window=None, percentiles=None,
+                z_range=None, z_stride=None, roi=None):
+    """
+    Load the slices of a nrrd volume along its third axis.
+
+    High bit depth data is mapped to uint8 over its whole range, unless a window (center, width) or percentiles
+    (low, high) select the mapped values, see intensity.intensity_range. Only the slices selected by z_range and
+    z_stride (see slice_selection) and the region of interest roi (x, y, width, height) are loaded, and read from
+    uncompressed files.
+    """
+    if stream or resize:
+        import nrrd
+
+        sizes = nrrd.read_header(path)["sizes"]
+        shape = cropped_shape(tuple(sizes[:2]) + tuple(sizes[3:]), roi)
+        num_slices = len(slice_selection(sizes[2], z_range, z_stride))
+        slices = profiled_iter(_nrrd_slices(path, resize, interpolation, window, percentiles, z_range, z_stride, roi),
+                               "decode")
+        if stream:
+            return SliceStream(num_slices, resized_shape(shape, resize), slices)
+        return stack_slices(slices, num_slices, path)
+    data = _read_nrrd(path, window, percentiles, z_range, z_stride, roi)
+    # the slices are moved to the first axis in a single copy
+    with stage("decode"):
+        return np.ascontiguousarray(np.moveaxis(data, 2, 0))
+
+
+def read_dicom_header(filename):
+    """
+    Read the header of a dicom file without its pixel data.
+
+    Returns:
+        a dict describing the slice (filename, series, shape, bits, rescale, location and position along the slice
+        normal), or None if the file is not a slice of a volume: it has no pixel data, no position, or it is a
+        localizer (scout) image
+    """
+    import pydicom
+
+    header = pydicom.dcmread(filename, force=True, stop_before_pixels=True)
+    if "Rows" not in header or "LOCALIZER" in [str(value).upper() for value in header.get("ImageType", [])]:
+        return None
+    position = None
+    if "ImagePositionPatient" in header:
+        orientation = np.array(header.get("ImageOrientationPatient", [1, 0, 0, 0, 1, 0]), dtype=np.float64)
+        # the position of a slice along the normal of its plane orders slices of any orientation
+        position = float(np.dot(np.cross(orientation[:3], orientation[3:]),
+                                np.array(header.ImagePositionPatient, dtype=np.float64)))
+    location = float(header.SliceLocation) if "SliceLocation" in header else None
+    if position is None and location is None:
+        return None
+    samples = int(header.get("SamplesPerPixel", 1))
+    return {
+        "filename": filename,
+        "series": str(header.get("SeriesInstanceUID", "")),
+        "shape": (int(header.Rows), int(header.Columns)) + ((samples,) if samples > 1 else ()),
+        "bits": int(header.get("BitsAllocated", 8)),
+        "rescale": (float(header.get("RescaleSlope", 1)), float(header.get("RescaleIntercept", 0))),
+        "position": position,
+        "location": location,
+    }
+
+
+def select_dicom_series(headers, series=None):
+    """
+    Return the headers of the slices of one series, sorted by position.
+
+    Args:
+        headers: headers of read_dicom_header, None for files that are not slices
+        series: SeriesInstanceUID of the series, by default the series with the most slices. Slices of another shape
+            than the most common one in the series are left out.
+    """
+    groups = {}
+    for header in headers:
+        if header is not None:
+            groups.setdefault(header["series"], []).append(header)
+    if series is not None:
+        if series not in groups:
+            raise ValueError("no slices of series " + str(series))
+        chosen = groups[series]
+    else:
+        chosen = max(groups.values(), key=len, default=[])
+    if not chosen:
+        return []
+    shapes = [header["shape"] for header in chosen]
+    shape = max(set(shapes), key=shapes.count)
+    chosen = [header for header in chosen if header["shape"] == shape]
+    # the filenames are sorted, so slices without positions keep their file order
+    if all(header["position"] is not None for header in chosen):
+        return sorted(chosen, key=lambda header: header["position"])
+    if all(header["location"] is not None for header in chosen):
+        return sorted(chosen, key=lambda header: header["location"])
+    return chosen
+
+
+def _decode_dicom(filename, resize=None, interpolation=Image.BICUBIC, value_range=None, roi=None, rescale=True):
+    """
+    Decode the pixel data of a single dicom file into a numpy array.
+
+    The region of interest roi is cropped first, then the RescaleSlope and RescaleIntercept of the file are applied
+    (unless rescale is False, which keeps the stored samples), and if value_range is given the (low, high) values are
+    mapped to [0-255] before resizing.
+    """
+    import pydicom
+
+    dicom_file = pydicom.dcmread(filename, force=True)
+    pixels = dicom_file.pixel_array
+    if roi is not None:
+        pixels = pixels[crop_window(pixels.shape, roi)]
+    if rescale:
+        pixels = modality_rescale(pixels, dicom_file.get("RescaleSlope", 1), dicom_file.get("RescaleIntercept", 0))
+    if value_range is not None:
+        pixels = rescale_to_uint8(pixels, *value_range)
     if resize:
-        slices = [resize_image(slice_, resize, interpolation) for slice_ in slices]
+        return resize_array(pixels, resize, interpolation)
+    return pixels
+
+
+def _dicom_sample_range(filenames, window=None, percentiles=None, workers=None, backend="thread", roi=None):
+    """Return the intensity range of a dicom series from a pre-pass decoding SAMPLE_SLICES evenly spaced files."""
+    if window is not None:
+        return intensity_range(None, window)
+    step = max(1, len(filenames) // SAMPLE_SLICES)
+    decode = partial(_decode_dicom, roi=roi)
+    sampled = list(profiled_map(decode, filenames[::step], workers, backend, "sample", file_read))
+    return intensity_range(None, window, percentiles, sample_values(sampled))
 
-    return [np.array(slice_) for slice_ in slices]
 
+def dicom_loader(path, resize=None, interpolation=Image.BICUBIC, workers=None, backend="thread", stream=False,
+                 window=None, percentiles=None, series=None, z_range=None, z_stride=None, roi=None):
+    """
+    Load the slices of a dicom series.
 
-def raw_loader(filename, *, size_of_raw, channels, slices, resize=None, interpolation=Image.BICUBIC):
+    The headers of all the files are scanned first, in parallel and without their pixel data, to pick the slices of
+    one series (the largest one unless series, a SeriesInstanceUID, is given), leave out localizers and sort the
+    slices by their position along the slice normal, or by SliceLocation. Only the pixel data of these slices, or of
+    the sorted slices selected by z_range and z_stride (see slice_selection), is decoded afterwards, and cropped to
+    the region of interest roi (x, y, width, height).
+
+    High bit depth data is mapped to uint8 over its whole range after applying the rescale slope and intercept of
+    the files, unless a window (center, width), e.g. in Hounsfield units, or percentiles (low, high) select the mapped
+    values, see intensity.intensity_range. The slices of a stream are mapped as they are decoded, with statistics
+    estimated from a sample of the slices.
+    """
+    filenames = sorted([os.path.join(path, f) for f in os.listdir(path)])
+    filenames = [f for f in filenames if f.lower().endswith(".dcm")]
+    with stage("scan"):
+        headers = select_dicom_series(profiled_map(read_dicom_header, filenames, workers, backend, "header"), series)
+    if not headers:
+        raise ValueError("no slices found in " + str(path))
+    headers = [headers[i] for i in slice_selection(len(headers), z_range, z_stride)]
+    filenames = [header["filename"] for header in headers]
+    if stream:
+        value_range = None
+        rescaled = any(header["rescale"] != (1, 0) for header in headers)
+        if max(header["bits"] for header in headers) > 8 or rescaled or needs_mapping(np.uint8, window, percentiles):
+            with stage("intensity"):
+                value_range = _dicom_sample_range(filenames, window, percentiles, workers, backend, roi)
+        decode = partial(_decode_dicom, resize=resize, interpolation=interpolation, value_range=value_range, roi=roi)
+        slices = profiled_map(decode, filenames, workers, backend, "decode", file_read)
+        return SliceStream(len(filenames), resized_shape(cropped_shape(headers[0]["shape"], roi), resize), slices)
+    # the stored integer samples are stacked, the rescale of every slice is applied while mapping them to uint8
+    decode = partial(_decode_dicom, resize=resize, interpolation=interpolation, roi=roi, rescale=False)
+    volume = stack_slices(profiled_map(decode, filenames, workers, backend, "decode", file_read), len(filenames), path)
+    with stage("intensity"):
+        return map_intensity(volume, window, percentiles, np.array([header["rescale"] for header in headers],
+                                                                   dtype=np.float32))
+
+
+def raw_dtype(dtype="uint8", endianness=None):
+    """Return the numpy dtype of raw samples, endianness being None (native), "little" or "big"."""
+    dtype = np.dtype(dtype)
+    if endianness is not None:
+        dtype = dtype.newbyteorder({"little": "<", "big": ">"}[endianness])
+    return dtype
+
+
+def _raw_slices(filename, size_of_raw, channels, indices, resize=None, interpolation=Image.BICUBIC, offset=0,
+                dtype=np.uint8, value_range=None, roi=None):
+    """
+    Read the slices of indices of a raw volume one by one and yield them as numpy arrays.
+
+    The file is seeked to every slice, and only the rows of the region of interest roi are read, so the bytes of the
+    other slices and rows are skipped. If value_range is given, the (minimum, maximum) sample values are mapped to
+    [0-255] before resizing.
+    """
+    rows, columns = crop_window(size_of_raw, roi)
+    row_size = size_of_raw[1] * channels
+    slice_bytes = size_of_raw[0] * row_size * dtype.itemsize
     with open(filename, "rb") as f:
-        data_slices = []
-        for _ in range(slices):
-            raw_data = np.fromfile(f, 'uint8', size_of_raw[0] *
-                                   size_of_raw[1] * channels).reshape(*size_of_raw, channels)
+        for index in indices:
+            f.seek(offset + index * slice_bytes + rows.start * row_size * dtype.itemsize)
+            raw_data = np.fromfile(f, dtype, (rows.stop - rows.start) * row_size)
+            raw_data = raw_data.reshape(-1, size_of_raw[1], channels)[:, columns]
             if channels == 1:
                 raw_data = raw_data.squeeze(-1)
-            data_slices.append(Image.fromarray(raw_data))
+            if value_range is not None:
+                raw_data = rescale_to_uint8(raw_data, *value_range)
+            yield resize_array(raw_data, resize, interpolation) if resize else raw_data
+
+
+def raw_mmap(filename, size_of_raw, channels, slices, offset=0, dtype=np.uint8):
+    """
+    Map a raw volume file as a read-only (slices, height, width, channels) array.
 
-        if resize:
-            data_slices = [resize_image(slice_, resize, interpolation) for slice_ in data_slices]
+    Nothing is read until the array is accessed, so the atlas can be tiled straight from the page cache without any
+    intermediate copy of the volume.
+    """
+    return np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=(slices, *size_of_raw, channels))
 
-        return [np.array(slice_) for slice_ in data_slices]
 
+def raw_loader(filename, *, size_of_raw, channels, slices, resize=None, interpolation=Image.BICUBIC, stream=False,
+               mmap=False, offset=0, dtype="uint8", endianness=None, z_range=None, z_stride=None, roi=None):
+    """
+    Load the slices of a raw volume file of (slices, height, width, channels) samples.
 
+    Only the slices selected by z_range and z_stride (see slice_selection) and the rows and columns of the region of
+    interest roi (x, y, width, height) are read. With mmap the selection is a view of the memory map.
+    """
+    if size_of_raw is None:
+        raise TypeError("raw_loader requires size_of_raw")
+    dtype = raw_dtype(dtype, endianness)
+    indices = slice_selection(slices, z_range, z_stride)
+    selection = (slice(indices.start, indices.stop, indices.step),) + crop_window(size_of_raw, roi)
+    if mmap:
+        if resize or stream:
+            raise ValueError("mmap raw loading does not support resize or stream")
+        return raw_mmap(filename, size_of_raw, channels, slices, offset, dtype)[selection]
+    value_range = None
+    if dtype != np.uint8:
+        # high bit depth samples are rescaled to uint8 with the range of the selected samples, found in a first pass
+        # over a memory map of the file
+        value_range = volume_range(raw_mmap(filename, size_of_raw, channels, slices, offset, dtype)[selection])
+    data_slices = profiled_iter(_raw_slices(filename, size_of_raw, channels, indices, resize, interpolation, offset,
+                                            dtype, value_range, roi), "decode")
+    if stream:
+        shape = cropped_shape(tuple(size_of_raw) + ((channels,) if channels > 1 else ()), roi)
+        return SliceStream(len(indices), resized_shape(shape, resize), data_slices)
+    return stack_slices(data_slices, len(indices), filename)
@@ -0,0 +1,203 @@
+import contextlib
+import contextvars
+import json
+import os
+import sys
+import time
+from functools import partial
+
+from atlas_conversion.utils import parallel_map
+
+try:
+    import resource
+except ImportError:  # not available on windows, peak memory is then not reported
+    resource = None
+
+# Profiler recording the stages of the current conversion, set while one of its stages is running
+_active_profiler = contextvars.ContextVar("active_profiler", default=None)
+
+
+def active_profiler():
+    """Return the profiler of the running stage, or None when nothing is profiled."""
+    return _active_profiler.get()
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory of the process, returns False where this is not supported (only linux is)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb(resettable=False):
+    """Return the peak resident memory of the process in megabytes, since the last reset if resettable."""
+    if resettable:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    if resource is None:
+        return None
+    # kilobytes on linux, bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024
+
+
+def io_counters():
+    """Return the (read, written) bytes of all the reads and writes of the process so far, or Nones (linux only)."""
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(":") for line in f)
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _difference(end, start):
+    return None if end is None or start is None else end - start
+
+
+class Profiler:
+    """
+    Per stage profiler of atlas conversions
+
+    Every stage (load, convert, gradient, write and their sub-stages) records its wall time, cpu time of the process,
+    bytes read and written by the process and peak resident memory. Sub-steps run in worker threads or processes, such
+    as the decoding of every slice file, every gradient chunk and the encoding of every output file, record their own
+    wall and cpu time and the size of the file they read or wrote. The byte counts and the peak memory are only
+    available on linux, they are None elsewhere.
+
+    Every record is a dict with the name of the step, its path (the names of the enclosing stages and its own,
+    joined by "/"), the metrics and any extra information of the step.
+
+    Attributes:
+        callback: called with every record as soon as its step finishes
+        records: the finished records, in order of completion
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.records = []
+        self._open = []
+        self._resettable = reset_peak_rss()
+
+    def _update_peaks(self):
+        """Account the peak memory since the last update to every open stage, and start measuring again."""
+        peak = peak_rss_mb(self._resettable)
+        for stage in self._open:
+            stage["peak"] = peak if stage["peak"] is None else max(stage["peak"], peak)
+        if self._resettable:
+            reset_peak_rss()
+
+    def _path(self, name):
+        return "/".join([stage["name"] for stage in self._open] + [name])
+
+    def _add(self, record):
+        self.records.append(record)
+        if self.callback:
+            self.callback(record)
+
+    @contextlib.contextmanager
+    def stage(self, name, **info):
+        """Context manager profiling the code it runs as a stage, which becomes the active profiler meanwhile."""
+        self._update_peaks()
+        path = self._path(name)
+        stage = {"name": name, "peak": None}
+        self._open.append(stage)
+        read, written = io_counters()
+        start, cpu_start = time.perf_counter(), time.process_time()
+        token = _active_profiler.set(self)
+        try:
+            yield
+        finally:
+            _active_profiler.reset(token)
+            wall, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+            end_read, end_written = io_counters()
+            self._update_peaks()
+            self._open.pop()
+            self._add(dict(name=name, path=path, wall_seconds=wall, cpu_seconds=cpu,
+                           bytes_read=_difference(end_read, read), bytes_written=_difference(end_written, written),
+                           peak_rss_mb=stage["peak"], **info))
+
+    def step(self, name, wall_seconds, cpu_seconds, bytes_read=None, bytes_written=None, **info):
+        """Record a sub-step of the current stage measured elsewhere, e.g. in a worker."""
+        self._add(dict(name=name, path=self._path(name), wall_seconds=wall_seconds, cpu_seconds=cpu_seconds,
+                       bytes_read=bytes_read, bytes_written=bytes_written, peak_rss_mb=None, **info))
+
+    def summary(self):
+        """Return the total wall time, cpu time and bytes of every step path, and the highest peak memory."""
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record["path"], {"count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0,
+                                                       "bytes_read": None, "bytes_written": None,
+                                                       "peak_rss_mb": None})
+            total["count"] += 1
+            for key in ["wall_seconds", "cpu_seconds", "bytes_read", "bytes_written"]:
+                if record[key] is not None:
+                    total[key] = (total[key] or 0) + record[key]
+            if record["peak_rss_mb"] is not None:
+                total["peak_rss_mb"] = max(total["peak_rss_mb"] or 0, record["peak_rss_mb"])
+        return totals
+
+    def write(self, filename):
+        """Write the records and their summary as JSON."""
+        with open(filename, "w") as f:
+            json.dump({"summary": self.summary(), "records": self.records}, f, indent=2, default=str)
+
+
+def stage(name, profiler=None, **info):
+    """Profile a stage with profiler, or with the active profiler if None; does nothing when there is neither."""
+    profiler = profiler or active_profiler()
+    return profiler.stage(name, **info) if profiler is not None else contextlib.nullcontext()
+
+
+def _timed_call(func, item):
+    """Call func(item) and return the result with the wall and cpu time of the call, measured in the worker."""
+    start, cpu_start = time.perf_counter(), time.thread_time()
+    result = func(item)
+    return result, time.perf_counter() - start, time.thread_time() - cpu_start
+
+
+def profiled_map(func, items, workers=None, backend="thread", name="step", describe=None):
+    """
+    Like utils.parallel_map, recording every call as a sub-step of the active profiler.
+
+    Args:
+        describe: optional function of (item, result) returning extra information and byte counts of the record
+    """
+    profiler = active_profiler()
+    if profiler is None:
+        yield from parallel_map(func, items, workers, backend)
+        return
+    items = list(items)
+    for item, (result, wall, cpu) in zip(items, parallel_map(partial(_timed_call, func), items, workers, backend)):
+        profiler.step(name, wall, cpu, **(describe(item, result) if describe else {}))
+        yield result
+
+
+def profiled_iter(iterable, name="step", **info):
+    """Iterate over iterable, recording the time taken to produce every item as a sub-step of the active profiler."""
+    profiler = active_profiler()
+    iterator = iter(iterable)
+    for index in range(sys.maxsize):
+        start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        if profiler is not None:
+            profiler.step(name, time.perf_counter() - start, time.process_time() - cpu_start, index=index, **info)
+        yield item
+
+
+def file_read(filename, result=None):
+    """describe function of profiled_map for steps reading filename."""
+    return {"file": filename, "bytes_read": os.path.getsize(filename)}
+
+
+def files_written(job, filenames):
+    """describe function of profiled_map for steps writing filenames."""
+    return {"file": filenames[0], "bytes_written": sum(os.path.getsize(filename) for filename in filenames)}
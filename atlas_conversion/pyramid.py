@@ -0,0 +1,69 @@
+from functools import partial
+
+import numpy as np
+from PIL import Image
+
+from atlas_conversion.utils import parallel_map
+
+# Sizes of the scaled outputs written when no other levels are requested
+DEFAULT_LEVELS = [8192, 4096, 2048, 1024, 512]
+
+# Resampling filters by name, "box" averages blocks with numpy when the scale factor is an integer
+RESAMPLING = {
+    "box": Image.BOX,
+    "nearest": Image.NEAREST,
+    "bilinear": Image.BILINEAR,
+    "bicubic": Image.BICUBIC,
+    "lanczos": Image.LANCZOS,
+}
+
+
+def pyramid_levels(full_size, levels=None):
+    """Return the requested level sizes that are smaller than the full atlas, largest first."""
+    return sorted([x for x in (levels or DEFAULT_LEVELS) if x < full_size], reverse=True)
+
+
+def level_shape(shape, dimension, full_size):
+    """Return the (height, width) of an image of shape at the level dimension of an atlas of longest side full_size."""
+    return tuple(max(1, int(round(size * dimension / full_size))) for size in shape[:2])
+
+
+def downsample(image, shape, resample="bicubic"):
+    """
+    Resize an (H, W, C) uint8 image to shape (height, width).
+
+    The channels of an RGBA image are resized independently: PIL would weight the colors by the alpha channel, which
+    holds data and not an opacity in the packed atlases.
+    """
+    height, width = image.shape[:2]
+    if resample == "box" and height % shape[0] == 0 and width % shape[1] == 0:
+        # average every block of pixels at once, rounding like PIL does
+        blocks = image.reshape(shape[0], height // shape[0], shape[1], width // shape[1], *image.shape[2:])
+        return (blocks.mean(axis=(1, 3), dtype=np.float32) + 0.5).astype(np.uint8)
+    if image.ndim == 3 and image.shape[2] == 4:
+        return np.dstack([downsample(image[..., :3], shape, resample), downsample(image[..., 3], shape, resample)])
+    return np.asarray(Image.fromarray(image).resize((shape[1], shape[0]), RESAMPLING[resample]))
+
+
+def build_pyramid(image, levels, resample="bicubic", full_size=None):
+    """
+    Return the downsampled images for every size in levels, each computed from the previous (larger) level.
+
+    A level size is the longest side of the level, keeping the aspect ratio of the image. With full_size, the image
+    is scaled as a part of an atlas whose longest side is full_size instead, e.g. so that the last, shorter page of a
+    multi-page atlas gets the same scale as the other pages.
+    """
+    if resample not in RESAMPLING:
+        raise ValueError("Unknown resampling filter: " + str(resample))
+    full_shape, full_size = image.shape[:2], full_size or max(image.shape[:2])
+    pyramid = []
+    for dimension in levels:
+        image = downsample(image, level_shape(full_shape, dimension, full_size), resample)
+        pyramid.append(image)
+    return pyramid
+
+
+def build_pyramids(images, levels, resample="bicubic", workers=None, full_size=None):
+    """Build the pyramids of several images (e.g. the color and gradient atlases) concurrently in threads."""
+    return list(parallel_map(partial(build_pyramid, levels=levels, resample=resample, full_size=full_size), images,
+                             workers, "thread"))
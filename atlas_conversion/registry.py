@@ -0,0 +1,64 @@
+import importlib
+
+# Entry point group of the loaders of the input formats added by other packages, e.g. in their setup.py:
+#   entry_points={"atlas_conversion.loaders": ["tiff = my_package.tiff:tiff_loader"]}
+ENTRY_POINT_GROUP = "atlas_conversion.loaders"
+
+# Loaders of the input formats, by name. The built in loaders are given as "module:function" references, so the
+# libraries of a format (pydicom, nrrd) are only imported when it is used.
+LOADERS = {
+    "png": "atlas_conversion.loaders:png_loader",
+    "dicom": "atlas_conversion.loaders:dicom_loader",
+    "nrrd": "atlas_conversion.loaders:nrrd_loader",
+    "raw": "atlas_conversion.loaders:raw_loader",
+}
+
+_plugins = None
+
+
+def _plugin_entry_points():
+    """Return the entry points of the loaders registered by the installed packages, by name."""
+    global _plugins
+    if _plugins is None:
+        from importlib.metadata import entry_points
+
+        found = entry_points()
+        found = found.select(group=ENTRY_POINT_GROUP) if hasattr(found, "select") else found.get(ENTRY_POINT_GROUP, [])
+        _plugins = {entry_point.name: entry_point for entry_point in found}
+    return _plugins
+
+
+def register_loader(name, loader):
+    """
+    Register the loader of an input format, replacing any loader of the same name.
+
+    A loader is called as loader(path, resize=None, stream=False) and returns a (Z, H, W[, C]) volume, or a
+    loaders.SliceStream of its slices when stream is True. It is also given the z_range, z_stride and roi options
+    when they are set, see loaders.slice_selection and loaders.crop_window. It is given either as a function or as a
+    "module:function" reference, imported when the format is first used.
+    """
+    LOADERS[name] = loader
+
+
+def loader_names():
+    """Return the names of the input formats: the built in ones, then those registered by installed packages."""
+    return list(LOADERS) + sorted(name for name in _plugin_entry_points() if name not in LOADERS)
+
+
+def get_loader(name):
+    """
+    Return the loader of an input format, importing its module on first use.
+
+    Raises:
+        ValueError: if no loader is registered under name
+    """
+    loader = LOADERS.get(name)
+    if loader is None:
+        if name not in _plugin_entry_points():
+            raise ValueError("Unknown input format: " + str(name))
+        loader = _plugin_entry_points()[name].load()
+    elif isinstance(loader, str):
+        module, _, function = loader.partition(":")
+        loader = getattr(importlib.import_module(module), function)
+    LOADERS[name] = loader
+    return loader
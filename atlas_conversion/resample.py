@@ -0,0 +1,123 @@
+import math
+
+import numpy as np
+
+from atlas_conversion.tiling import plan_layout
+from atlas_conversion.utils import parallel_map
+
+# Resampling methods of resample_volume
+RESAMPLING_METHODS = ["area", "nearest"]
+
+# Number of output slices computed by one parallel task
+CHUNK_SLICES = 8
+
+
+def area_weights(in_size, out_size):
+    """
+    Return the (out_size, in_size) float32 matrix of a box filter downsampling in_size samples to out_size.
+
+    Every output sample is the average of the input samples it covers, weighted by how much of each is covered, so
+    the factor does not need to be an integer.
+    """
+    scale = in_size / out_size
+    edges = np.arange(out_size + 1) * scale
+    samples = np.arange(in_size)
+    overlap = np.minimum(edges[1:, np.newaxis], samples + 1) - np.maximum(edges[:-1, np.newaxis], samples)
+    return (overlap.clip(0, None) / scale).astype(np.float32)
+
+
+def nearest_indices(in_size, out_size):
+    """Return the input sample nearest to the center of every output sample."""
+    return np.minimum(((np.arange(out_size) + 0.5) * (in_size / out_size)).astype(np.intp), in_size - 1)
+
+
+def budget_shape(shape, max_voxels=None, max_atlas_size=None):
+    """
+    Return the largest (Z, H, W) shape, scaled uniformly from shape, that fits the budgets.
+
+    Args:
+        shape: (Z, H, W) shape of the volume
+        max_voxels: maximum number of voxels of the volume
+        max_atlas_size: maximum width and height in pixels of the atlas tiling the volume, see tiling.plan_layout
+    """
+    def fits(candidate):
+        if max_voxels is not None and math.prod(candidate) > max_voxels:
+            return False
+        return max_atlas_size is None or max(plan_layout(candidate[0], candidate[1:]).shape) <= max_atlas_size
+
+    def scaled(factor):
+        return tuple(max(1, int(size * factor)) for size in shape)
+
+    if fits(tuple(shape)):
+        return tuple(shape)
+    low, high = 0.0, 1.0
+    for _ in range(50):
+        factor = (low + high) / 2
+        low, high = (factor, high) if fits(scaled(factor)) else (low, factor)
+    return scaled(low)
+
+
+def _cast(block, dtype):
+    """Convert a float32 block back to dtype, rounding and clipping integer types."""
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        block = np.rint(block).clip(info.min, info.max)
+    return block.astype(dtype)
+
+
+def _area_chunk(volume, out, start, end, weights):
+    """Compute the output slices start to end of an area resampling."""
+    z_weights, y_weights, x_weights = weights
+    # input slices covered by the chunk
+    columns = np.flatnonzero(z_weights[start:end].any(axis=0))
+    first, last = columns[0], columns[-1] + 1
+    slab = np.asarray(volume[first:last], dtype=np.float32)
+    channels = slab.shape[3:]
+    if channels:
+        # (z, H, W, C) -> (C, z, H, W), every channel is filtered like a single channel volume
+        slab = np.moveaxis(slab, 3, 0)
+    slab = np.matmul(np.matmul(y_weights, slab), x_weights.T)
+    slab = np.tensordot(z_weights[start:end, first:last], slab, axes=([1], [slab.ndim - 3]))
+    if channels:
+        slab = np.moveaxis(slab, 1, 3)
+    out[start:end] = _cast(slab, out.dtype)
+
+
+def _nearest_chunk(volume, out, start, end, indices):
+    z_indices, y_indices, x_indices = indices
+    out[start:end] = np.asarray(volume[z_indices[start:end]])[:, y_indices][:, :, x_indices]
+
+
+def resample_volume(volume, shape, method="area", workers=None):
+    """
+    Downsample a (Z, H, W[, C]) volume to shape (Z', H', W') along all three axes in one pass.
+
+    The separable filters are applied to chunks of CHUNK_SLICES output slices, each reading only the input slices it
+    covers, so a memory mapped volume is read once and never fully loaded. The chunks run in parallel threads.
+
+    Args:
+        volume: volume array, e.g. a loaded volume or a read-only memory map
+        shape: (Z', H', W') target shape, not larger than the volume along any axis
+        method: "area" (box filter averaging all covered voxels) or "nearest" (keep the nearest voxel)
+        workers: number of parallel threads
+
+    Returns:
+        the resampled contiguous volume, with the dtype and channels of volume
+    """
+    if method not in RESAMPLING_METHODS:
+        raise ValueError("Unknown resampling method: " + str(method))
+    shape = tuple(shape)
+    if any(size > in_size for size, in_size in zip(shape, volume.shape)):
+        raise ValueError("Cannot resample a volume of shape {} up to {}".format(volume.shape[:3], shape))
+    out = np.empty(shape + volume.shape[3:], dtype=volume.dtype)
+    if method == "area":
+        factors = [area_weights(in_size, size) for in_size, size in zip(volume.shape, shape)]
+        compute = _area_chunk
+    else:
+        factors = [nearest_indices(in_size, size) for in_size, size in zip(volume.shape, shape)]
+        compute = _nearest_chunk
+    chunks = range(0, shape[0], CHUNK_SLICES)
+    for _ in parallel_map(lambda start: compute(volume, out, start, min(start + CHUNK_SLICES, shape[0]), factors),
+                          chunks, workers, "thread"):
+        pass
+    return out
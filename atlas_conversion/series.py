@@ -0,0 +1,86 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from atlas_conversion.formats import write_metadata
+from atlas_conversion.utils import worker_context
+
+
+def frame_paths(path):
+    """Return the inputs of the frames of a time series folder: its files or folders, sorted by name."""
+    return [os.path.join(path, name) for name in sorted(os.listdir(path)) if not name.startswith(".")]
+
+
+def frame_output(output_filename, frame):
+    """Return the base name of the outputs of a frame of a time series."""
+    return "{}_frame{}".format(output_filename, frame)
+
+
+def frame_arguments(arguments, path, frame):
+    """Return the command line arguments converting one frame of a time series."""
+    profile = None
+    if arguments.profile:
+        name, extension = os.path.splitext(arguments.profile)
+        profile = "{}_frame{}{}".format(name, frame, extension)
+    return argparse.Namespace(**dict(vars(arguments), input=path, output=frame_output(arguments.output, frame),
+                                     profile=profile, frames=False))
+
+
+def plan_series(arguments, path):
+    """
+    Return the layout of the frames of a time series, planned from the slices of its first frame.
+
+    The first frame is loaded as a stream, which reads the headers of its files without decoding its slices, and its
+    shape is reduced to the budgets of the command line like Atlas.resample reduces it, see resample.budget_shape.
+    """
+    from atlas_conversion.loaders import SliceStream
+    from atlas_conversion.registry import get_loader
+    from atlas_conversion.resample import budget_shape
+    from atlas_conversion.tiling import plan_layout
+
+    loader_options = dict(arguments.loader_options)
+    if not loader_options.get("mmap"):
+        # memory maps are not decoded either, and cannot be streamed
+        loader_options["stream"] = True
+    slices = get_loader(arguments.format)(path, **loader_options)
+    num_slices = len(slices)
+    slice_shape = tuple(slices.shape if isinstance(slices, SliceStream) else slices[0].shape)
+    if arguments.max_voxels or arguments.max_atlas_size:
+        shape = budget_shape((num_slices,) + slice_shape[:2], arguments.max_voxels, arguments.max_atlas_size)
+        num_slices, slice_shape = shape[0], shape[1:] + slice_shape[2:]
+    return plan_layout(num_slices, slice_shape, arguments.max_texture_size)
+
+
+def _run_frame(arguments, layout, callback=None):
+    from atlas_conversion.__main__ import run
+
+    return run(arguments, callback, layout)
+
+
+def run_series(arguments, callback=None):
+    """
+    Convert the frames of a time series, volumes of the same geometry, with the layout of the first frame.
+
+    Every frame is written as a separate conversion named by frame_output, with its own metadata, and the frames are
+    listed in <output>_series.json. The frames are converted in arguments.frame_workers processes, or one after the
+    other in this process, which then reports the progress of every frame to callback.
+    """
+    paths = frame_paths(arguments.input)
+    if not paths:
+        raise ValueError("No frames found in " + str(arguments.input))
+    print("Planning the layout of the frames...")
+    layout = plan_series(arguments, paths[0])
+    frames = [frame_arguments(arguments, path, frame) for frame, path in enumerate(paths)]
+    workers = min(arguments.frame_workers or os.cpu_count(), len(frames))
+    if workers <= 1:
+        for frame in frames:
+            _run_frame(frame, layout, callback)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=worker_context()) as executor:
+            list(executor.map(partial(_run_frame, layout=layout), frames))
+    write_metadata(arguments.output + "_series.json", dict(
+        layout.describe(),
+        frames=[{"input": path, "metadata": os.path.basename(frame.output) + "_atlas.json"}
+                for path, frame in zip(paths, frames)]))
+    return 0
@@ -0,0 +1,366 @@
+import argparse
+import asyncio
+import contextlib
+import importlib
+import io
+import itertools
+import json
+import os
+import signal
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from atlas_conversion.batch import job_arguments, run_job
+from atlas_conversion.utils import worker_context
+
+# Modules imported by every worker process as soon as it starts, so that no job pays for these imports
+WARM_MODULES = ["numpy", "scipy.ndimage", "dask.array", "PIL.Image", "pydicom", "nrrd", "atlas_conversion.__main__"]
+
+# Reason phrases of the HTTP status codes of the service
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 503: "Service Unavailable"}
+
+# Queue of the progress events of the current worker process, set when the worker starts
+_progress_queue = None
+
+
+def _init_worker(progress_queue, modules):
+    global _progress_queue
+    _progress_queue = progress_queue
+    for module in modules:
+        importlib.import_module(module)
+
+
+def _warm_up():
+    return os.getpid()
+
+
+def _send_progress(job_id, event):
+    _progress_queue.put((job_id, event))
+
+
+def run_service_job(job_id, job, default_memory_limit=None, runner=run_job):
+    """Run a job in a worker process, sending its progress events and then an end marker (None) to the service."""
+    try:
+        return runner(job, default_memory_limit, partial(_send_progress, job_id))
+    finally:
+        _send_progress(job_id, None)
+
+
+class ServiceBusy(Exception):
+    """Raised when a job is submitted while the service already has as many pending jobs as it accepts."""
+
+
+def check_job(job):
+    """
+    Check that a job has an input and an output and valid command line options, without running it.
+
+    Returns:
+        the error message, or None if the job is valid
+    """
+    from atlas_conversion.__main__ import check_and_parse_args, create_parser
+
+    if not isinstance(job, dict) or "input" not in job or "output" not in job:
+        return "a job is a json object with an input and an output"
+    errors = io.StringIO()
+    try:
+        with contextlib.redirect_stderr(errors):
+            check_and_parse_args(create_parser(), job_arguments(job))
+    except SystemExit:
+        return errors.getvalue().strip().splitlines()[-1] if errors.getvalue().strip() else "invalid options"
+    return None
+
+
+class ConversionService:
+    """
+    Conversion jobs run by a pool of warm worker processes
+
+    The worker processes are spawned when the service starts and import the modules of the conversions (WARM_MODULES)
+    straight away, so a job only pays for its own work. At most workers jobs run at the same time, the next ones wait
+    for a free worker, and jobs beyond max_pending running and waiting jobs are rejected with ServiceBusy until some
+    finish. The progress of every job (the lines it prints and the profiling record of every stage and step) is sent
+    back to the submitter while it runs.
+
+    A worker process that dies breaks the pool: the jobs that were running in it are reported as failed and a fresh
+    pool is started for the next jobs.
+
+    Attributes:
+        workers: number of worker processes, defaults to the number of cores
+        max_pending: maximum number of running and waiting jobs, defaults to twice the number of workers
+        default_memory_limit: memory limit in megabytes of the jobs that do not set their own
+        runner: module level function running one job in a worker, batch.run_job by default
+    """
+
+    def __init__(self, workers=None, max_pending=None, default_memory_limit=None, runner=run_job):
+        self.workers = workers or os.cpu_count()
+        self.max_pending = max(max_pending or 2 * self.workers, 1)
+        self.default_memory_limit = default_memory_limit
+        self.runner = runner
+        self.context = worker_context()
+        self.progress_queue = self.context.SimpleQueue()
+        self.executor = None
+        self.loop = None
+        self.slots = None
+        self.reader = None
+        self.listeners = {}
+        self.job_ids = itertools.count(1)
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+
+    async def start(self):
+        """Spawn the worker processes and wait until they have imported the conversion modules."""
+        self.loop = asyncio.get_running_loop()
+        self.slots = asyncio.Semaphore(self.workers)
+        self.reader = threading.Thread(target=self._read_progress, daemon=True)
+        self.reader.start()
+        await asyncio.gather(*self._start_pool())
+
+    def _start_pool(self):
+        """Start a pool of worker processes and return the futures of its warm up tasks."""
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=self.context, initializer=_init_worker,
+                                            initargs=(self.progress_queue, WARM_MODULES))
+        # every submitted task spawns a worker process until the pool is full
+        return [self.loop.run_in_executor(self.executor, _warm_up) for _ in range(self.workers)]
+
+    def stop(self):
+        """Stop the worker processes, after the running jobs, and the progress reader."""
+        if self.executor is not None:
+            self.executor.shutdown()
+        if self.reader is not None:
+            self.progress_queue.put(None)
+            self.reader.join()
+
+    def status(self):
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+    def _read_progress(self):
+        """Hand the progress events sent by the workers over to the event loop, until a None item."""
+        while True:
+            item = self.progress_queue.get()
+            if item is None:
+                return
+            self.loop.call_soon_threadsafe(self._deliver, *item)
+
+    def _deliver(self, job_id, event):
+        events = self.listeners.get(job_id)
+        if events is not None:
+            events.put_nowait(event if event is None else dict(event, job=job_id))
+
+    async def submit(self, job, send):
+        """
+        Run a job once a worker is free, and return its report (see batch.run_job).
+
+        send is awaited with every event of the job: "queued" when it is accepted, "started" when a worker takes it,
+        the "log" and "stage" progress events of the conversion and "done" with the report.
+
+        Raises:
+            ServiceBusy: if max_pending jobs are already running or waiting, before any event is sent
+        """
+        if self.pending >= self.max_pending:
+            raise ServiceBusy("{} jobs are already pending".format(self.pending))
+        job_id = next(self.job_ids)
+        self.pending += 1
+        events = self.listeners[job_id] = asyncio.Queue()
+        try:
+            await send({"event": "queued", "job": job_id, "waiting": self.pending - 1 - self.running})
+            async with self.slots:
+                self.running += 1
+                try:
+                    await send({"event": "started", "job": job_id})
+                    report = await self._run(job_id, job, events, send)
+                finally:
+                    self.running -= 1
+            if report["status"] == "ok":
+                self.completed += 1
+            else:
+                self.failed += 1
+            await send({"event": "done", "job": job_id, "report": report})
+            return report
+        finally:
+            self.pending -= 1
+            del self.listeners[job_id]
+
+    async def _run(self, job_id, job, events, send):
+        """Run a job in the pool and send its progress events until its end marker, or until its worker dies."""
+        executor = self.executor
+        future = self.loop.run_in_executor(executor, run_service_job, job_id, job, self.default_memory_limit,
+                                           self.runner)
+        getter = None
+        try:
+            while True:
+                getter = getter or asyncio.ensure_future(events.get())
+                await asyncio.wait({getter} if future.done() else {getter, future},
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if future.done() and future.exception() is not None:
+                    return await future
+                if getter.done():
+                    event, getter = getter.result(), None
+                    if event is None:
+                        return await future
+                    await send(event)
+        except BrokenProcessPool:
+            if self.executor is executor:
+                executor.shutdown(wait=False)
+                self._start_pool()
+            return {"input": job["input"], "output": job["output"], "status": "failed",
+                    "error": "the worker process running the job died", "seconds": None, "cpu_seconds": None,
+                    "log": ""}
+        finally:
+            if getter is not None:
+                getter.cancel()
+
+
+def _http_response(status, headers=()):
+    lines = ["HTTP/1.1 {} {}".format(status, REASONS[status]), "Connection: close"] + list(headers)
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def _json_response(status, content, headers=()):
+    body = json.dumps(content).encode()
+    return _http_response(status, ["Content-Type: application/json", "Content-Length: {}".format(len(body))]
+                          + list(headers)) + body
+
+
+async def _read_request(reader):
+    """Read an HTTP request and return its method, path and body."""
+    method, path, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path.split("?")[0], body
+
+
+async def handle_connection(service, reader, writer):
+    """
+    Serve one HTTP request of the conversion service.
+
+    GET /status returns the numbers of workers and of running, pending, completed and failed jobs. POST /jobs takes
+    a job as a json object with the keys of a batch manifest job (input, output and optionally format, options and
+    memory_limit), and streams its events back as newline delimited json until the "done" event with the report. A
+    job is rejected with 503 and a Retry-After header when the service already has its maximum of pending jobs.
+    """
+    try:
+        try:
+            method, path, body = await _read_request(reader)
+        except (ValueError, asyncio.IncompleteReadError):
+            writer.write(_json_response(400, {"error": "malformed request"}))
+            return
+        if path == "/status":
+            writer.write(_json_response(200, service.status()) if method == "GET" else
+                         _json_response(405, {"error": "use GET"}))
+        elif path == "/jobs":
+            if method != "POST":
+                writer.write(_json_response(405, {"error": "use POST"}))
+                return
+            await _submit(service, body, writer)
+        else:
+            writer.write(_json_response(404, {"error": "unknown path " + path}))
+    finally:
+        with contextlib.suppress(ConnectionError):
+            await writer.drain()
+        writer.close()
+
+
+async def _submit(service, body, writer):
+    try:
+        job = json.loads(body)
+    except ValueError:
+        writer.write(_json_response(400, {"error": "the job is not valid json"}))
+        return
+    error = check_job(job)
+    if error:
+        writer.write(_json_response(400, {"error": error}))
+        return
+    started = False
+
+    async def send(event):
+        nonlocal started
+        if not started:
+            writer.write(_http_response(200, ["Content-Type: application/x-ndjson", "Transfer-Encoding: chunked"]))
+            started = True
+        data = (json.dumps(event, default=str) + "\n").encode()
+        writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+        # a client that went away does not stop its job
+        with contextlib.suppress(ConnectionError):
+            await writer.drain()
+
+    try:
+        await service.submit(job, send)
+    except ServiceBusy as e:
+        writer.write(_json_response(503, {"error": str(e)}, ["Retry-After: 1"]))
+        return
+    writer.write(b"0\r\n\r\n")
+
+
+async def serve(service, host="127.0.0.1", port=8765, socket_path=None):
+    """Run the conversion service on a local TCP port, or on a unix socket, until SIGINT or SIGTERM."""
+    await service.start()
+    handler = partial(handle_connection, service)
+    if socket_path:
+        server = await asyncio.start_unix_server(handler, socket_path)
+        address = socket_path
+    else:
+        server = await asyncio.start_server(handler, host, port)
+        address = "http://{}:{}".format(host, server.sockets[0].getsockname()[1])
+    stop = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):  # not available on windows
+            asyncio.get_running_loop().add_signal_handler(signal_number, stop.set)
+    print("Serving on {} with {} warm workers".format(address, service.workers), flush=True)
+    try:
+        async with server:
+            await stop.wait()
+    finally:
+        service.stop()
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog='atlas_conversion serve',
+                                     description='''
+Run a conversion service with a pool of warm worker processes, which have
+already imported the conversion modules when a job arrives. Jobs are posted as
+json to /jobs, with the keys of a batch manifest job, e.g.
+  {"input": "slices", "output": "out/atlas", "options": "--gradient"}
+and their progress is streamed back as newline delimited json events, ending
+with a "done" event holding the report of the job. GET /status describes the
+load of the service.''',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--host', type=str, default="127.0.0.1", help='Address to listen on, default is 127.0.0.1.')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on, default is 8765.')
+    parser.add_argument('--socket', type=str, metavar='PATH',
+                        help='Listen on this unix socket instead of a TCP port.')
+    parser.add_argument('--workers', '-w', type=int,
+                        help='Number of worker processes, i.e. of concurrent jobs, default is the number of cores.')
+    parser.add_argument('--max-pending', type=int,
+                        help='Maximum number of running and waiting jobs, further jobs are rejected with 503 until '
+                             'some finish, default is twice the number of workers.')
+    parser.add_argument('--memory-limit', type=float, metavar='MB',
+                        help='Memory limit of every job that does not set its own memory_limit.')
+    return parser
+
+
+def main(argv=None):
+    arguments = create_parser().parse_args(argv)
+    service = ConversionService(arguments.workers, arguments.max_pending, arguments.memory_limit)
+    asyncio.run(serve(service, arguments.host, arguments.port, arguments.socket))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+import math
+
+import numpy as np
+
+
+def grid_size(num_slices):
+    """Return the number of tiles per side of the square grid that holds num_slices slices."""
+    return int(math.ceil(math.sqrt(num_slices)))
+
+
+class Layout:
+    """
+    Placement of the slices of a volume in the tiles of one or several atlas pages
+
+    The slices fill a grid of columns tiles per row, row after row, and the grid is cut into pages of at most page_rows
+    rows of tiles. The pages are held one below the other in a single atlas array, so every page is a contiguous band
+    of its rows and the tiling functions place the slices of all the pages as in one grid. Only the last row of tiles
+    has empty tiles, and the last page only has the rows it needs.
+
+    Attributes:
+        num_slices: number of slices of the volume
+        slice_shape: (height, width) of a slice
+        columns: number of tiles per row
+        rows: number of rows of tiles of all the pages
+        page_rows: maximum number of rows of tiles of a page
+    """
+
+    def __init__(self, num_slices, slice_shape, columns, page_rows=None):
+        self.num_slices = num_slices
+        self.slice_shape = tuple(slice_shape[:2])
+        self.columns = columns
+        self.rows = -(-num_slices // columns)
+        self.page_rows = min(page_rows or self.rows, self.rows)
+
+    @property
+    def pages(self):
+        """Number of atlas pages."""
+        return -(-self.rows // self.page_rows)
+
+    @property
+    def shape(self):
+        """(height, width) in pixels of the atlas array holding all the pages."""
+        return self.rows * self.slice_shape[0], self.columns * self.slice_shape[1]
+
+    def page_rows_range(self, page):
+        """Return the first and last + 1 rows of tiles of a page."""
+        return page * self.page_rows, min((page + 1) * self.page_rows, self.rows)
+
+    def split(self, atlas):
+        """Return the views of the pages of an atlas array of this layout."""
+        height = self.slice_shape[0]
+        return [atlas[first * height:last * height] for first, last in map(self.page_rows_range, range(self.pages))]
+
+    def describe(self):
+        """Describe the layout for the metadata file."""
+        pages = []
+        for page in range(self.pages):
+            first, last = self.page_rows_range(page)
+            first_slice = first * self.columns
+            pages.append({
+                "first_slice": first_slice,
+                "slices": min(last * self.columns, self.num_slices) - first_slice,
+                "rows": last - first,
+                "width": self.columns * self.slice_shape[1],
+                "height": (last - first) * self.slice_shape[0],
+            })
+        return {
+            "slices": self.num_slices,
+            "grid": {"rows": self.page_rows, "columns": self.columns},
+            "slice": {"width": self.slice_shape[1], "height": self.slice_shape[0]},
+            "pages": pages,
+        }
+
+
+def plan_layout(num_slices, slice_shape, max_size=None):
+    """
+    Choose the grid of an atlas of num_slices slices of slice_shape (height, width).
+
+    Among all the numbers of columns, the grid with the smallest longest side is chosen, then the one with the fewest
+    empty tiles and then the widest one; rows are only added as needed, so unlike a square grid at most one row of
+    tiles is partially empty. When that grid is larger than max_size pixels, the slices are split across pages
+    filled with as many tiles as fit in max_size x max_size pixels.
+
+    Returns:
+        the Layout
+    """
+    height, width = slice_shape[:2]
+    if max_size is not None and (height > max_size or width > max_size):
+        raise ValueError("Slices of {}x{} pixels do not fit in an atlas of {} pixels".format(width, height, max_size))
+    best_score, best_columns = None, 1
+    for columns in range(1, num_slices + 1):
+        rows = -(-num_slices // columns)
+        score = (max(rows * height, columns * width), rows * columns)
+        if best_score is None or score <= best_score:
+            best_score, best_columns = score, columns
+    if max_size is None or best_score[0] <= max_size:
+        return Layout(num_slices, slice_shape, best_columns)
+    return Layout(num_slices, slice_shape, min(num_slices, max_size // width), max_size // height)
+
+
+def tile_origin(index, size, slice_shape):
+    """Return the (row, col) pixel position of the tile holding slice index in a grid of size tiles per row."""
+    return (index // size) * slice_shape[0], (index % size) * slice_shape[1]
+
+
+def tile_view(atlas, index, size, slice_shape):
+    """Return a writable view of the atlas tile holding slice index."""
+    row, col = tile_origin(index, size, slice_shape)
+    return atlas[row:row + slice_shape[0], col:col + slice_shape[1]]
+
+
+def _grid_cells(atlas, slice_shape):
+    """View a (rows * H, columns * W, ...) atlas as a (rows, H, columns, W, ...) array of cells."""
+    rows, columns = atlas.shape[0] // slice_shape[0], atlas.shape[1] // slice_shape[1]
+    return atlas.reshape(rows, slice_shape[0], columns, slice_shape[1], *atlas.shape[2:])
+
+
+def tile_volume(volume, size=None, fill=0, out=None, transform=None):
+    """
+    Tile a (Z, H, W[, C]) volume into a (rows * H, size * W[, C]) atlas of size tiles per row.
+
+    Every full row of tiles is placed with a single reshape, transpose and copy, and the cells after the last slice
+    are set to fill. A single channel volume is broadcast when out has channels, e.g. a grayscale volume into an RGB
+    atlas. If transform is given it is applied to the slices of one row of tiles at a time before they are placed,
+    which keeps the temporary memory of a conversion (e.g. a rescale to uint8) to one row of tiles.
+
+    Args:
+        volume: array of slices, may be a read-only memory map or a non contiguous view
+        size: number of tiles per row, defaults to the smallest square grid holding all slices
+        fill: value of the empty cells after the last slice
+        out: contiguous atlas array to write into, whose height gives the number of rows, allocated as a square grid
+            of size rows when None
+        transform: optional function applied to every (rows, H, W[, C]) block of slices before placement
+
+    Returns:
+        the atlas array
+    """
+    num_slices, slice_shape = volume.shape[0], volume.shape[1:3]
+    size = size or grid_size(num_slices)
+    if out is None:
+        out = np.empty((size * slice_shape[0], size * slice_shape[1]) + volume.shape[3:], dtype=volume.dtype)
+    if volume.ndim == 3 and out.ndim == 3:
+        volume = volume[..., np.newaxis]
+    cells = _grid_cells(out, slice_shape)
+    full_rows, remainder = divmod(num_slices, size)
+
+    # (rows * size, H, W, C) -> (rows, size, H, W, C) -> (rows, H, size, W, C), the layout of the atlas cells
+    row_step = 1 if transform else max(full_rows, 1)
+    for row in range(0, full_rows, row_step):
+        block = volume[row * size:(row + row_step) * size]
+        if transform:
+            block = transform(block)
+        cells[row:row + row_step] = block.reshape(-1, size, *block.shape[1:]).swapaxes(1, 2)
+    if remainder:
+        block = volume[full_rows * size:]
+        if transform:
+            block = transform(block)
+        cells[full_rows, :, :remainder] = block.swapaxes(0, 1)
+        cells[full_rows, :, remainder:] = fill
+    cells[full_rows + (1 if remainder else 0):] = fill
+    return out
+
+
+def untile_atlas(atlas, num_slices, slice_shape):
+    """
+    Inverse of tile_volume: extract the (num_slices, H, W[, C]) volume from an atlas.
+
+    The returned volume is a contiguous copy, so it can be re-tiled or compared with the original slices.
+    """
+    cells = _grid_cells(atlas, slice_shape).swapaxes(1, 2)
+    return np.ascontiguousarray(cells.reshape(-1, *cells.shape[2:])[:num_slices])
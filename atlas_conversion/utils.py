@@ -1,9 +1,11 @@
+import contextlib
+import multiprocessing
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
 import numpy as np
 from PIL import Image
-from dask import delayed
-import dask.array as da
-from scipy import ndimage
 
 
 # Simple decrement function
@@ -11,14 +13,43 @@ def decr(x, y):
     return x - y
 
 
-# Normalize values between [0-1]
+# Normalize values between [0-1], also returns the normalized value of zero and the (minimum, maximum) of the block
 def normalize(block):
+    from dask import delayed
+
     old_min = delayed(block.min())
     old_max = delayed(block.max())
     r = delayed(decr)(old_max, old_min)
     minimum = old_min.compute()
     t0 = decr(block, minimum)
-    return t0 / r.compute(), -minimum / r.compute()
+    return t0 / r.compute(), -minimum / r.compute(), (minimum, old_max.compute())
+
+
+# Minimum and maximum of a volume, computed in a single pass over chunks of slices
+def volume_range(volume, chunk_size=16):
+    minimum, maximum = None, None
+    for start in range(0, len(volume), chunk_size):
+        chunk = np.asarray(volume[start:start + chunk_size])
+        minimum = chunk.min() if minimum is None else min(minimum, chunk.min())
+        maximum = chunk.max() if maximum is None else max(maximum, chunk.max())
+    return minimum, maximum
+
+
+# Linearly map values between minimum and maximum to [0-255], rounded to the nearest integer
+def rescale_to_uint8(block, minimum, maximum):
+    scale = 255.0 / max(float(maximum) - float(minimum), 1e-12)
+    return ((block.astype(np.float32) - minimum) * scale + 0.5).clip(0, 255).astype(np.uint8)
+
+
+# Convert (Z, H, W, 3) RGB uint8 slices to (Z, H, W) luminance with the integer weights of Pillow's convert('L'),
+# a chunk of slices at a time
+def luminance(rgb, chunk_size=16):
+    gray = np.empty(rgb.shape[:-1], dtype=np.uint8)
+    for start in range(0, len(rgb), chunk_size):
+        chunk = np.asarray(rgb[start:start + chunk_size], dtype=np.uint32)
+        gray[start:start + chunk_size] = (chunk[..., 0] * 19595 + chunk[..., 1] * 38470 + chunk[..., 2] * 7471
+                                          + 0x8000) >> 16
+    return gray
 
 
 def normalize_rgb(g_background, gradient_data):
@@ -29,39 +60,216 @@ def normalize_rgb(g_background, gradient_data):
 
 
 def gaussian_filter(block, axis, sigma_value=2):
+    from scipy import ndimage
+
     return ndimage.gaussian_filter1d(block, sigma=sigma_value, axis=axis, order=1)
 
 
-# This function calculates the gradient from a 3-dimensional dask array
-def calculate_gradient(slices):
+# Number of neighbouring voxels read on each side by gaussian_filter (scipy truncates the kernel at 4 sigma)
+def gaussian_radius(sigma):
+    return int(4.0 * sigma + 0.5)
+
+
+# This function builds the (lazy) gradient of a 3-dimensional dask array as a (x, y, z, 3) dask array.
+# The volume is reflected by one voxel at its borders, and every chunk overlaps its neighbours along the filtered axis
+# by the radius of the gaussian kernel, so the result does not depend on the chunking of slices. Chunks thinner than
+# the radius are merged by dask.
+def gradient_graph(slices, sigma=2):
+    import dask.array as da
+
     axes = [1, 0, 2]
-    overlap_depth = {0: 1, 1: 1, 2: 1}
-    overlap_boundary = {0: 'reflect', 1: 'reflect', 2: 'reflect'}
-    g = da.overlap.overlap(slices, depth=overlap_depth, boundary=overlap_boundary)
-    derivatives = [g.map_blocks(gaussian_filter, axis) for axis in axes]
-    derivatives = [da.overlap.trim_overlap(d, depth=overlap_depth,  boundary=overlap_boundary) for d in derivatives]
-    gradient = da.stack(derivatives, axis=3).compute()
-    return normalize(gradient)
+    radius = gaussian_radius(sigma)
+    padded = da.pad(slices, 1, mode='symmetric')
+    # axes not longer than the kernel radius are held in a single chunk, which needs no overlap
+    padded = padded.rechunk({a: -1 for a in range(3) if padded.shape[a] <= radius})
+    derivatives = [da.map_overlap(gaussian_filter, padded, boundary='none', dtype=np.float32, axis=axis,
+                                  depth={a: radius if a == axis and padded.numblocks[a] > 1 else 0 for a in range(3)},
+                                  sigma_value=sigma) for axis in axes]
+    return da.stack(derivatives, axis=3)[1:-1, 1:-1, 1:-1]
+
+
+# Schedulers of the dask gradient: the threads or processes of the local machine, or a local distributed cluster
+DASK_SCHEDULERS = ["threads", "processes", "distributed"]
+
+# Number of z chunks of the gradient per worker, enough for the scheduler to balance the load between workers
+CHUNKS_PER_WORKER = 4
+
+# Bounds of the float32 bytes of an automatic gradient chunk: smaller chunks cost more in scheduling than they compute,
+# larger ones hold too much memory per worker
+MIN_CHUNK_BYTES = 2 ** 22
+MAX_CHUNK_BYTES = 2 ** 27
+
+
+# This function chooses the chunks of a (x, y, z) volume for its dask gradient: whole (x, y) planes, which keeps the
+# halos to the z axis, and a z depth giving every worker CHUNKS_PER_WORKER chunks within the chunk size bounds. A chunk
+# is never thinner than the kernel radius, which dask would undo by merging chunks.
+def gradient_chunks(shape, workers=None, sigma=2):
+    plane_bytes = shape[0] * shape[1] * 4
+    depth = -(-shape[2] // ((workers or os.cpu_count()) * CHUNKS_PER_WORKER))
+    depth = min(max(depth, MIN_CHUNK_BYTES // plane_bytes), max(MAX_CHUNK_BYTES // plane_bytes, 1))
+    return shape[0], shape[1], min(max(depth, gaussian_radius(sigma), 1), shape[2])
+
+
+# This context manager gives the keyword arguments of compute running dask graphs on a scheduler (see DASK_SCHEDULERS,
+# None is dask's default threads) with workers threads or processes. The distributed scheduler starts a local cluster
+# of workers single threaded processes, which sidesteps the GIL held by the filters, until the context exits.
+@contextlib.contextmanager
+def dask_scheduler(scheduler=None, workers=None):
+    if scheduler not in (None, "threads", "processes", "distributed"):
+        raise ValueError("Unknown dask scheduler: " + str(scheduler))
+    if scheduler != "distributed":
+        options = {"scheduler": scheduler} if scheduler else {}
+        yield dict(options, num_workers=workers) if workers else options
+        return
+    try:
+        from dask.distributed import Client, LocalCluster
+    except ImportError:
+        raise ValueError("The distributed scheduler needs the dask.distributed package") from None
+    with LocalCluster(n_workers=workers or os.cpu_count(), threads_per_worker=1, processes=True,
+                      dashboard_address=None) as cluster, Client(cluster, set_as_default=False) as client:
+        yield {"scheduler": client}
+
+
+# This function calculates the gradient from a 3-dimensional dask array, on a dask scheduler with workers workers (see
+# dask_scheduler). The volume is rechunked to chunks, or to the gradient_chunks of its shape. With return_range, the
+# (minimum, maximum) of the gradient before normalization is returned as well.
+def calculate_gradient(slices, sigma=2, scheduler=None, workers=None, chunks=None, return_range=False):
+    slices = slices.rechunk(chunks or gradient_chunks(slices.shape, workers, sigma))
+    with dask_scheduler(scheduler, workers) as options:
+        gradient = gradient_graph(slices, sigma).compute(**options)
+    gradient_data, g_background, value_range = normalize(gradient)
+    return (gradient_data, g_background, value_range) if return_range else (gradient_data, g_background)
+
+
+# This function calculates the gradient of the z slices first to stop of a 3-dimensional dask array, not normalized,
+# equal to those slices of the gradient of the whole volume: only the slices within the kernel radius of the range
+# (and one more, whose reflection pads the cut volume) are read.
+def calculate_gradient_slices(slices, first, stop, sigma=2, scheduler=None, workers=None):
+    margin = gaussian_radius(sigma) + 1
+    start, end = max(first - margin, 0), min(stop + margin, slices.shape[2])
+    gradient = gradient_graph(slices[:, :, start:end], sigma)[:, :, first - start:stop - start]
+    with dask_scheduler(scheduler, workers) as options:
+        return gradient.compute(**options)
+
+
+# Approximate peak memory of computing one z slice of the gradient, relative to the float32 gradient slice itself:
+# the stacked output, the three derivative blocks and the overlapped input block
+GRADIENT_MEMORY_FACTOR = 3
+
+
+# This function splits the z axis of a gradient graph into slabs of whole dask chunks that fit in memory_budget bytes
+def gradient_slabs(gradient, memory_budget):
+    bytes_per_slice = gradient.shape[0] * gradient.shape[1] * gradient.shape[3] * 4 * GRADIENT_MEMORY_FACTOR
+    slabs, start, end = [], 0, 0
+    for depth in gradient.chunks[2]:
+        # a slab always holds at least one chunk, otherwise chunks would be computed several times
+        if end > start and (end + depth - start) * bytes_per_slice > memory_budget:
+            slabs.append((start, end))
+            start = end
+        end += depth
+    slabs.append((start, end))
+    return slabs
+
+
+# This function calculates the gradient from a 3-dimensional dask array without holding it in memory.
+# A first pass over z slabs finds the global minimum and maximum, the returned generator then computes every slab a
+# second time and yields (first z index, uint8 (x, y, z, 3) slab), normalized exactly as calculate_gradient and
+# normalize_rgb do, together with the background value of the normalized gradient. The slabs are computed on a dask
+# scheduler with workers workers, which stays up until the generator is exhausted or closed (see dask_scheduler).
+# With return_range, the (minimum, maximum) of the gradient is returned after the generator.
+def calculate_gradient_out_of_core(slices, memory_budget, sigma=2, scheduler=None, workers=None, chunks=None,
+                                   return_range=False):
+    # chunk z by the budget too, so that a slab holds several chunks computed in parallel rather than a single one.
+    # Chunks are never thinner than the kernel radius, which dask would undo by merging them.
+    slices = slices.rechunk(chunks or gradient_chunks(slices.shape, workers, sigma))
+    bytes_per_slice = slices.shape[0] * slices.shape[1] * 3 * 4 * GRADIENT_MEMORY_FACTOR
+    depth = max(gaussian_radius(sigma), int(memory_budget // bytes_per_slice))
+    if max(slices.chunks[2]) > depth:
+        slices = slices.rechunk({2: depth})
+    gradient = gradient_graph(slices, sigma)
+    slabs = gradient_slabs(gradient, memory_budget)
+    context = contextlib.ExitStack()
+    options = context.enter_context(dask_scheduler(scheduler, workers))
+    minimum, maximum = None, None
+    try:
+        for start, end in slabs:
+            slab = gradient[:, :, start:end].compute(**options)
+            minimum = slab.min() if minimum is None else min(minimum, slab.min())
+            maximum = slab.max() if maximum is None else max(maximum, slab.max())
+    except BaseException:
+        context.close()
+        raise
+    r = decr(maximum, minimum)
+    g_background = int(-minimum / r * 255)
+
+    def quantized_slabs():
+        with context:
+            for start, end in slabs:
+                slab = decr(gradient[:, :, start:end].compute(**options), minimum) / r
+                slab *= 255
+                yield start, slab.astype(np.uint8)
+
+    if return_range:
+        return g_background, quantized_slabs(), (minimum, maximum)
+    return g_background, quantized_slabs()
 
 
 # This functions takes a (tiled) image and writes it to a png file with base filename outputFilename.
-# It also writes several versions in different sizes determined by dimensions
-def write_versions(tile_image, tile_gradient, output_filename, dimensions=None):
+# It also writes several versions in different sizes determined by dimensions, png_options are passed to Image.save
+# (see formats.png_options)
+def write_versions(tile_image, tile_gradient, output_filename, dimensions=None, **png_options):
     if dimensions is None:
         dimensions = [8192, 4096, 2048, 1024, 512]
-    tile_image.save(output_filename + "_full.png", "PNG")
+    tile_image.save(output_filename + "_full.png", "PNG", **png_options)
     if tile_gradient:
-        tile_gradient.save(output_filename + "_gradient_full.png", "PNG")
+        tile_gradient.save(output_filename + "_gradient_full.png", "PNG", **png_options)
     for dimension in [x for x in dimensions if x < tile_image.size[0]]:
         print("Writing image with size: " + str(dimension) + "...")
         im = tile_image.resize((dimension, dimension), Image.BICUBIC)
-        im.save(output_filename + "_" + str(dimension) + ".png")
+        im.save(output_filename + "_" + str(dimension) + ".png", **png_options)
         if tile_gradient:
             im = tile_gradient.resize((dimension, dimension), Image.BICUBIC)
             print("Writing gradient with size: " + str(dimension) + "...")
-            im.save(output_filename + "_" + str(dimension) + "_gradient.png")
+            im.save(output_filename + "_" + str(dimension) + "_gradient.png", **png_options)
 
 
 # This function lists the files within a given directory dir
 def listdir_fullpath(d):
     return [os.path.join(d, f) for f in os.listdir(d)]
+
+
+# Executors usable by parallel_map, selected by name
+EXECUTORS = {"thread": ThreadPoolExecutor, "process": ProcessPoolExecutor}
+
+
+def parallel_map(func, items, workers=None, backend="thread"):
+    """
+    Apply func to every item and yield the results in input order.
+
+    With more than one worker the calls run in a thread or process pool. At most two calls per worker are in flight at
+    any time, so a consumer that drops each result as it goes keeps memory bounded. With the process backend func must
+    be picklable, i.e. a module level function or a functools.partial of one.
+    """
+    if backend not in EXECUTORS:
+        raise ValueError("Unknown parallel backend: " + str(backend))
+    if not workers or workers <= 1:
+        yield from map(func, items)
+        return
+    with EXECUTORS[backend](max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def worker_context():
+    """
+    Return the multiprocessing context of the worker processes running whole conversions (batches, time series and
+    the conversion service).
+
+    The workers are spawned rather than forked, a forked copy of dask's thread pool would hang the gradient computation.
+    """
+    return multiprocessing.get_context("spawn")
@@ -0,0 +1,71 @@
+"""
+Measure how the dask gradient of utils.calculate_gradient scales from 1 to N workers on every dask scheduler.
+
+The time of the distributed scheduler includes starting its local cluster, which is also given on its own.
+
+Run with: python benchmarks/bench_dask_scaling.py --shape 512 512 512 --max-workers 64
+"""
+import argparse
+import importlib.util
+import os
+import time
+
+import dask.array as da
+import numpy as np
+
+from atlas_conversion.utils import calculate_gradient, dask_scheduler, gradient_chunks
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def cluster_startup(workers):
+    """Return the seconds taken to start a local distributed cluster of workers processes."""
+    start = time.perf_counter()
+    with dask_scheduler("distributed", workers):
+        return time.perf_counter() - start
+
+
+def worker_counts(max_workers):
+    """Return 1, 2, 4... up to max_workers, which is always included."""
+    counts = [1]
+    while counts[-1] * 2 < max_workers:
+        counts.append(counts[-1] * 2)
+    return counts + [max_workers] if max_workers > 1 else counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--shape', type=int, nargs=3, default=[256, 256, 256], metavar=('x', 'y', 'z'))
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--schedulers', nargs='+', default=["threads", "processes", "distributed"])
+    parser.add_argument('--chunks', type=int, nargs=3, metavar=('x', 'y', 'z'),
+                        help='dask chunks, default is utils.gradient_chunks for every number of workers')
+    parser.add_argument('--sigma', type=int, default=2)
+    arguments = parser.parse_args()
+
+    volume = np.random.default_rng(0).integers(0, 255, arguments.shape, dtype=np.uint8)
+    data = da.from_array(volume).astype(np.float32)
+    print("volume {}, {} cores".format(volume.shape, os.cpu_count()))
+    calculate_gradient(data, arguments.sigma, "threads", 1)  # warm up the imports and caches
+    for scheduler in arguments.schedulers:
+        if scheduler == "distributed" and importlib.util.find_spec("distributed") is None:
+            print("{}: dask.distributed is not installed".format(scheduler))
+            continue
+        baseline = None
+        for workers in worker_counts(arguments.max_workers):
+            chunks = tuple(arguments.chunks or gradient_chunks(volume.shape, workers, arguments.sigma))
+            elapsed = timed(lambda: calculate_gradient(data, arguments.sigma, scheduler, workers, chunks))
+            baseline = baseline or elapsed
+            line = "{:11s} {:3d} workers, chunks {}: {:.3f} s, speedup {:.2f}x, efficiency {:.0%}".format(
+                scheduler, workers, chunks, elapsed, baseline / elapsed, baseline / elapsed / workers)
+            if scheduler == "distributed":
+                line += ", of which {:.3f} s of cluster start up".format(cluster_startup(workers))
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
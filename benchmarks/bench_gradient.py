@@ -0,0 +1,41 @@
+"""
+Compare the dask gradient of utils.calculate_gradient with the fused gradient engine.
+
+Run with: python benchmarks/bench_gradient.py --shape 512 512 512
+"""
+import argparse
+import time
+
+import dask.array as da
+import numpy as np
+
+from atlas_conversion.gradient import KERNELS, fused_gradient
+from atlas_conversion.utils import calculate_gradient
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--shape', type=int, nargs=3, default=[512, 512, 512], metavar=('x', 'y', 'z'))
+    parser.add_argument('--chunk-depth', type=int, default=64)
+    parser.add_argument('--sigma', type=int, default=2)
+    arguments = parser.parse_args()
+
+    volume = np.random.default_rng(0).integers(0, 255, arguments.shape, dtype=np.uint8)
+    data = da.from_array(volume).rechunk().astype(np.float32)
+    print("volume {}".format(volume.shape))
+    reference = timed(lambda: calculate_gradient(data, arguments.sigma))
+    print("dask gaussian:  {:.3f} s".format(reference))
+    out = np.empty(volume.shape + (3,), dtype=np.float32)
+    for kernel in KERNELS:
+        elapsed = timed(lambda: fused_gradient(volume, kernel, arguments.sigma, arguments.chunk_depth, out))
+        print("fused {:9s} {:.3f} s ({:.2f}x)".format(kernel + ":", elapsed, reference / elapsed))
+
+
+if __name__ == "__main__":
+    main()
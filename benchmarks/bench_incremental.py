@@ -0,0 +1,62 @@
+"""
+Compare converting a volume again in full with an incremental conversion after a few of its slices were edited.
+
+The incremental conversion only tiles the edited slices and only computes the gradient around them, see
+incremental.IncrementalAtlas. Writing the outputs is not timed.
+
+Run with: python benchmarks/bench_incremental.py --shape 256 256 256 --edited 4
+"""
+import argparse
+import os
+import time
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+from atlas_conversion.atlas import Atlas
+from atlas_conversion.cache import Cache
+from atlas_conversion.incremental import IncrementalAtlas
+
+
+def npy_loader(path):
+    return np.load(path, mmap_mode="r")
+
+
+def convert(atlas_obj, path, kernel):
+    """Convert the volume at path with its gradient and return the wall time."""
+    start = time.perf_counter()
+    atlas_obj.load(path)
+    atlas_obj.convert()
+    atlas_obj.gradient_atlas(kernel=kernel)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--shape', type=int, nargs=3, default=[256, 256, 256], metavar=('slices', 'height', 'width'))
+    parser.add_argument('--edited', type=int, default=4, help='number of consecutive slices edited in the middle')
+    parser.add_argument('--kernel', type=str, help='fused gradient kernel, default is the dask gradient')
+    arguments = parser.parse_args()
+
+    z, y, x = np.ogrid[:arguments.shape[0], :arguments.shape[1], :arguments.shape[2]]
+    volume = ((np.sin(z / 9.0) + np.cos(y / 7.0) * np.sin(x / 5.0)) * 60 + 128).astype(np.uint8)
+    with TemporaryDirectory() as tmpdirname:
+        path = os.path.join(tmpdirname, "volume.npy")
+        np.save(path, volume)
+        cache = Cache(os.path.join(tmpdirname, "cache"), max_size=None)
+        print("volume {}, first incremental conversion {:.3f} s".format(
+            volume.shape, convert(IncrementalAtlas(npy_loader, cache), path, arguments.kernel)))
+
+        first = (len(volume) - arguments.edited) // 2
+        # a small correction, which keeps the value range of the whole gradient
+        volume[first:first + arguments.edited] -= 1
+        np.save(path, volume)
+        print("full:        {:.3f} s".format(convert(Atlas(npy_loader), path, arguments.kernel)))
+        atlas_obj = IncrementalAtlas(npy_loader, cache)
+        elapsed = convert(atlas_obj, path, arguments.kernel)
+        print("incremental: {:.3f} s   {} slices tiled, gradient of slices {}".format(
+            elapsed, len(atlas_obj.changed), atlas_obj.recomputed))
+
+
+if __name__ == "__main__":
+    main()
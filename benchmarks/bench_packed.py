@@ -0,0 +1,52 @@
+"""
+Compare writing the atlas and the gradient atlas with writing one packed RGBA atlas of the gradient and the intensity.
+
+Both write the full size atlases and their pyramids from the same gradient, which is computed once and not timed.
+
+Run with: python benchmarks/bench_packed.py --shape 256 256 256
+"""
+import argparse
+import os
+import time
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+from atlas_conversion.atlas import Atlas
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--shape', type=int, nargs=3, default=[256, 256, 256], metavar=('slices', 'height', 'width'))
+    parser.add_argument('--kernel', type=str, default="gaussian")
+    parser.add_argument('--workers', type=int)
+    arguments = parser.parse_args()
+
+    z, y, x = np.ogrid[:arguments.shape[0], :arguments.shape[1], :arguments.shape[2]]
+    volume = ((np.sin(z / 9.0) + np.cos(y / 7.0) * np.sin(x / 5.0)) * 60 + 128).astype(np.uint8)
+    atlas_obj = Atlas(lambda path: volume)
+    atlas_obj.load("")
+    atlas_obj.convert()
+    gradient = atlas_obj.gradient_atlas(kernel=arguments.kernel)
+    # the gradient is computed once, both writes reuse it
+    atlas_obj.gradient_atlas = lambda **options: gradient
+    print("volume {}, atlas {}".format(volume.shape, atlas_obj.layout.shape))
+
+    with TemporaryDirectory() as tmpdirname:
+        for name, options in [("color + gradient", {"gradient": True}), ("packed", {"packed": True})]:
+            output = os.path.join(tmpdirname, name.split()[0])
+            elapsed = timed(lambda: atlas_obj.write(output, scaled_outputs=True, workers=arguments.workers, **options))
+            written = [os.path.join(tmpdirname, f) for f in os.listdir(tmpdirname)
+                       if f.startswith(os.path.basename(output)) and f.endswith(".png")]
+            size = sum(os.path.getsize(f) for f in written)
+            print("{:18} {:.3f} s   {} files   {:.1f} MB".format(name, elapsed, len(written), size / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
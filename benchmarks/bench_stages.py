@@ -0,0 +1,235 @@
+"""
+Time every stage of an atlas conversion (load, convert, compute_gradient, write) on synthetic volumes.
+
+Synthetic png, dicom, nrrd and raw volumes of every requested size are generated (and kept in --data-dir for the next
+runs), and each format and size is converted in a fresh process, so the peak memory of one case does not leak into
+the next. For every stage the wall time, the cpu time and the peak resident memory are recorded.
+
+Run with: python benchmarks/bench_stages.py run --sizes 128 256 512 --output results.json
+Compare:  python benchmarks/bench_stages.py compare baseline.json results.json --threshold 0.1
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import nrrd
+import numpy as np
+from PIL import Image
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from atlas_conversion.atlas import Atlas
+from atlas_conversion.loaders import dicom_loader, nrrd_loader, png_loader, raw_loader
+from atlas_conversion.profiling import peak_rss_mb, reset_peak_rss
+
+FORMATS = ["png", "dicom", "nrrd", "raw"]
+
+STAGES = ["load", "convert", "compute_gradient", "write"]
+
+# Stage metrics compared by the compare command, lower is better for all of them
+METRICS = ["seconds", "cpu_seconds", "peak_rss_mb"]
+
+
+def synthetic_volume(size):
+    """Return a (size, size, size) uint8 volume of nested spheres with some noise, shaped like a scan."""
+    axis = np.linspace(-1, 1, size, dtype=np.float32)
+    z, y, x = np.meshgrid(axis, axis, axis, indexing="ij", sparse=True)
+    radius = np.sqrt(x * x + y * y + z * z)
+    volume = np.where(radius < 0.8, 120, 20) + np.where(radius < 0.4, 100, 0)
+    noise = np.random.default_rng(0).integers(0, 16, volume.shape, dtype=np.uint8)
+    return (volume + noise).astype(np.uint8)
+
+
+def write_dicom_slice(image, location, filename):
+    ds = Dataset()
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.MediaStorageSOPClassUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta = file_meta
+    ds.SOPInstanceUID = generate_uid()
+    ds.SliceLocation = location
+    ds.Rows, ds.Columns = image.shape
+    ds.PixelData = image.tobytes()
+    ds.BitsAllocated = 8
+    ds.BitsStored = 8
+    ds.HighBit = 7
+    ds.PixelRepresentation = 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.save_as(filename, implicit_vr=False, little_endian=True)
+
+
+def generate_input(volume_format, size, data_dir):
+    """Write the synthetic volume of a size in a format into data_dir, unless it is already there, and return its path."""
+    path = os.path.join(data_dir, "{}_{}".format(volume_format, size))
+    if volume_format in ("nrrd", "raw"):
+        path += "." + volume_format
+    if os.path.exists(path):
+        return path
+    volume = synthetic_volume(size)
+    temporary = path + ".partial"
+    if volume_format == "png":
+        os.makedirs(temporary)
+        for i, image in enumerate(volume):
+            Image.fromarray(image).save(os.path.join(temporary, "slice_{:04d}.png".format(i)))
+    elif volume_format == "dicom":
+        os.makedirs(temporary)
+        for i, image in enumerate(volume):
+            write_dicom_slice(image, i, os.path.join(temporary, "slice_{:04d}.dcm".format(i)))
+    elif volume_format == "nrrd":
+        # the nrrd loader slices the volume along its third axis
+        nrrd.write(temporary, volume.transpose(1, 2, 0))
+    else:
+        volume.tofile(temporary)
+    os.rename(temporary, path)
+    return path
+
+
+def loader_of(volume_format, size, workers=None):
+    """Return the loader and loader options converting the synthetic volume of a size in a format."""
+    if volume_format == "raw":
+        return raw_loader, {"size_of_raw": (size, size), "channels": 1, "slices": size}
+    if volume_format == "nrrd":
+        return nrrd_loader, {}
+    options = {"workers": workers} if workers else {}
+    return {"png": png_loader, "dicom": dicom_loader}[volume_format], options
+
+
+def run_case(volume_format, size, path, output_dir, workers=None, gradient_options=None):
+    """Convert one synthetic volume stage by stage and return the metrics of every stage."""
+    loader, loader_options = loader_of(volume_format, size, workers)
+    atlas = Atlas(loader, **loader_options)
+    output = os.path.join(output_dir, "{}_{}".format(volume_format, size))
+    steps = {
+        "load": lambda: atlas.load(path),
+        "convert": atlas.convert,
+        "compute_gradient": lambda: atlas.compute_gradient(**(gradient_options or {})),
+        "write": lambda: atlas.write(output, workers=workers),
+    }
+    stages = {}
+    for stage in STAGES:
+        resettable = reset_peak_rss()
+        start, cpu_start = time.perf_counter(), time.process_time()
+        steps[stage]()
+        stages[stage] = {
+            "seconds": time.perf_counter() - start,
+            "cpu_seconds": time.process_time() - cpu_start,
+            "peak_rss_mb": peak_rss_mb(resettable),
+        }
+    return stages
+
+
+def best_of(runs):
+    """Merge the stage metrics of repeated runs of a case, keeping the lowest value of every metric."""
+    return {stage: {metric: min((run[stage][metric] for run in runs if run[stage][metric] is not None), default=None)
+                    for metric in METRICS} for stage in STAGES}
+
+
+def run(arguments):
+    data_dir = arguments.data_dir or os.path.join(tempfile.gettempdir(), "atlas_conversion_bench")
+    os.makedirs(data_dir, exist_ok=True)
+    gradient_options = {"sigma": arguments.sigma}
+    if arguments.gradient_kernel:
+        gradient_options["kernel"] = arguments.gradient_kernel
+    results = []
+    # every case runs in a fresh process, spawned like the batch workers are
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as output_dir:
+        for size in arguments.sizes:
+            for volume_format in arguments.formats:
+                path = generate_input(volume_format, size, data_dir)
+                runs = []
+                for _ in range(arguments.repeat):
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                        runs.append(executor.submit(run_case, volume_format, size, path, output_dir,
+                                                    arguments.workers, gradient_options).result())
+                stages = best_of(runs)
+                results.append({"format": volume_format, "size": size, "stages": stages})
+                print("{:6s} {:5d}^3  ".format(volume_format, size) + "  ".join(
+                    "{} {:.3f} s".format(stage, stages[stage]["seconds"]) for stage in STAGES), flush=True)
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "options": {"workers": arguments.workers, "repeat": arguments.repeat, "gradient": gradient_options},
+        "results": results,
+    }
+    with open(arguments.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to " + arguments.output)
+    return 0
+
+
+def compare_results(baseline, current, threshold=0.1, min_seconds=0.05):
+    """
+    Compare two result files and return the regressions, as (format, size, stage, metric, baseline, current) tuples.
+
+    A metric regresses when it is more than threshold (relative) above the baseline. Timings of stages faster than
+    min_seconds in both runs are too noisy to compare and are ignored.
+    """
+    baseline_cases = {(case["format"], case["size"]): case["stages"] for case in baseline["results"]}
+    regressions = []
+    for case in current["results"]:
+        baseline_stages = baseline_cases.get((case["format"], case["size"]))
+        if baseline_stages is None:
+            continue
+        for stage, metrics in case["stages"].items():
+            for metric in METRICS:
+                old, new = baseline_stages.get(stage, {}).get(metric), metrics.get(metric)
+                if old is None or new is None:
+                    continue
+                if metric != "peak_rss_mb" and max(old, new) < min_seconds:
+                    continue
+                if new > old * (1 + threshold):
+                    regressions.append((case["format"], case["size"], stage, metric, old, new))
+    return regressions
+
+
+def compare(arguments):
+    with open(arguments.baseline) as f:
+        baseline = json.load(f)
+    with open(arguments.current) as f:
+        current = json.load(f)
+    regressions = compare_results(baseline, current, arguments.threshold, arguments.min_seconds)
+    for volume_format, size, stage, metric, old, new in regressions:
+        print("REGRESSION {:6s} {:5d}^3 {:17s} {:12s} {:10.3f} -> {:10.3f} ({:+.0%})".format(
+            volume_format, size, stage, metric, old, new, new / old - 1))
+    print("{} regressions".format(len(regressions)))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks and write the results as json")
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256], metavar='SIZE',
+                            help='edge lengths of the cubic volumes, e.g. 128 256 512 1024')
+    run_parser.add_argument('--formats', nargs='+', default=FORMATS, choices=FORMATS)
+    run_parser.add_argument('--data-dir', type=str, help='folder of the generated volumes, default is in the temp dir')
+    run_parser.add_argument('--output', '-o', type=str, default="bench_stages.json")
+    run_parser.add_argument('--repeat', type=int, default=1, help='runs of every case, the best one is kept')
+    run_parser.add_argument('--workers', type=int)
+    run_parser.add_argument('--sigma', type=int, default=2)
+    run_parser.add_argument('--gradient-kernel', type=str, choices=["gaussian", "central", "sobel"])
+    run_parser.set_defaults(func=run)
+    compare_parser = commands.add_parser("compare", help="flag the regressions of results against a baseline")
+    compare_parser.add_argument('baseline', type=str)
+    compare_parser.add_argument('current', type=str)
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='relative increase flagged as a regression, default is 0.1 (10%%)')
+    compare_parser.add_argument('--min-seconds', type=float, default=0.05,
+                                help='ignore timings of stages faster than this in both runs, default is 0.05')
+    compare_parser.set_defaults(func=compare)
+    arguments = parser.parse_args()
+    return arguments.func(arguments)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
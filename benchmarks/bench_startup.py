@@ -0,0 +1,65 @@
+"""
+Measure the start up time of the command line, and the slow to import libraries it loads.
+
+Every command runs in a fresh interpreter: "atlas_conversion --help", a png conversion and a png conversion with the
+gradient of the fused engine and of the dask engine. "python -X importtime -m atlas_conversion --help" details the
+import time of every module.
+
+Run with: python benchmarks/bench_startup.py --repeat 5
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+from tempfile import TemporaryDirectory
+
+import numpy as np
+from PIL import Image
+
+HEAVY_MODULES = ["pydicom", "nrrd", "dask", "scipy"]
+
+SCRIPT = '''
+import sys
+from atlas_conversion.__main__ import main
+try:
+    main(sys.argv[1:])
+except SystemExit:
+    pass
+print("imported:" + ",".join(module for module in {} if module in sys.modules))
+'''.format(HEAVY_MODULES)
+
+
+def run_command(argv):
+    """Run the command line in a fresh interpreter and return its wall time and the heavy modules it imported."""
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", SCRIPT, *argv], capture_output=True, text=True, check=True).stdout
+    return time.perf_counter() - start, output.splitlines()[-1][len("imported:"):] or "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--slices', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=5)
+    arguments = parser.parse_args()
+
+    with TemporaryDirectory() as tmpdirname:
+        input_dir = os.path.join(tmpdirname, "slices")
+        os.mkdir(input_dir)
+        for i in range(arguments.slices):
+            Image.fromarray(np.full((16, 16, 3), i, dtype=np.uint8)).save(os.path.join(input_dir, f"{i:04}.png"))
+        output = os.path.join(tmpdirname, "atlas")
+        commands = {
+            "--help": ["--help"],
+            "png": [input_dir, output],
+            "png --gradient (fused)": [input_dir, output, "--gradient", "--gradient-kernel", "gaussian"],
+            "png --gradient (dask)": [input_dir, output, "--gradient"],
+        }
+        run_command(["--help"])  # warm the file system cache
+        for name, argv in commands.items():
+            timings, imported = zip(*(run_command(argv) for _ in range(arguments.repeat)))
+            print("{:24} {:.3f} s   imports {}".format(name, min(timings), imported[0]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Compare the vectorized tiling engine with the per-slice loop Atlas.convert used before.
+
+Run with: python benchmarks/bench_tiling.py --width 512 --height 512 --slices 2048
+"""
+import argparse
+import time
+
+import numpy as np
+
+from atlas_conversion.tiling import grid_size, tile_volume
+
+
+def loop_tile(volume, size):
+    """The per-slice tiling loop of the original Atlas.convert."""
+    row_dim, col_dim = volume.shape[1:3]
+    atlas = np.zeros((size * row_dim, size * col_dim, 3), dtype=np.uint8)
+    for i, image_slice in enumerate(volume):
+        row = (i // size) * row_dim
+        col = (i % size) * col_dim
+        atlas[row:row + row_dim, col:col + col_dim, :] = image_slice
+    return atlas
+
+
+def best_time(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--height', type=int, default=512)
+    parser.add_argument('--slices', type=int, default=2048)
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=3)
+    arguments = parser.parse_args()
+
+    volume = np.random.default_rng(0).integers(0, 255, (arguments.slices, arguments.height, arguments.width,
+                                                        arguments.channels), dtype=np.uint8)
+    size = grid_size(arguments.slices)
+    atlas_shape = (size * arguments.height, size * arguments.width, 3)
+    loop = best_time(lambda: loop_tile(volume, size), arguments.repeat)
+    vectorized = best_time(lambda: tile_volume(volume, size, out=np.zeros(atlas_shape, dtype=np.uint8)),
+                           arguments.repeat)
+    print("volume {} -> atlas {}".format(volume.shape, atlas_shape))
+    print("loop:       {:.3f} s".format(loop))
+    print("vectorized: {:.3f} s ({:.2f}x)".format(vectorized, loop / vectorized))
+
+
+if __name__ == "__main__":
+    main()
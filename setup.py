@@ -9,6 +9,9 @@ setup(
                       'dask',
                       'pillow',
                       'pydicom'],
+    extras_require={
+        'distributed': ['distributed']
+    },
     entry_points={
         'console_scripts': [
             'atlas_conversion = atlas_conversion.__main__:main'
@@ -1,11 +1,18 @@
+import contextlib
+import io
+import json
 import os
 import unittest
+from functools import partial
 from tempfile import TemporaryDirectory
 
 import numpy as np
 from PIL import Image
 
 from atlas_conversion.atlas import Atlas
+from atlas_conversion.formats import read_container
+from atlas_conversion.loaders import SliceStream, png_loader, raw_loader
+from atlas_conversion.tiling import tile_volume
 
 
 def dummy_loader(path=None, size=(128, 128), num_slices=10):
@@ -17,6 +24,11 @@ def dummy_loader(path=None, size=(128, 128), num_slices=10):
     return images
 
 
+def dummy_stream_loader(path=None, size=(128, 128), num_slices=10, stream=True):
+    images = dummy_loader(path, size, num_slices)
+    return SliceStream(num_slices, (*size, 3), iter(images)) if stream else images
+
+
 class TestAtlasClass(unittest.TestCase):
     def test_initialization(self):
         atlas = Atlas(dummy_loader)
@@ -43,19 +55,100 @@ class TestAtlasConversion(unittest.TestCase):
 
     def test_convert(self):
         self.assertIsNotNone(self.atlas_obj.atlas)
-        self.assertEqual(self.atlas_obj.size, 4)
-        self.assertEqual(self.atlas_obj.atlas.shape, (512, 512, 3))
+        # 4 columns like a square grid, but without its empty last row
+        self.assertEqual(self.atlas_obj.layout.columns, 4)
+        self.assertEqual(self.atlas_obj.atlas.shape, (384, 512, 3))
 
         # Check if the images are placed correctly with increasing color values
         for i in range(10):
             increment = int(255 * (i + 1) / 10)
-            row = (i // self.atlas_obj.size) * 128
-            col = (i % self.atlas_obj.size) * 128
+            row = (i // self.atlas_obj.layout.columns) * 128
+            col = (i % self.atlas_obj.layout.columns) * 128
             # Extract the corresponding slice from atlas
             slice_from_atlas = self.atlas_obj.atlas[row:row+128, col:col+128, :]
             # Check if the color is uniform and matches the expected increment
             self.assertTrue(np.all(slice_from_atlas == increment))
 
+    def test_convert_stream(self):
+        streamed = Atlas(dummy_stream_loader)
+        streamed.load("")
+        streamed.convert()
+        self.assertEqual(streamed.layout.columns, self.atlas_obj.layout.columns)
+        self.assertTrue(np.array_equal(streamed.atlas, self.atlas_obj.atlas))
+        self.assertEqual(len(streamed.slices), 10)
+        self.assertTrue(np.array_equal(np.array(streamed.compute_gradient()),
+                                       np.array(self.atlas_obj.compute_gradient())))
+
+    def test_plan_layout(self):
+        atlas_obj = Atlas(dummy_loader)
+        atlas_obj.load("")
+        atlas_obj.plan()
+        layout = atlas_obj.layout
+        other = Atlas(dummy_loader)
+        other.load("")
+        other.convert(layout=layout)
+        self.assertIs(other.layout, layout)
+        smaller = Atlas(dummy_loader, num_slices=9)
+        smaller.load("")
+        with self.assertRaises(ValueError):
+            smaller.plan(layout=layout)
+
+    def test_convert_volume_array(self):
+        volume = np.stack(dummy_loader())[..., :1]
+        from_volume = Atlas(lambda path: volume)
+        from_volume.load("")
+        from_volume.convert()
+        self.assertTrue(np.array_equal(from_volume.atlas, self.atlas_obj.atlas))
+
+    def test_grayscale_volume_gradient(self):
+        volume = np.stack(dummy_loader())[..., 0]
+        grayscale = Atlas(lambda path: volume)
+        grayscale.load("")
+        grayscale.convert()
+        self.assertTrue(np.array_equal(grayscale.atlas, self.atlas_obj.atlas))
+        self.assertIs(grayscale.grayscale_volume(), volume)
+        for kernel in [None, "central"]:
+            self.assertTrue(np.array_equal(grayscale.gradient_atlas(kernel=kernel),
+                                           self.atlas_obj.gradient_atlas(kernel=kernel)))
+
+    def test_convert_rescales_high_bit_depth(self):
+        volume = np.stack(dummy_loader())[..., 0].astype(np.uint16) * 16 + 1000
+        high_bit_depth = Atlas(lambda path: volume)
+        high_bit_depth.load("")
+        high_bit_depth.convert()
+        self.assertEqual(high_bit_depth.atlas.dtype, np.uint8)
+        self.assertTrue(np.all(high_bit_depth.atlas[:128, :128] == 0))
+        self.assertTrue(np.all(high_bit_depth.atlas[256:384, 128:256] == 255))
+
+    def test_convert_raw_high_bit_depth(self):
+        with TemporaryDirectory() as temp_dir:
+            raw_path = os.path.join(temp_dir, "volume.raw")
+            volume = np.full((3, 8, 8), 1000, dtype=np.uint16)
+            volume[0], volume[2] = 0, 3000
+            volume.tofile(raw_path)
+            for stream in [False, True]:
+                atlas_obj = Atlas(raw_loader, size_of_raw=(8, 8), channels=1, slices=3, dtype="uint16", stream=stream)
+                atlas_obj.load(raw_path)
+                atlas_obj.convert()
+                self.assertTrue(np.all(atlas_obj.atlas[:8, 8:16] == 85))
+                self.assertTrue(np.all(atlas_obj.atlas[8:16, :8] == 255))
+
+    def test_convert_png_high_bit_depth_stream(self):
+        with TemporaryDirectory() as temp_dir:
+            volume = np.full((3, 8, 8), 1000, dtype=np.uint16)
+            volume[0], volume[2] = 0, 3000
+            volume[1, 2:5, 3:7] = 1700
+            for i, slice_ in enumerate(volume):
+                Image.fromarray(slice_).save(os.path.join(temp_dir, "{}.png".format(i)))
+            atlases = []
+            for stream in [False, True]:
+                atlas_obj = Atlas(png_loader, stream=stream)
+                atlas_obj.load(temp_dir)
+                atlas_obj.convert()
+                atlases.append(atlas_obj.atlas)
+            self.assertTrue(np.all(atlases[1][:2, 8:16] == 85))
+            self.assertTrue(np.array_equal(atlases[1], atlases[0]))
+
 
 class TestGradientComputation(unittest.TestCase):
 
@@ -70,8 +163,8 @@ class TestGradientComputation(unittest.TestCase):
 
         # Check the gradient image type and shape
         self.assertIsInstance(gradient_image, Image.Image)
-        self.assertEqual(gradient_image.size, (512, 512))
-        self.assertEqual(gradient_data.shape, (512, 512, 3))  # 3 channels (RGB)
+        self.assertEqual(gradient_image.size, (512, 384))
+        self.assertEqual(gradient_data.shape, (384, 512, 3))  # 3 channels (RGB)
 
         for i in range(3):
             for j in range(3):
@@ -85,37 +178,245 @@ class TestGradientComputation(unittest.TestCase):
                     # Check the gradient in the Z-direction is non-zero
                     self.assertTrue(np.all(block[:, :, 2] != 0))
 
+    def test_compute_gradient_out_of_core(self):
+        in_memory = np.array(self.atlas_obj.compute_gradient())
+        out_of_core = np.array(self.atlas_obj.compute_gradient(memory_budget=128 * 128 * 3 * 4))
+        self.assertTrue(np.array_equal(in_memory, out_of_core))
+
+    def test_compute_gradient_dask_options(self):
+        expected = np.array(self.atlas_obj.compute_gradient())
+        for options in [{"scheduler": "threads", "workers": 2, "chunks": (-1, -1, 3)},
+                        {"scheduler": "processes", "workers": 2, "memory_budget": 128 * 128 * 3 * 4 * 3 * 4}]:
+            self.assertTrue(np.array_equal(np.array(self.atlas_obj.compute_gradient(**options)), expected))
+
+    def test_compute_gradient_fused_kernels(self):
+        for kernel in ["gaussian", "central", "sobel"]:
+            gradient_data = np.array(self.atlas_obj.compute_gradient(kernel=kernel))
+            self.assertEqual(gradient_data.shape, (384, 512, 3))
+            # uniform slices only vary along z
+            background = gradient_data[-1, -1]
+            self.assertTrue(np.all(gradient_data[:384, :, :2] == background[:2]))
+            out_of_core = np.array(self.atlas_obj.compute_gradient(memory_budget=1, kernel=kernel))
+            self.assertTrue(np.array_equal(gradient_data, out_of_core))
+
+    def test_gradient_normalization(self):
+        for options in [{}, {"memory_budget": 128 * 128 * 3 * 4}, {"kernel": "central"},
+                        {"kernel": "central", "memory_budget": 1}]:
+            gradient_data = self.atlas_obj.gradient_atlas(**options)
+            normalization = self.atlas_obj.gradient_normalization
+            minimum, maximum = normalization["minimum"], normalization["maximum"]
+            self.assertLess(minimum, maximum)
+            self.assertEqual(normalization["background"], int(-minimum / (maximum - minimum) * 255))
+            # the empty cells hold the background, and the gradient of the slices spans the whole uint8 range
+            self.assertTrue(np.all(gradient_data[-1, -1] == normalization["background"]))
+            self.assertEqual(gradient_data.max(), 255)
+
 
 class TestAtlasFileOutput(unittest.TestCase):
 
     def setUp(self):
-        self.atlas_obj = Atlas(dummy_loader, size=(512, 512), num_slices=512)
+        # 64 slices of 128x128 pixels, a 1024x1024 atlas with one smaller level (512)
+        self.atlas_obj = Atlas(dummy_loader, size=(128, 128), num_slices=64)
         self.atlas_obj.load("")
         self.atlas_obj.convert()
 
+    def assert_written(self, output_base_path, gradient):
+        with open(output_base_path + "_atlas.json") as f:
+            metadata = json.load(f)
+        names = ["test_output_full.png", "test_output_512.png"]
+        if gradient:
+            names += ["test_output_gradient_full.png", "test_output_512_gradient.png"]
+        self.assertEqual(sorted(entry["path"] for entry in metadata["files"]), sorted(names))
+        for name in names:
+            self.assertTrue(os.path.exists(os.path.join(os.path.dirname(output_base_path), name)), name)
+        self.assertFalse(os.path.exists(output_base_path + "_1024.png"))
+
     def test_write_with_gradient(self):
         with TemporaryDirectory() as tmpdirname:
             output_base_path = os.path.join(tmpdirname, "test_output")
-            self.atlas_obj.write(output_base_path, gradient=True)
+            self.atlas_obj.write(output_base_path, gradient=True, scaled_outputs=True)
+            self.assert_written(output_base_path, gradient=True)
+
+    def test_write(self):
+        with TemporaryDirectory() as tmpdirname:
+            output_base_path = os.path.join(tmpdirname, "test_output")
+            self.atlas_obj.write(output_base_path, gradient=False, scaled_outputs=True)
+            self.assert_written(output_base_path, gradient=False)
 
-            self.assertTrue(os.path.exists(output_base_path + "_AtlasDim.txt"))
-            self.assertTrue(os.path.exists(output_base_path + "_full.png"))
-            self.assertTrue(os.path.exists(output_base_path + "_gradient_full.png"))
 
-            for size in [8192, 4096, 2048, 1024, 512]:
-                if size < self.atlas_obj.atlas.shape[0]:
-                    self.assertTrue(os.path.exists(f"{output_base_path}_{size}.png"))
-                    self.assertTrue(os.path.exists(f"{output_base_path}_{size}_gradient.png"))
+class TestAtlasScaledOutput(unittest.TestCase):
 
-    def test_write(self):
+    def test_write_levels(self):
+        atlas_obj = Atlas(dummy_loader, size=(64, 64), num_slices=16)
+        atlas_obj.load("")
+        atlas_obj.convert()
+        with TemporaryDirectory() as tmpdirname:
+            output_base_path = os.path.join(tmpdirname, "test_output")
+            atlas_obj.write(output_base_path, gradient=True, scaled_outputs=True, levels=[128, 64, 512],
+                            resample="box", workers=2)
+
+            for size in [128, 64]:
+                with Image.open(f"{output_base_path}_{size}.png") as image:
+                    self.assertEqual(image.size, (size, size))
+                self.assertTrue(os.path.exists(f"{output_base_path}_{size}_gradient.png"))
+            self.assertFalse(os.path.exists(f"{output_base_path}_512.png"))
+
+            with open(output_base_path + "_atlas.json") as f:
+                metadata = json.load(f)
+            self.assertEqual(metadata["slices"], 16)
+            self.assertEqual(metadata["grid"], {"rows": 4, "columns": 4})
+            self.assertEqual(metadata["format"], "png")
+            self.assertEqual(len(metadata["files"]), 6)
+
+    def test_write_without_smaller_levels(self):
+        atlas_obj = Atlas(dummy_loader, size=(8, 8), num_slices=4)
+        atlas_obj.load("")
+        atlas_obj.convert()
+        with TemporaryDirectory() as tmpdirname, contextlib.redirect_stdout(io.StringIO()) as output:
+            atlas_obj.write(os.path.join(tmpdirname, "test_output"), scaled_outputs=True)
+        self.assertNotIn("Writing images with sizes", output.getvalue())
+
+    def test_write_container(self):
+        atlas_obj = Atlas(dummy_loader, size=(64, 64), num_slices=16)
+        atlas_obj.load("")
+        atlas_obj.convert()
         with TemporaryDirectory() as tmpdirname:
             output_base_path = os.path.join(tmpdirname, "test_output")
-            self.atlas_obj.write(output_base_path, gradient=False)
+            atlas_obj.write(output_base_path, scaled_outputs=True, levels=[128], output_format="container")
 
-            self.assertTrue(os.path.exists(output_base_path + "_AtlasDim.txt"))
-            self.assertTrue(os.path.exists(output_base_path + "_full.png"))
+            levels = read_container(output_base_path + ".atlas")
+            self.assertTrue(np.array_equal(levels["full"], atlas_obj.atlas))
+            self.assertEqual(levels["128"].shape, (128, 128, 3))
+            del levels
+            with open(output_base_path + "_atlas.json") as f:
+                metadata = json.load(f)
+            self.assertEqual([entry["entry"] for entry in metadata["files"]], ["full", "128"])
 
-            for size in [8192, 4096, 2048, 1024, 512]:
-                if size < self.atlas_obj.atlas.shape[0]:
-                    self.assertTrue(os.path.exists(f"{output_base_path}_{size}.png"))
+    def test_write_pages(self):
+        atlas_obj = Atlas(dummy_loader, size=(16, 16), num_slices=10)
+        atlas_obj.load("")
+        atlas_obj.convert(max_texture_size=40)
+        # 2 x 2 tiles fit in a page, the 5 rows of tiles are split into pages of 2, 2 and 1 rows
+        self.assertEqual(atlas_obj.atlas.shape, (80, 32, 3))
+        with TemporaryDirectory() as tmpdirname:
+            output_base_path = os.path.join(tmpdirname, "test_output")
+            atlas_obj.write(output_base_path, gradient=True, scaled_outputs=True, levels=[16], resample="box")
+
+            pages = []
+            for page in range(3):
+                with Image.open(f"{output_base_path}_full_page{page}.png") as image:
+                    pages.append(np.array(image))
+                with Image.open(f"{output_base_path}_16_page{page}.png") as image:
+                    self.assertEqual(image.size, (16, 16 if page < 2 else 8))
+                self.assertTrue(os.path.exists(f"{output_base_path}_gradient_full_page{page}.png"))
+            self.assertTrue(np.array_equal(np.concatenate(pages), atlas_obj.atlas))
+            self.assertFalse(os.path.exists(output_base_path + "_full.png"))
+
+            with open(output_base_path + "_atlas.json") as f:
+                metadata = json.load(f)
+            self.assertEqual(metadata["grid"], {"rows": 2, "columns": 2})
+            self.assertEqual([(page["first_slice"], page["slices"], page["height"]) for page in metadata["pages"]],
+                             [(0, 4, 32), (4, 4, 32), (8, 2, 16)])
+            self.assertEqual(len(metadata["files"]), 12)
+            self.assertEqual(sorted({entry["page"] for entry in metadata["files"]}), [0, 1, 2])
+
+            atlas_obj.write(output_base_path, output_format="container")
+            levels = read_container(output_base_path + ".atlas")
+            self.assertEqual(sorted(levels), ["full_page0", "full_page1", "full_page2"])
+            self.assertTrue(np.array_equal(levels["full_page2"], pages[2]))
+            del levels
+
+
+class TestStreamingWrite(unittest.TestCase):
+
+    def write_both(self, loader, tmpdirname, max_texture_size=None, gradient_options=None, packed=False):
+        """Write an atlas converted in memory and streamed from a planned atlas, and return both output paths."""
+        outputs = []
+        for streaming in [False, True]:
+            atlas_obj = Atlas(loader)
+            atlas_obj.load("")
+            if streaming:
+                atlas_obj.plan(max_texture_size)
+            else:
+                atlas_obj.convert(max_texture_size)
+            output = os.path.join(tmpdirname, "streamed" if streaming else "in_memory")
+            atlas_obj.write(output, gradient=gradient_options is not None, gradient_options=gradient_options,
+                            streaming=streaming, packed=packed)
+            self.assertEqual(atlas_obj.atlas is None, streaming)
+            outputs.append(output)
+        return outputs
+
+    def assert_same_files(self, in_memory, streamed):
+        with open(in_memory + "_atlas.json") as f, open(streamed + "_atlas.json") as g:
+            files, streamed_files = json.load(f)["files"], json.load(g)["files"]
+        self.assertEqual([dict(entry, path=None) for entry in files],
+                         [dict(entry, path=None) for entry in streamed_files])
+        tmpdirname = os.path.dirname(in_memory)
+        for entry, streamed_entry in zip(files, streamed_files):
+            with Image.open(os.path.join(tmpdirname, entry["path"])) as image, \
+                    Image.open(os.path.join(tmpdirname, streamed_entry["path"])) as streamed_image:
+                self.assertTrue(np.array_equal(np.asarray(image), np.asarray(streamed_image)))
+
+    def test_streaming_write_volume(self):
+        volume = np.stack(dummy_loader(size=(16, 16)))[..., 0].astype(np.uint16) * 16 + 1000
+        with TemporaryDirectory() as tmpdirname:
+            for gradient_options in [{"kernel": "central"}, {"memory_budget": 2 ** 16}]:
+                self.assert_same_files(*self.write_both(lambda path: volume, tmpdirname, 40, gradient_options))
+
+    def test_streaming_write_packed(self):
+        volume = np.stack(dummy_loader(size=(16, 16)))[..., 0].astype(np.uint16) * 16 + 1000
+        with TemporaryDirectory() as tmpdirname:
+            in_memory, streamed = self.write_both(lambda path: volume, tmpdirname, 40, {"kernel": "central"}, True)
+            self.assert_same_files(in_memory, streamed)
+            with open(in_memory + "_atlas.json") as f, open(streamed + "_atlas.json") as g:
+                self.assertEqual(json.load(f)["gradient"], json.load(g)["gradient"])
+
+    def test_streaming_write_stream(self):
+        loader = partial(dummy_stream_loader, size=(16, 16))
+        with TemporaryDirectory() as tmpdirname:
+            self.assert_same_files(*self.write_both(loader, tmpdirname))
+            streamed = Atlas(loader)
+            streamed.load("")
+            streamed.plan()
+            with self.assertRaises(ValueError):
+                streamed.write(os.path.join(tmpdirname, "out"), gradient=True, streaming=True)
+            with self.assertRaises(ValueError):
+                streamed.write(os.path.join(tmpdirname, "out"), scaled_outputs=True, streaming=True)
+
+
+class TestPackedWrite(unittest.TestCase):
+
+    def setUp(self):
+        volume = np.stack(dummy_loader(size=(16, 16)))[..., 0].astype(np.uint16) * 16 + 1000
+        self.atlas_obj = Atlas(lambda path: volume)
+        self.atlas_obj.load("")
+        self.atlas_obj.plan()
+
+    def test_packed_atlas(self):
+        packed = self.atlas_obj.packed_atlas(kernel="central")
+        self.assertIsNone(self.atlas_obj.atlas)
+        self.assertEqual(packed.shape, (48, 64, 4))
+        self.assertTrue(np.array_equal(packed[..., :3], self.atlas_obj.gradient_atlas(kernel="central")))
+        intensity = tile_volume(self.atlas_obj.grayscale_volume(), self.atlas_obj.layout.columns)
+        self.assertTrue(np.array_equal(packed[..., 3], intensity[:48]))
+
+    def test_write_packed(self):
+        with TemporaryDirectory() as tmpdirname:
+            output_base_path = os.path.join(tmpdirname, "test_output")
+            self.atlas_obj.write(output_base_path, scaled_outputs=True, levels=[32], resample="box",
+                                 gradient_options={"kernel": "central"}, packed=True)
+            self.assertFalse(os.path.exists(output_base_path + "_full.png"))
+            self.assertFalse(os.path.exists(output_base_path + "_gradient_full.png"))
+            with Image.open(output_base_path + "_packed_full.png") as image:
+                self.assertEqual(image.mode, "RGBA")
+                self.assertTrue(np.array_equal(np.asarray(image), self.atlas_obj.packed_atlas(kernel="central")))
+            with Image.open(output_base_path + "_32_packed.png") as image:
+                self.assertEqual(image.size, (32, 24))
 
+            with open(output_base_path + "_atlas.json") as f:
+                metadata = json.load(f)
+            self.assertEqual(metadata["version"], 3)
+            self.assertEqual(metadata["channels"], {"rgb": "gradient", "alpha": "intensity"})
+            self.assertEqual(metadata["gradient"], self.atlas_obj.gradient_normalization)
+            self.assertEqual([(entry["kind"], entry["level"], entry["channels"]) for entry in metadata["files"]],
+                             [("packed", "full", 4), ("packed", 32, 4)])
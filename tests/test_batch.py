@@ -0,0 +1,86 @@
+import json
+import os
+import unittest
+from tempfile import TemporaryDirectory
+
+import numpy as np
+from PIL import Image
+
+from atlas_conversion.batch import job_arguments, main, options_to_arguments, read_manifest, run_batch, run_job
+
+
+def crashing_run_job(job, default_memory_limit=None):
+    """Run a job like run_job, but kill the worker process for inputs named crash."""
+    if os.path.basename(job["input"]) == "crash":
+        os._exit(1)
+    return run_job(job, default_memory_limit)
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.input_dir = os.path.join(self.temp_dir.name, "slices")
+        os.mkdir(self.input_dir)
+        for i in range(4):
+            image = np.full((16, 16, 3), i * 60, dtype=np.uint8)
+            Image.fromarray(image).save(os.path.join(self.input_dir, f"slice_{i}.png"))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def output(self, name):
+        return os.path.join(self.temp_dir.name, name)
+
+    def test_options_to_arguments(self):
+        self.assertEqual(options_to_arguments("--gradient --resize 8 8"), ["--gradient", "--resize", "8", "8"])
+        self.assertEqual(options_to_arguments({"gradient": True, "scaled_outputs": False, "resize": [8, 8]}),
+                         ["--gradient", "--resize", "8", "8"])
+        self.assertEqual(options_to_arguments(None), [])
+        self.assertEqual(job_arguments({"input": "in", "output": "out", "format": "png"}),
+                         ["in", "out", "--format", "png"])
+
+    def test_read_manifest(self):
+        csv_path = self.output("manifest.csv")
+        with open(csv_path, "w") as f:
+            f.write("input,output,format,options,memory_limit\n")
+            f.write("in,out,png,--gradient,\n")
+        self.assertEqual(read_manifest(csv_path),
+                         [{"input": "in", "output": "out", "format": "png", "options": "--gradient"}])
+
+        json_path = self.output("manifest.json")
+        with open(json_path, "w") as f:
+            json.dump([{"output": "out"}], f)
+        with self.assertRaises(ValueError):
+            read_manifest(json_path)
+
+    def test_run_batch(self):
+        jobs = [
+            {"input": self.input_dir, "output": self.output("a"), "options": {"gradient": True}},
+            {"input": self.output("missing"), "output": self.output("b")},
+            {"input": self.input_dir, "output": self.output("c"), "format": "png", "options": "--resize 8 8"},
+        ]
+        reports = run_batch(jobs, workers=2)
+        self.assertEqual([report["status"] for report in reports], ["ok", "failed", "ok"])
+        self.assertIn("FileNotFoundError", reports[1]["error"])
+        self.assertTrue(os.path.exists(self.output("a_gradient_full.png")))
+        with Image.open(self.output("c_full.png")) as image:
+            self.assertEqual(image.size, (16, 16))
+
+    def test_run_batch_worker_crash(self):
+        jobs = [{"input": self.input_dir, "output": self.output(name)} for name in "ab"]
+        jobs.insert(1, {"input": self.output("crash"), "output": self.output("crash")})
+        jobs.append({"input": self.input_dir, "output": self.output("c")})
+        reports = run_batch(jobs, workers=2, runner=crashing_run_job)
+        self.assertEqual([report["status"] for report in reports], ["ok", "failed", "ok", "ok"])
+        self.assertIn("died", reports[1]["error"])
+        for name in "abc":
+            self.assertTrue(os.path.exists(self.output(name + "_full.png")))
+
+    def test_main_report(self):
+        manifest = self.output("manifest.json")
+        with open(manifest, "w") as f:
+            json.dump([{"input": self.input_dir, "output": self.output("a")}], f)
+        self.assertEqual(main([manifest, "--workers", "1", "--report", self.output("report.json")]), 0)
+        with open(self.output("report.json")) as f:
+            self.assertEqual(json.load(f)[0]["status"], "ok")
@@ -0,0 +1,123 @@
+import os
+import unittest
+from tempfile import TemporaryDirectory
+
+import numpy as np
+from PIL import Image
+
+from atlas_conversion.atlas import Atlas
+from atlas_conversion.cache import Cache, content_hash, slice_hashes, source_key, volume_key
+from atlas_conversion.loaders import png_loader
+
+
+# Paths loaded by counting_loader
+LOADED = []
+
+
+def counting_loader(path, **options):
+    """Load the png slices of path and record the call in LOADED."""
+    LOADED.append(path)
+    return png_loader(path, **options)
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.cache = Cache(os.path.join(self.temp_dir.name, "cache"))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_put_get(self):
+        array = np.arange(24, dtype=np.uint16).reshape(2, 3, 4)
+        self.assertIsNone(self.cache.get("key"))
+        self.cache.put("key", array)
+        cached = self.cache.get("key")
+        self.assertTrue(np.array_equal(cached, array))
+        self.assertEqual(cached.dtype, np.uint16)
+        self.assertFalse(cached.flags.writeable)
+
+    def test_lru_eviction(self):
+        array = np.zeros(1000, dtype=np.uint8)
+        self.cache.max_size = 3 * (array.nbytes + 128)
+        for i, key in enumerate("abc"):
+            self.cache.put(key, array)
+            os.utime(self.cache.path(key), (i, i))
+        self.cache.get("a")
+        self.cache.put("d", array)
+        self.assertIsNotNone(self.cache.get("a"))
+        self.assertIsNone(self.cache.get("b"))
+        self.assertLessEqual(self.cache.size(), self.cache.max_size)
+
+    def test_keys(self):
+        path = os.path.join(self.temp_dir.name, "volume.raw")
+        with open(path, "wb") as f:
+            f.write(b"volume")
+        key = volume_key(path, png_loader, {"resize": (8, 8), "workers": 4})
+        self.assertEqual(key, volume_key(path, png_loader, {"resize": (8, 8)}))
+        self.assertNotEqual(key, volume_key(path, png_loader, {"resize": (4, 4)}))
+        digest, source = content_hash(path), source_key(path, png_loader, {"resize": (8, 8)})
+        with open(path, "wb") as f:
+            f.write(b"changed")
+        self.assertNotEqual(content_hash(path), digest)
+        self.assertEqual(source_key(path, png_loader, {"resize": (8, 8), "workers": 4}), source)
+
+    def test_slice_hashes(self):
+        volume = np.zeros((3, 4, 5), dtype=np.uint8)
+        hashes = slice_hashes(volume)
+        self.assertEqual(hashes.shape, (3, 16))
+        volume[1, 2, 3] = 1
+        changed = slice_hashes(volume)
+        self.assertEqual([np.array_equal(a, b) for a, b in zip(hashes, changed)], [True, False, True])
+        self.assertFalse(np.array_equal(slice_hashes(volume, b"salt")[0], changed[0]))
+
+
+class TestAtlasCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.input_dir = os.path.join(self.temp_dir.name, "slices")
+        os.mkdir(self.input_dir)
+        for i in range(5):
+            Image.fromarray(np.full((16, 16, 3), i * 50, dtype=np.uint8)).save(
+                os.path.join(self.input_dir, f"slice_{i}.png"))
+        self.cache = Cache(os.path.join(self.temp_dir.name, "cache"))
+        LOADED.clear()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def convert(self, **loader_options):
+        atlas = Atlas(counting_loader, cache=self.cache, **loader_options)
+        atlas.load(self.input_dir)
+        atlas.convert()
+        return atlas
+
+    def test_reuses_volume_atlas_and_gradient(self):
+        first = self.convert()
+        gradient = first.gradient_atlas()
+        second = self.convert()
+        self.assertEqual(len(LOADED), 1)
+        self.assertTrue(np.array_equal(second.atlas, first.atlas))
+        self.assertEqual(second.layout.columns, 3)
+        self.assertTrue(np.array_equal(second.gradient_atlas(), gradient))
+        self.assertEqual(second.gradient_normalization, first.gradient_normalization)
+
+        uncached = Atlas(png_loader)
+        uncached.load(self.input_dir)
+        uncached.convert()
+        self.assertTrue(np.array_equal(second.atlas, uncached.atlas))
+
+    def test_stream_is_not_decoded_when_atlas_is_cached(self):
+        self.convert(stream=True)
+        atlas = self.convert(stream=True)
+        self.assertEqual(len(atlas.slices), 5)
+        self.assertEqual(atlas.atlas.shape, (32, 48, 3))
+
+    def test_changed_input_misses(self):
+        self.convert()
+        Image.fromarray(np.zeros((16, 16, 3), dtype=np.uint8)).save(os.path.join(self.input_dir, "slice_1.png"))
+        atlas = self.convert()
+        self.assertEqual(len(LOADED), 2)
+        self.assertTrue(np.all(atlas.atlas[:16, 16:32] == 0))
@@ -0,0 +1,84 @@
+import json
+import os
+import unittest
+from tempfile import TemporaryDirectory
+
+import numpy as np
+from PIL import Image
+
+from atlas_conversion.formats import (encode_images, output_base_name, png_options, read_container,
+                                      write_container, write_png_strips)
+
+
+class TestFormats(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.image = rng.integers(0, 255, (48, 64, 3), dtype=np.uint8)
+        self.small = rng.integers(0, 255, (24, 32, 3), dtype=np.uint8)
+
+    def test_png_options(self):
+        self.assertEqual(png_options(1, "rle")["compress_level"], 1)
+        with self.assertRaises(ValueError):
+            png_options(1, "zstd")
+
+    def test_encode_png(self):
+        with TemporaryDirectory() as tmpdirname:
+            base_name = os.path.join(tmpdirname, "image")
+            for backend in ["thread", "process"]:
+                written = encode_images([(self.image, base_name)], "png", workers=2, backend=backend,
+                                        compress_level=1, strategy="huffman")
+                self.assertEqual(written, [[base_name + ".png"]])
+                self.assertTrue(np.array_equal(np.asarray(Image.open(base_name + ".png")), self.image))
+
+    def test_write_png_strips(self):
+        # smooth, flat and noisy rows exercise all the png filters
+        image = (np.add.outer(np.arange(150), np.arange(70))[..., np.newaxis] * [1, 2, 3] % 256).astype(np.uint8)
+        image[40:60] = 9
+        image[120:] = np.random.default_rng(1).integers(0, 255, (30, 70, 3), dtype=np.uint8)
+        with TemporaryDirectory() as tmpdirname:
+            filename = os.path.join(tmpdirname, "image.png")
+            strips = [image[:1], image[1:100], image[100:]]
+            self.assertEqual(write_png_strips(iter(strips), image.shape, filename), [filename])
+            self.assertTrue(np.array_equal(np.asarray(Image.open(filename)), image))
+            for channels in [1, 2, 4]:
+                shaped = image[..., 0] if channels == 1 else np.repeat(image[..., :1], channels, axis=2)
+                shaped = np.ascontiguousarray(shaped)
+                write_png_strips([shaped], shaped.shape, filename, compress_level=1, strategy="rle")
+                self.assertTrue(np.array_equal(np.asarray(Image.open(filename)), shaped))
+            with self.assertRaises(ValueError):
+                write_png_strips([image[:10]], image.shape, filename)
+
+    def test_encode_raw(self):
+        with TemporaryDirectory() as tmpdirname:
+            base_name = os.path.join(tmpdirname, "image")
+            encode_images([(self.image, base_name)], "raw")
+            with open(base_name + ".json") as f:
+                description = json.load(f)
+            self.assertEqual(description, {"width": 64, "height": 48, "channels": 3, "dtype": "uint8"})
+            data = np.fromfile(base_name + ".bin", dtype=np.uint8).reshape(48, 64, 3)
+            self.assertTrue(np.array_equal(data, self.image))
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            encode_images([(self.image, "image")], "jpeg")
+
+    def test_container_round_trip(self):
+        with TemporaryDirectory() as tmpdirname:
+            filename = os.path.join(tmpdirname, "image.atlas")
+            write_container([("full", self.image), (32, self.small), ("gray", self.small[..., 0])], filename)
+            levels = read_container(filename)
+            self.assertEqual(list(levels), ["full", "32", "gray"])
+            self.assertTrue(np.array_equal(levels["full"], self.image))
+            self.assertTrue(np.array_equal(levels["32"], self.small))
+            self.assertTrue(np.array_equal(levels["gray"], self.small[..., 0]))
+            del levels
+
+    def test_output_base_name(self):
+        self.assertEqual(output_base_name("out", "color", "full"), "out_full")
+        self.assertEqual(output_base_name("out", "gradient", "full"), "out_gradient_full")
+        self.assertEqual(output_base_name("out", "gradient", 512), "out_512_gradient")
+        self.assertEqual(output_base_name("out", "gradient", "full", 1), "out_gradient_full_page1")
+        self.assertEqual(output_base_name("out", "color", 512, 0), "out_512_page0")
+        self.assertEqual(output_base_name("out", "packed", "full"), "out_packed_full")
+        self.assertEqual(output_base_name("out", "packed", 512, 1), "out_512_packed_page1")
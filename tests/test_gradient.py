@@ -0,0 +1,73 @@
+import unittest
+
+import dask.array as da
+import numpy as np
+from scipy import ndimage
+
+from atlas_conversion.gradient import (budget_chunk_depth, fused_gradient, iter_gradient_chunks, kernel_halo,
+                                       quantize_gradient)
+from atlas_conversion.utils import calculate_gradient, normalize_rgb
+
+
+class TestFusedGradient(unittest.TestCase):
+
+    def setUp(self):
+        self.volume = np.random.default_rng(0).integers(0, 255, (20, 17, 41), dtype=np.uint8)
+        data = self.volume.astype(np.float32)
+        axes = [1, 0, 2]
+        self.expected = {
+            # the gaussian kernel repeats the border voxels like calculate_gradient
+            "gaussian": np.stack([ndimage.gaussian_filter1d(np.pad(data, 1, mode="symmetric"), 2, axis=axis, order=1)
+                                  for axis in axes], axis=3)[1:-1, 1:-1, 1:-1],
+            "central": np.stack([ndimage.correlate1d(data, [-0.5, 0, 0.5], axis=axis) for axis in axes], axis=3),
+            "sobel": np.stack([ndimage.sobel(data, axis=axis) for axis in axes], axis=3),
+        }
+
+    def test_kernels_match_whole_volume_filters(self):
+        for kernel, expected in self.expected.items():
+            for chunk_depth in [1, 7, 41, 100]:
+                gradient, minimum, maximum = fused_gradient(self.volume, kernel, chunk_depth=chunk_depth)
+                self.assertEqual(gradient.dtype, np.float32)
+                self.assertTrue(np.allclose(gradient, expected, atol=1e-4), (kernel, chunk_depth))
+                self.assertEqual(minimum, gradient.min())
+                self.assertEqual(maximum, gradient.max())
+
+    def test_gaussian_matches_calculate_gradient(self):
+        gradient, minimum, maximum = fused_gradient(self.volume, "gaussian", chunk_depth=7)
+        gradient_data, g_background = quantize_gradient(gradient, minimum, maximum)
+        expected, expected_background, value_range = calculate_gradient(
+            da.from_array(self.volume, chunks=(20, 17, 9)).astype(np.float32), return_range=True)
+        expected_background, expected = normalize_rgb(expected_background, expected)
+        self.assertEqual((minimum, maximum), value_range)
+        self.assertEqual(g_background, expected_background)
+        self.assertTrue(np.array_equal(gradient_data, expected))
+
+    def test_chunks_reuse_buffer(self):
+        chunks = list(iter_gradient_chunks(self.volume, "central", chunk_depth=10))
+        self.assertEqual([start for start, _ in chunks], [0, 10, 20, 30, 40])
+        self.assertTrue(np.shares_memory(chunks[0][1], chunks[1][1]))
+
+    def test_chunks_of_z_range(self):
+        gradient = fused_gradient(self.volume, "gaussian")[0]
+        chunks = list(iter_gradient_chunks(self.volume, "gaussian", chunk_depth=4, z_range=(13, 23)))
+        self.assertEqual([start for start, _ in chunks], [13, 17, 21])
+        # the halo is read from the neighbouring slices, so the range gets the gradient of the whole volume
+        self.assertTrue(np.array_equal(chunks[-1][1], gradient[:, :, 21:23]))
+
+    def test_unknown_kernel(self):
+        with self.assertRaises(ValueError):
+            fused_gradient(self.volume, "laplace")
+
+    def test_kernel_halo(self):
+        self.assertEqual(kernel_halo("gaussian", 2), 8)
+        self.assertEqual(kernel_halo("sobel"), 1)
+
+    def test_budget_chunk_depth(self):
+        self.assertEqual(budget_chunk_depth((20, 17, 41), 20 * 17 * 24 * 5), 5)
+        self.assertEqual(budget_chunk_depth((20, 17, 41), 1), 1)
+
+    def test_quantize_gradient(self):
+        gradient = np.array([-2.0, 0.0, 2.0], dtype=np.float32)
+        quantized, background = quantize_gradient(gradient, np.float32(-2), np.float32(2))
+        self.assertTrue(np.array_equal(quantized, [0, 127, 255]))
+        self.assertEqual(background, 127)
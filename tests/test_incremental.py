@@ -0,0 +1,133 @@
+import json
+import os
+import unittest
+from tempfile import TemporaryDirectory
+
+import numpy as np
+from PIL import Image
+
+from atlas_conversion.__main__ import main
+from atlas_conversion.atlas import Atlas
+from atlas_conversion.cache import Cache
+from atlas_conversion.incremental import IncrementalAtlas, affected_ranges, changed_slices, complement_ranges
+
+
+def npy_loader(path):
+    return np.load(path)
+
+
+class TestRanges(unittest.TestCase):
+
+    def test_changed_slices(self):
+        hashes = np.zeros((5, 16), dtype=np.uint8)
+        edited = hashes.copy()
+        edited[[1, 3], 0] = 1
+        self.assertEqual(list(changed_slices(hashes, edited)), [1, 3])
+        self.assertEqual(list(changed_slices(None, edited)), [0, 1, 2, 3, 4])
+        self.assertEqual(list(changed_slices(hashes[:4], edited)), [0, 1, 2, 3, 4])
+
+    def test_affected_ranges(self):
+        self.assertEqual(affected_ranges([1, 3, 12], 20, 2), [(0, 6), (10, 15)])
+        self.assertEqual(affected_ranges([19], 20, 8), [(11, 20)])
+        self.assertEqual(affected_ranges([], 20, 8), [])
+
+    def test_complement_ranges(self):
+        self.assertEqual(complement_ranges([(0, 6), (10, 15)], 20), [(6, 10), (15, 20)])
+        self.assertEqual(complement_ranges([(0, 20)], 20), [])
+        self.assertEqual(complement_ranges([], 20), [(0, 20)])
+
+
+class TestIncrementalAtlas(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "volume.npy")
+        # the steepest gradients are at the step of the first slices, far from the edited slices
+        self.volume = np.full((30, 16, 12), 100, dtype=np.uint8)
+        self.volume[:3], self.volume[3:6] = 0, 200
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def convert(self, cache, kernel):
+        """Convert the volume incrementally and in full, and return both atlases."""
+        np.save(self.path, self.volume)
+        atlas_obj = IncrementalAtlas(npy_loader, cache)
+        reference = Atlas(npy_loader)
+        for converted in [atlas_obj, reference]:
+            converted.load(self.path)
+            converted.convert()
+            converted.gradient = converted.gradient_atlas(kernel=kernel)
+        self.assertTrue(np.array_equal(atlas_obj.atlas, reference.atlas))
+        self.assertTrue(np.array_equal(atlas_obj.gradient, reference.gradient))
+        self.assertEqual(atlas_obj.gradient_normalization, reference.gradient_normalization)
+        return atlas_obj
+
+    def test_changed_slices_are_converted_again(self):
+        for kernel, recomputed in [(None, [(12, 29)]), ("gaussian", [(12, 29)]), ("central", [(19, 22)])]:
+            self.volume[20] = 100
+            cache = Cache(os.path.join(self.temp_dir.name, "cache-" + str(kernel)))
+            atlas_obj = self.convert(cache, kernel)
+            self.assertEqual(len(atlas_obj.changed), 30)
+            self.assertEqual(atlas_obj.recomputed, [(0, 30)])
+
+            self.volume[20] = 110
+            atlas_obj = self.convert(cache, kernel)
+            self.assertEqual(list(atlas_obj.changed), [20])
+            self.assertEqual(atlas_obj.recomputed, recomputed)
+
+    def test_changed_gradient_range_quantizes_all_slices(self):
+        cache = Cache(os.path.join(self.temp_dir.name, "cache"))
+        self.convert(cache, "central")
+        self.volume[20] = 255
+        atlas_obj = self.convert(cache, "central")
+        self.assertEqual(list(atlas_obj.changed), [20])
+        self.assertEqual(atlas_obj.recomputed, [(0, 30)])
+
+    def test_needs_cache(self):
+        with self.assertRaises(ValueError):
+            IncrementalAtlas(npy_loader, None)
+
+
+class TestSeries(unittest.TestCase):
+
+    def test_frames(self):
+        with TemporaryDirectory() as tmpdirname:
+            frames = os.path.join(tmpdirname, "frames")
+            for frame in range(3):
+                os.makedirs(os.path.join(frames, "t{}".format(frame)))
+                for i in range(5):
+                    Image.fromarray(np.full((8, 8), frame * 50 + i * 10, dtype=np.uint8)).save(
+                        os.path.join(frames, "t{}".format(frame), "{}.png".format(i)))
+            output = os.path.join(tmpdirname, "series")
+            main([frames, output, "--frames", "--frame-workers", "2", "--gradient", "--gradient-kernel", "central",
+                  "--incremental", "--cache-dir", os.path.join(tmpdirname, "cache")])
+
+            with open(output + "_series.json") as f:
+                series = json.load(f)
+            self.assertEqual(series["grid"], {"rows": 2, "columns": 3})
+            self.assertEqual([frame["metadata"] for frame in series["frames"]],
+                             ["series_frame0_atlas.json", "series_frame1_atlas.json", "series_frame2_atlas.json"])
+            for frame in range(3):
+                with Image.open("{}_frame{}_gradient_full.png".format(output, frame)) as image:
+                    self.assertEqual(image.size, (24, 16))
+                with Image.open("{}_frame{}_full.png".format(output, frame)) as image:
+                    self.assertEqual(np.asarray(image)[0, 0, 0], frame * 50)
+
+    def test_frames_of_a_budget(self):
+        with TemporaryDirectory() as tmpdirname:
+            frames = os.path.join(tmpdirname, "frames")
+            for frame in range(2):
+                os.makedirs(os.path.join(frames, "t{}".format(frame)))
+                for i in range(8):
+                    Image.fromarray(np.full((16, 16), frame * 50 + i * 10, dtype=np.uint16)).save(
+                        os.path.join(frames, "t{}".format(frame), "{}.png".format(i)))
+            output = os.path.join(tmpdirname, "series")
+            # the layout is planned from the headers of the first frame, it must hold the resampled frames
+            main([frames, output, "--frames", "--frame-workers", "1", "--max-voxels", "512"])
+
+            with open(output + "_series.json") as f:
+                series = json.load(f)
+            self.assertEqual(series["grid"], {"rows": 2, "columns": 3})
+            with Image.open(output + "_frame1_full.png") as image:
+                self.assertEqual(image.size, (30, 20))
@@ -0,0 +1,60 @@
+import unittest
+
+import numpy as np
+
+from atlas_conversion.intensity import (intensity_range, map_intensity, map_to_uint8, modality_rescale,
+                                        sample_values)
+from atlas_conversion.utils import rescale_to_uint8
+
+
+class TestIntensity(unittest.TestCase):
+
+    def setUp(self):
+        self.volume = np.random.default_rng(0).integers(-1024, 3000, (20, 16, 12), dtype=np.int16)
+
+    def test_sample_values(self):
+        sample = sample_values(self.volume, sample_size=100)
+        self.assertGreaterEqual(sample.size, 100)
+        self.assertLess(sample.size, 200)
+        self.assertTrue(np.array_equal(sample_values(self.volume), self.volume.ravel()))
+        self.assertEqual(sample_values([self.volume[0], self.volume[1]]).size, 2 * 16 * 12)
+
+    def test_intensity_range(self):
+        self.assertEqual(intensity_range(self.volume, window=(40, 400)), (-160, 240))
+        self.assertEqual(intensity_range(self.volume), (self.volume.min(), self.volume.max()))
+        low, high = intensity_range(self.volume, percentiles=(0, 100))
+        self.assertEqual((low, high), (self.volume.min(), self.volume.max()))
+        low, high = intensity_range(None, percentiles=(50, 50), sample=np.arange(101))
+        self.assertEqual((low, high), (50, 50))
+
+    def test_map_to_uint8(self):
+        mapped = map_to_uint8(self.volume, -160, 240, chunk_size=3)
+        self.assertEqual(mapped.dtype, np.uint8)
+        self.assertTrue(np.array_equal(mapped, rescale_to_uint8(self.volume, -160, 240)))
+        self.assertTrue(np.all(mapped[self.volume <= -160] == 0))
+        self.assertTrue(np.all(mapped[self.volume >= 240] == 255))
+
+    def test_map_intensity(self):
+        volume = np.arange(24, dtype=np.uint8).reshape(2, 3, 4)
+        self.assertIs(map_intensity(volume), volume)
+        self.assertEqual(map_intensity(volume, window=(10, 20))[0, 0, 0], 0)
+        mapped = map_intensity(self.volume)
+        self.assertEqual((mapped.min(), mapped.max()), (0, 255))
+
+    def test_rescale_of_every_slice(self):
+        rescale = np.zeros((len(self.volume), 2), dtype=np.float32)
+        rescale[:, 0], rescale[::2, 1] = 1, -1024
+        rescaled = self.volume.astype(np.float32) + rescale[:, 1, None, None]
+        self.assertTrue(np.array_equal(sample_values(self.volume, rescale=rescale), rescaled.ravel()))
+        self.assertEqual(intensity_range(self.volume, rescale=rescale), (rescaled.min(), rescaled.max()))
+        for options in [{}, {"percentiles": (5, 95)}, {"window": (40, 400)}]:
+            mapped = map_intensity(self.volume, rescale=rescale, **options)
+            self.assertTrue(np.array_equal(mapped, map_intensity(rescaled, **options)), options)
+        rescale[:, 1] = 0
+        self.assertTrue(np.array_equal(map_intensity(self.volume, rescale=rescale), map_intensity(self.volume)))
+
+    def test_modality_rescale(self):
+        pixels = np.array([0, 1024], dtype=np.uint16)
+        self.assertIs(modality_rescale(pixels), pixels)
+        self.assertTrue(np.array_equal(modality_rescale(pixels, "1", "-1024"), [-1024, 0]))
+        self.assertEqual(modality_rescale(pixels, 0.5, 0).dtype, np.float32)
@@ -3,7 +3,9 @@ import os
 import random
 import nrrd
 
-from atlas_conversion.loaders import png_loader, dicom_loader, nrrd_loader, raw_loader
+from atlas_conversion.loaders import (png_loader, dicom_loader, nrrd_loader, raw_loader, SliceStream, crop_window,
+                                      nrrd_dtype, nrrd_mmap, slice_selection)
+from atlas_conversion.utils import rescale_to_uint8
 from pydicom.dataset import Dataset, FileMetaDataset
 from pydicom.uid import generate_uid, ExplicitVRLittleEndian
 from PIL import Image
@@ -20,38 +22,43 @@ def generate_random_image(size=(128, 128)):
     )
 
 
+def write_dicom_slice(filename, pixels, **attributes):
+    """Write a (H, W) or RGB (H, W, 3) array of uint8 or uint16 pixels as a dicom file, with extra attributes."""
+    ds = Dataset()
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.MediaStorageSOPClassUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta = file_meta
+    ds.SOPInstanceUID = generate_uid()
+    ds.Rows, ds.Columns = pixels.shape[:2]
+    ds.PixelData = pixels.tobytes()
+    ds.BitsAllocated = ds.BitsStored = pixels.itemsize * 8
+    ds.HighBit = ds.BitsStored - 1
+    ds.PixelRepresentation = 0
+    if pixels.ndim == 3:
+        ds.SamplesPerPixel = 3
+        ds.PhotometricInterpretation = "RGB"
+        ds.PlanarConfiguration = 0
+    else:
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+    for name, value in attributes.items():
+        setattr(ds, name, value)
+    ds.save_as(filename, implicit_vr=False, little_endian=True)
+
+
 class TestDICOM(unittest.TestCase):
 
     def setUp(self):
         self.num_slices = 10
         self.slices = [generate_random_image() for _ in range(self.num_slices)]
+        self.series = generate_uid()
 
     def generate_dicom_slices(self, temp_dir):
         for idx, slice_img in enumerate(self.slices):
-            ds = Dataset()
-
-            file_meta = FileMetaDataset()
-            file_meta.MediaStorageSOPInstanceUID = generate_uid()
-            file_meta.MediaStorageSOPClassUID = generate_uid()
-            file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
-            ds.file_meta = file_meta
-            ds.SOPInstanceUID = generate_uid()
-            ds.SeriesInstanceUID = generate_uid()
-            ds.StudyInstanceUID = generate_uid()
-            ds.SliceLocation = idx
-            ds.Rows, ds.Columns = slice_img.size
-            ds.PixelData = slice_img.tobytes()
-            ds.BitsAllocated = 8
-            ds.BitsStored = 8
-            ds.HighBit = 7
-            ds.PixelRepresentation = 0
-            ds.SamplesPerPixel = 3
-            ds.PhotometricInterpretation = "RGB"
-            ds.PlanarConfiguration = 0
-            ds.is_little_endian = True
-            ds.is_implicit_VR = False
-
-            ds.save_as(os.path.join(temp_dir, f"slice_{idx}.dcm"))
+            write_dicom_slice(os.path.join(temp_dir, f"slice_{idx}.dcm"), np.array(slice_img),
+                              SeriesInstanceUID=self.series, StudyInstanceUID=generate_uid(), SliceLocation=idx)
 
     def test_dicom_loader(self):
         with TemporaryDirectory() as temp_dir:
@@ -62,6 +69,153 @@ class TestDICOM(unittest.TestCase):
             for loaded, original in zip(loaded_slices, self.slices):
                 self.assertTrue(np.array_equal(loaded, np.array(original)))
 
+    def test_dicom_loader_stream(self):
+        with TemporaryDirectory() as temp_dir:
+            self.generate_dicom_slices(temp_dir)
+
+            stream = dicom_loader(temp_dir, stream=True)
+            self.assertIsInstance(stream, SliceStream)
+            self.assertEqual(len(stream), self.num_slices)
+            self.assertEqual(stream.shape, (128, 128, 3))
+            for loaded, original in zip(stream, self.slices):
+                self.assertTrue(np.array_equal(loaded, np.array(original)))
+
+    def test_dicom_loader_selection(self):
+        with TemporaryDirectory() as temp_dir:
+            self.generate_dicom_slices(temp_dir)
+            expected = np.stack([np.array(slice_) for slice_ in self.slices])[-4::2, 5:105, 30:40]
+
+            volume = dicom_loader(temp_dir, z_range=(-4, 10), z_stride=2, roi=(30, 5, 10, 100))
+            self.assertTrue(np.array_equal(volume, expected))
+            stream = dicom_loader(temp_dir, stream=True, z_range=(-4, 10), z_stride=2, roi=(30, 5, 10, 100))
+            self.assertEqual((len(stream), stream.shape), (2, (100, 10, 3)))
+            self.assertTrue(np.array_equal(np.stack(list(stream)), expected))
+
+    def test_dicom_loader_stream_empty(self):
+        with TemporaryDirectory() as temp_dir:
+            with self.assertRaisesRegex(ValueError, "no slices found in"):
+                dicom_loader(temp_dir, stream=True)
+
+    def test_dicom_loader_parallel(self):
+        with TemporaryDirectory() as temp_dir:
+            self.generate_dicom_slices(temp_dir)
+
+            for backend in ["thread", "process"]:
+                loaded_slices = dicom_loader(temp_dir, workers=3, backend=backend)
+                self.assertEqual(len(loaded_slices), self.num_slices)
+                for loaded, original in zip(loaded_slices, self.slices):
+                    self.assertTrue(np.array_equal(loaded, np.array(original)))
+
+
+class TestSelection(unittest.TestCase):
+
+    def test_slice_selection(self):
+        self.assertEqual(slice_selection(10), range(10))
+        self.assertEqual(list(slice_selection(10, (2, 9), 3)), [2, 5, 8])
+        self.assertEqual(list(slice_selection(10, (-3, 100))), [7, 8, 9])
+        self.assertEqual(list(slice_selection(10, z_stride=4)), [0, 4, 8])
+        with self.assertRaises(ValueError):
+            slice_selection(10, (5, 5))
+
+    def test_crop_window(self):
+        self.assertEqual(crop_window((20, 30, 3)), (slice(0, 20), slice(0, 30)))
+        self.assertEqual(crop_window((20, 30), (25, -5, 10, 10)), (slice(0, 5), slice(25, 30)))
+        with self.assertRaises(ValueError):
+            crop_window((20, 30), (30, 0, 5, 5))
+
+
+class TestDICOMIntensity(unittest.TestCase):
+
+    def setUp(self):
+        self.volume = np.random.default_rng(0).integers(0, 4096, (6, 8, 10), dtype=np.uint16)
+
+    def generate_dicom_slices(self, temp_dir, slope=1, intercept=-1024):
+        for idx, pixels in enumerate(self.volume):
+            write_dicom_slice(os.path.join(temp_dir, f"slice_{idx}.dcm"), pixels, SliceLocation=idx, BitsStored=12,
+                              HighBit=11, RescaleSlope=slope, RescaleIntercept=intercept)
+
+    def test_rescale_and_window(self):
+        hounsfield = self.volume.astype(np.float32) - 1024
+        with TemporaryDirectory() as temp_dir:
+            self.generate_dicom_slices(temp_dir)
+
+            volume = dicom_loader(temp_dir)
+            self.assertEqual(volume.dtype, np.uint8)
+            self.assertTrue(np.array_equal(volume, rescale_to_uint8(hounsfield, hounsfield.min(), hounsfield.max())))
+
+            windowed = rescale_to_uint8(hounsfield, -160, 240)
+            self.assertTrue(np.array_equal(dicom_loader(temp_dir, window=(40, 400)), windowed))
+            stream = dicom_loader(temp_dir, stream=True, window=(40, 400))
+            self.assertTrue(np.array_equal(np.stack(list(stream)), windowed))
+
+    def test_stream_sampled_range(self):
+        with TemporaryDirectory() as temp_dir:
+            self.generate_dicom_slices(temp_dir, intercept=0)
+
+            # all 6 slices are in the sample, so the sampled range is exact
+            streamed = np.stack(list(dicom_loader(temp_dir, stream=True)))
+            self.assertEqual(streamed.dtype, np.uint8)
+            self.assertTrue(np.array_equal(streamed, dicom_loader(temp_dir)))
+            percentiles = dicom_loader(temp_dir, percentiles=(10, 90))
+            self.assertGreater(np.count_nonzero(percentiles == 255), np.count_nonzero(streamed == 255))
+
+
+    def test_rescale_of_every_slice(self):
+        # the first slice is not rescaled, the other slices are
+        intercepts = np.array([0] + [-1024] * (len(self.volume) - 1), dtype=np.float32)
+        with TemporaryDirectory() as temp_dir:
+            for idx, pixels in enumerate(self.volume):
+                write_dicom_slice(os.path.join(temp_dir, f"slice_{idx}.dcm"), pixels, SliceLocation=idx,
+                                  RescaleSlope=1, RescaleIntercept=intercepts[idx])
+            rescaled = self.volume.astype(np.float32) + intercepts[:, None, None]
+            expected = rescale_to_uint8(rescaled, rescaled.min(), rescaled.max())
+            self.assertTrue(np.array_equal(dicom_loader(temp_dir), expected))
+            self.assertTrue(np.array_equal(np.stack(list(dicom_loader(temp_dir, stream=True))), expected))
+            low, high = np.percentile(rescaled, (5, 95))
+            self.assertTrue(np.array_equal(dicom_loader(temp_dir, percentiles=(5, 95)),
+                                           rescale_to_uint8(rescaled, low, high)))
+
+    def test_series_of_several_bit_depths(self):
+        with TemporaryDirectory() as temp_dir:
+            write_dicom_slice(os.path.join(temp_dir, "slice_0.dcm"), np.full((8, 10), 200, dtype=np.uint8),
+                              SliceLocation=0)
+            for idx in range(1, 3):
+                write_dicom_slice(os.path.join(temp_dir, f"slice_{idx}.dcm"), np.full((8, 10), 1000, dtype=np.uint16),
+                                  SliceLocation=idx)
+            self.assertEqual(dicom_loader(temp_dir)[:, 0, 0].tolist(), [0, 255, 255])
+
+
+class TestDICOMSeries(unittest.TestCase):
+
+    def write_slice(self, filename, value, series, position=None, shape=(8, 8), **attributes):
+        if position is not None:
+            # sagittal slices, their normal is the x axis
+            attributes.update(ImageOrientationPatient=[0, 1, 0, 0, 0, 1], ImagePositionPatient=[position, -100, 50])
+        write_dicom_slice(filename, np.full(shape, value, dtype=np.uint8), SeriesInstanceUID=series, **attributes)
+
+    def test_series_selection_and_order(self):
+        volume, other = generate_uid(), generate_uid()
+        positions = [3.0, -1.5, 0.0, 1.5, 4.5]
+        with TemporaryDirectory() as temp_dir:
+            # the file names do not follow the slice positions
+            for idx, position in enumerate(positions):
+                self.write_slice(os.path.join(temp_dir, f"slice_{idx}.dcm"), idx, volume, position)
+            self.write_slice(os.path.join(temp_dir, "localizer.dcm"), 200, volume, 2.0,
+                             ImageType=["ORIGINAL", "PRIMARY", "LOCALIZER"])
+            self.write_slice(os.path.join(temp_dir, "odd_size.dcm"), 201, volume, 2.5, shape=(4, 4))
+            for idx in range(2):
+                self.write_slice(os.path.join(temp_dir, f"other_{idx}.dcm"), 100 + idx, other, idx)
+
+            expected = [idx for _, idx in sorted(zip(positions, range(len(positions))))]
+            for stream in [False, True]:
+                loaded = dicom_loader(temp_dir, workers=2, stream=stream)
+                self.assertEqual([int(slice_[0, 0]) for slice_ in loaded], expected)
+
+            loaded = dicom_loader(temp_dir, series=other)
+            self.assertEqual(loaded[:, 0, 0].tolist(), [100, 101])
+            with self.assertRaisesRegex(ValueError, "no slices of series"):
+                dicom_loader(temp_dir, series="1.2.3")
+
 
 class TestPNG(unittest.TestCase):
 
@@ -83,6 +237,85 @@ class TestPNG(unittest.TestCase):
             for loaded, original in zip(loaded_slices, self.slices):
                 self.assertTrue(np.array_equal(loaded, np.array(original)))
 
+    def test_png_loader_grayscale_volume(self):
+        with TemporaryDirectory() as temp_dir:
+            for idx, slice_img in enumerate(self.slices):
+                slice_img.convert('L').save(os.path.join(temp_dir, f"slice_{idx}.png"))
+
+            volume = png_loader(temp_dir)
+            self.assertIsInstance(volume, np.ndarray)
+            self.assertEqual(volume.shape, (self.num_slices, 128, 128))
+            self.assertTrue(volume.flags.c_contiguous)
+            for loaded, original in zip(volume, self.slices):
+                self.assertTrue(np.array_equal(loaded, np.array(original.convert('L'))))
+            self.assertEqual(png_loader(temp_dir, stream=True).shape, (128, 128))
+
+    def test_png_loader_mixed_modes(self):
+        with TemporaryDirectory() as temp_dir:
+            modes = ["L", "RGB", "P", "LA"]
+            for idx, mode in enumerate(modes):
+                self.slices[idx].convert(mode).save(os.path.join(temp_dir, f"slice_{idx}.png"))
+            expected = np.stack([np.array(self.slices[idx].convert(mode).convert("RGB"))
+                                 for idx, mode in enumerate(modes)])
+            self.assertTrue(np.array_equal(png_loader(temp_dir, workers=2), expected))
+            self.assertTrue(np.array_equal(np.stack(list(png_loader(temp_dir, stream=True))), expected))
+
+            Image.fromarray(np.full((128, 128), 1000, dtype=np.uint16)).save(os.path.join(temp_dir, "slice_4.png"))
+            with self.assertRaisesRegex(ValueError, "slice_4.png"):
+                png_loader(temp_dir)
+
+    def test_png_loader_parallel(self):
+        with TemporaryDirectory() as temp_dir:
+            self.generate_png_slices(temp_dir)
+
+            for backend in ["thread", "process"]:
+                loaded_slices = png_loader(temp_dir, resize=(64, 32), workers=3, backend=backend)
+                self.assertEqual(len(loaded_slices), self.num_slices)
+                for loaded, original in zip(loaded_slices, self.slices):
+                    expected = np.array(original.resize((64, 32), Image.BICUBIC))
+                    self.assertTrue(np.array_equal(loaded, expected))
+
+    def test_png_loader_stream(self):
+        with TemporaryDirectory() as temp_dir:
+            self.generate_png_slices(temp_dir)
+
+            stream = png_loader(temp_dir, resize=(64, 32), stream=True)
+            self.assertIsInstance(stream, SliceStream)
+            self.assertEqual(len(stream), self.num_slices)
+            self.assertEqual(stream.shape, (32, 64, 3))
+            loaded_slices = list(stream)
+            self.assertEqual(len(loaded_slices), self.num_slices)
+            self.assertTrue(all(slice_.shape == stream.shape for slice_ in loaded_slices))
+
+    def test_png_loader_selection(self):
+        with TemporaryDirectory() as temp_dir:
+            self.generate_png_slices(temp_dir)
+            expected = np.stack([np.array(slice_) for slice_ in self.slices])[2:9:3, 20:50, 10:74]
+
+            volume = png_loader(temp_dir, z_range=(2, 9), z_stride=3, roi=(10, 20, 64, 30))
+            self.assertTrue(np.array_equal(volume, expected))
+            stream = png_loader(temp_dir, z_range=(2, 9), z_stride=3, roi=(10, 20, 64, 30), stream=True)
+            self.assertEqual((len(stream), stream.shape), (3, (30, 64, 3)))
+            self.assertTrue(np.array_equal(np.stack(list(stream)), expected))
+            # the region of interest is cropped before resizing
+            resized = png_loader(temp_dir, z_range=(0, 1), roi=(10, 20, 64, 30), resize=(32, 15))
+            self.assertTrue(np.array_equal(resized[0], np.array(self.slices[0].crop((10, 20, 74, 50)).resize(
+                (32, 15), Image.BICUBIC))))
+            with self.assertRaises(ValueError):
+                png_loader(temp_dir, z_range=(20, 30))
+
+    def test_png_loader_stream_empty(self):
+        with TemporaryDirectory() as temp_dir:
+            with self.assertRaisesRegex(ValueError, "no slices found in"):
+                png_loader(temp_dir, stream=True)
+
+    def test_png_loader_unknown_backend(self):
+        with TemporaryDirectory() as temp_dir:
+            self.generate_png_slices(temp_dir)
+
+            with self.assertRaises(ValueError):
+                png_loader(temp_dir, workers=2, backend="gpu")
+
 
 class TestNRRD(unittest.TestCase):
 
@@ -106,6 +339,77 @@ class TestNRRD(unittest.TestCase):
             for loaded_slice, original_slice in zip(loaded_slices, self.slices):
                 self.assertTrue(np.array_equal(loaded_slice, np.array(original_slice)))
 
+    def test_nrrd_loader_grayscale_volume(self):
+        with TemporaryDirectory() as temp_dir:
+            nrrd_path = os.path.join(temp_dir, "volume.nrrd")
+            nrrd.write(nrrd_path, self.volume[..., 0])
+
+            volume = nrrd_loader(nrrd_path)
+            self.assertEqual(volume.shape, (self.num_slices, 128, 128))
+            self.assertTrue(volume.flags.c_contiguous)
+            self.assertTrue(np.array_equal(volume, np.moveaxis(self.volume[..., 0], 2, 0)))
+            resized = nrrd_loader(nrrd_path, resize=(64, 32))
+            self.assertEqual(resized.shape, (self.num_slices, 32, 64))
+
+    def test_nrrd_loader_high_bit_depth(self):
+        with TemporaryDirectory() as temp_dir:
+            nrrd_path = os.path.join(temp_dir, "volume.nrrd")
+            data = np.random.default_rng(0).integers(-1000, 2000, (16, 12, 5), dtype=np.int16)
+            nrrd.write(nrrd_path, data)
+
+            expected = np.moveaxis(rescale_to_uint8(data, data.min(), data.max()), 2, 0)
+            self.assertTrue(np.array_equal(nrrd_loader(nrrd_path), expected))
+            self.assertTrue(np.array_equal(np.stack(list(nrrd_loader(nrrd_path, stream=True))), expected))
+            windowed = nrrd_loader(nrrd_path, window=(0, 1000))
+            self.assertTrue(np.array_equal(windowed, np.moveaxis(rescale_to_uint8(data, -500, 500), 2, 0)))
+
+    def test_nrrd_loader_selection(self):
+        with TemporaryDirectory() as temp_dir:
+            data = np.random.default_rng(0).integers(-1000, 2000, (16, 12, 9), dtype=np.int16)
+            selected = data[4:14, 2:8, 1:8:3]
+            expected = np.moveaxis(rescale_to_uint8(selected, selected.min(), selected.max()), 2, 0)
+            for encoding in ["raw", "gzip"]:
+                nrrd_path = os.path.join(temp_dir, encoding + ".nrrd")
+                nrrd.write(nrrd_path, data, {"encoding": encoding})
+                options = {"z_range": (1, 8), "z_stride": 3, "roi": (2, 4, 6, 10)}
+                self.assertTrue(np.array_equal(nrrd_loader(nrrd_path, **options), expected))
+                stream = nrrd_loader(nrrd_path, stream=True, **options)
+                self.assertEqual((len(stream), stream.shape), (3, (10, 6)))
+                self.assertTrue(np.array_equal(np.stack(list(stream)), expected))
+
+    def test_nrrd_mmap(self):
+        with TemporaryDirectory() as temp_dir:
+            nrrd_path = os.path.join(temp_dir, "volume.nrrd")
+            nrrd.write(nrrd_path, self.volume, {"encoding": "raw"})
+            self.assertTrue(np.array_equal(nrrd_mmap(nrrd_path), self.volume))
+            detached = os.path.join(temp_dir, "detached.nhdr")
+            nrrd.write(detached, self.volume, {"encoding": "raw"}, detached_header=True)
+            self.assertTrue(np.array_equal(nrrd_mmap(detached), self.volume))
+            nrrd.write(nrrd_path, self.volume)
+            self.assertIsNone(nrrd_mmap(nrrd_path))
+            big_endian = self.volume.astype(">u2") * 100
+            nrrd.write(nrrd_path, big_endian, {"encoding": "raw", "endian": "big"})
+            self.assertTrue(np.array_equal(nrrd_mmap(nrrd_path), big_endian))
+
+    def test_nrrd_dtype(self):
+        self.assertEqual(nrrd_dtype({"type": "unsigned char"}), np.uint8)
+        self.assertEqual(nrrd_dtype({"type": "short", "endian": "big"}), np.dtype(">i2"))
+        self.assertEqual(nrrd_dtype({"type": "double", "endian": "little"}), np.dtype("<f8"))
+        self.assertIsNone(nrrd_dtype({"type": "block"}))
+        with self.assertRaises(ValueError):
+            nrrd_dtype({"type": "float"})
+
+    def test_nrrd_loader_stream(self):
+        with TemporaryDirectory() as temp_dir:
+            nrrd_path = os.path.join(temp_dir, "volume.nrrd")
+            self.generate_nrrd_volume(nrrd_path)
+
+            stream = nrrd_loader(nrrd_path, stream=True)
+            self.assertEqual(len(stream), self.num_slices)
+            self.assertEqual(stream.shape, (128, 128, 3))
+            for loaded_slice, original_slice in zip(stream, self.slices):
+                self.assertTrue(np.array_equal(loaded_slice, np.array(original_slice)))
+
 
 class TestRAW(unittest.TestCase):
 
@@ -147,6 +451,95 @@ class TestRAW(unittest.TestCase):
                 grayscale_original_slice_array = np.array(original_slice.convert('L'))
                 self.assertTrue(np.array_equal(loaded_slice, grayscale_original_slice_array))
 
+    def test_raw_loader_stream(self):
+        with TemporaryDirectory() as temp_dir:
+            raw_path = os.path.join(temp_dir, "volume.raw")
+            self.generate_raw_data_grayscale(raw_path)
+
+            stream = raw_loader(raw_path, size_of_raw=(128, 128), slices=self.num_slices, channels=1, stream=True)
+            self.assertEqual(len(stream), self.num_slices)
+            self.assertEqual(stream.shape, (128, 128))
+            for loaded_slice, original_slice in zip(stream, self.slices):
+                self.assertTrue(np.array_equal(loaded_slice, np.array(original_slice.convert('L'))))
+
+    def test_raw_loader_mmap(self):
+        with TemporaryDirectory() as temp_dir:
+            raw_path = os.path.join(temp_dir, "volume.raw")
+            self.generate_raw_data_rgb(raw_path)
+
+            volume = raw_loader(raw_path, size_of_raw=(128, 128), slices=self.num_slices, channels=3, mmap=True)
+            self.assertIsInstance(volume, np.memmap)
+            self.assertEqual(volume.shape, (self.num_slices, 128, 128, 3))
+            self.assertFalse(volume.flags.writeable)
+            for loaded_slice, original_slice in zip(volume, self.slices):
+                self.assertTrue(np.array_equal(loaded_slice, np.array(original_slice)))
+            del volume
+
+    def test_raw_loader_mmap_offset_and_dtype(self):
+        with TemporaryDirectory() as temp_dir:
+            raw_path = os.path.join(temp_dir, "volume.raw")
+            data = np.arange(self.num_slices * 4 * 6, dtype=">u2").reshape(self.num_slices, 4, 6)
+            with open(raw_path, 'wb') as raw_file:
+                raw_file.write(b"header")
+                raw_file.write(data.tobytes())
+
+            volume = raw_loader(raw_path, size_of_raw=(4, 6), slices=self.num_slices, channels=1, mmap=True, offset=6,
+                                dtype="uint16", endianness="big")
+            self.assertEqual(volume.shape, (self.num_slices, 4, 6, 1))
+            self.assertTrue(np.array_equal(volume[..., 0], data))
+
+            # without mmap high bit depth samples are rescaled to uint8 with the range of the volume
+            loaded_slices = raw_loader(raw_path, size_of_raw=(4, 6), slices=self.num_slices, channels=1, offset=6,
+                                       dtype="uint16", endianness="big")
+            expected = rescale_to_uint8(data, data.min(), data.max())
+            self.assertTrue(np.array_equal(np.stack(loaded_slices), expected))
+            del volume
+
+    def test_raw_loader_rescales_high_bit_depth(self):
+        with TemporaryDirectory() as temp_dir:
+            raw_path = os.path.join(temp_dir, "volume.raw")
+            data = np.full((3, 4, 6), 1000, dtype=np.uint16)
+            data[0], data[2] = 0, 3000
+            data.tofile(raw_path)
+
+            for stream in [False, True]:
+                loaded_slices = raw_loader(raw_path, size_of_raw=(4, 6), slices=3, channels=1, dtype="uint16",
+                                           stream=stream)
+                self.assertEqual([int(s[0, 0]) for s in loaded_slices], [0, 85, 255])
+
+            resized = raw_loader(raw_path, size_of_raw=(4, 6), slices=3, channels=1, dtype="uint16", resize=(2, 3))
+            self.assertEqual(resized[1].shape, (3, 2))
+            self.assertTrue(np.all(resized[1] == 85))
+
+    def test_raw_loader_selection(self):
+        with TemporaryDirectory() as temp_dir:
+            raw_path = os.path.join(temp_dir, "volume.raw")
+            data = np.random.default_rng(0).integers(0, 4000, (self.num_slices, 12, 16), dtype=np.uint16)
+            with open(raw_path, 'wb') as raw_file:
+                raw_file.write(b"head")
+                raw_file.write(data.tobytes())
+            selected = data[3::4, 2:9, 5:16]
+            options = {"size_of_raw": (12, 16), "slices": self.num_slices, "channels": 1, "offset": 4,
+                       "dtype": "uint16", "z_range": (3, 100), "z_stride": 4, "roi": (5, 2, 20, 7)}
+
+            volume = raw_loader(raw_path, mmap=True, **options)
+            self.assertTrue(np.array_equal(volume[..., 0], selected))
+            del volume
+            expected = rescale_to_uint8(selected, selected.min(), selected.max())
+            self.assertTrue(np.array_equal(raw_loader(raw_path, **options), expected))
+            stream = raw_loader(raw_path, stream=True, **options)
+            self.assertEqual((len(stream), stream.shape), (2, (7, 11)))
+            self.assertTrue(np.array_equal(np.stack(list(stream)), expected))
+
+    def test_raw_loader_mmap_rejects_resize(self):
+        with TemporaryDirectory() as temp_dir:
+            raw_path = os.path.join(temp_dir, "volume.raw")
+            self.generate_raw_data_rgb(raw_path)
+
+            with self.assertRaises(ValueError):
+                raw_loader(raw_path, size_of_raw=(128, 128), slices=self.num_slices, channels=3, mmap=True,
+                           resize=(64, 64))
+
     def test_raw_fails_without_size_of_raw(self):
         with TemporaryDirectory() as temp_dir:
             raw_path = os.path.join(temp_dir, "volume.raw")
@@ -0,0 +1,72 @@
+import contextlib
+import io
+import unittest
+
+from atlas_conversion.__main__ import check_and_parse_args, create_parser
+
+
+class TestArguments(unittest.TestCase):
+
+    def parse(self, *argv):
+        return check_and_parse_args(create_parser(), ["volume.raw", "out", "--format", "raw", "--raw-size", "4", "6",
+                                                      "--raw-slices", "3", "--raw-channels", "1", *argv])
+
+    def test_raw_options(self):
+        arguments = self.parse("--raw-mmap", "--raw-dtype", "uint16")
+        self.assertEqual(arguments.loader_options["size_of_raw"], (6, 4))
+        self.assertTrue(arguments.loader_options["mmap"])
+        self.assertEqual(arguments.loader_options["dtype"], "uint16")
+
+    def test_raw_mmap_rejects_resize_and_stream(self):
+        for argv in [["--resize", "2", "2"], ["--stream"]]:
+            with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+                self.parse("--raw-mmap", *argv)
+
+    def test_intensity_options(self):
+        arguments = check_and_parse_args(create_parser(),
+                                         ["slices", "out", "--format", "dicom", "--window", "40", "400"])
+        self.assertEqual(arguments.loader_options["window"], (40, 400))
+        with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+            check_and_parse_args(create_parser(),
+                                 ["slices", "out", "--window", "40", "400", "--percentiles", "1", "99"])
+
+    def test_stream_output_options(self):
+        arguments = check_and_parse_args(create_parser(), ["slices", "out", "--stream-output", "--gradient"])
+        self.assertTrue(arguments.stream_output)
+        for options in [["--scaled-outputs"], ["--output-format", "raw"], ["--stream", "--gradient"]]:
+            with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+                check_and_parse_args(create_parser(), ["slices", "out", "--stream-output"] + options)
+
+    def test_packed_option(self):
+        arguments = check_and_parse_args(create_parser(), ["slices", "out", "--packed"])
+        self.assertTrue(arguments.packed)
+        self.assertTrue(arguments.gradient)
+        with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+            check_and_parse_args(create_parser(), ["slices", "out", "--packed", "--stream", "--stream-output"])
+
+    def test_incremental_options(self):
+        arguments = check_and_parse_args(create_parser(), ["frames", "out", "--frames", "--frame-workers", "2",
+                                                           "--incremental", "--cache-dir", "cache"])
+        self.assertTrue(arguments.frames and arguments.incremental)
+        self.assertEqual(arguments.frame_workers, 2)
+        for options in [[], ["--cache-dir", "cache", "--stream"], ["--cache-dir", "cache", "--gradient-memory", "64"]]:
+            with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+                check_and_parse_args(create_parser(), ["slices", "out", "--incremental"] + options)
+
+    def test_dask_options(self):
+        arguments = check_and_parse_args(create_parser(), ["slices", "out", "--gradient", "--dask-scheduler",
+                                                           "processes", "--dask-workers", "4", "--dask-chunks", "-1",
+                                                           "-1", "16"])
+        self.assertEqual(arguments.gradient_options, {"sigma": 2, "scheduler": "processes", "workers": 4,
+                                                      "chunks": (-1, -1, 16)})
+        with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+            check_and_parse_args(create_parser(), ["slices", "out", "--gradient-kernel", "sobel",
+                                                   "--dask-workers", "4"])
+
+    def test_selection_options(self):
+        arguments = check_and_parse_args(create_parser(), ["slices", "out", "--z-range", "10", "-10", "--z-stride", "2",
+                                                           "--roi", "8", "16", "64", "32"])
+        self.assertEqual(arguments.loader_options, {"z_range": (10, -10), "z_stride": 2, "roi": (8, 16, 64, 32)})
+        for options in [["--z-stride", "0"], ["--roi", "0", "0", "0", "10"]]:
+            with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+                check_and_parse_args(create_parser(), ["slices", "out"] + options)
@@ -0,0 +1,92 @@
+import json
+import os
+import unittest
+from tempfile import TemporaryDirectory
+
+import numpy as np
+from PIL import Image
+
+from atlas_conversion.__main__ import main
+from atlas_conversion.atlas import Atlas
+from atlas_conversion.loaders import png_loader
+from atlas_conversion.profiling import Profiler, active_profiler, profiled_iter, profiled_map, stage
+
+
+def square(x):
+    return x * x
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_nested_stages(self):
+        records = []
+        profiler = Profiler(callback=records.append)
+        self.assertIsNone(active_profiler())
+        with stage("outer", profiler, volume="a"):
+            self.assertIs(active_profiler(), profiler)
+            with stage("inner"):
+                np.ones(10 ** 6).sum()
+            self.assertEqual(list(profiled_iter(range(3), "item")), [0, 1, 2])
+        self.assertIsNone(active_profiler())
+
+        self.assertEqual([record["path"] for record in records],
+                         ["outer/inner", "outer/item", "outer/item", "outer/item", "outer"])
+        self.assertEqual(records, profiler.records)
+        self.assertEqual(records[-1]["volume"], "a")
+        self.assertEqual([record["index"] for record in records[1:4]], [0, 1, 2])
+        self.assertGreaterEqual(records[-1]["wall_seconds"], records[0]["wall_seconds"])
+        if records[0]["peak_rss_mb"] is not None:
+            self.assertGreaterEqual(records[-1]["peak_rss_mb"], records[0]["peak_rss_mb"])
+        self.assertEqual(profiler.summary()["outer/item"]["count"], 3)
+
+    def test_profiled_map(self):
+        self.assertEqual(list(profiled_map(square, [1, 2, 3], workers=2)), [1, 4, 9])
+        profiler = Profiler()
+        for backend in ["thread", "process"]:
+            with stage("map", profiler):
+                results = list(profiled_map(square, [1, 2, 3], 2, backend, "square",
+                                            lambda item, result: {"item": item, "result": result}))
+            self.assertEqual(results, [1, 4, 9])
+        steps = [record for record in profiler.records if record["name"] == "square"]
+        self.assertEqual([(step["item"], step["result"]) for step in steps], [(1, 1), (2, 4), (3, 9)] * 2)
+
+
+class TestAtlasProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.input_dir = os.path.join(self.temp_dir.name, "slices")
+        os.mkdir(self.input_dir)
+        for i in range(4):
+            Image.fromarray(np.full((16, 16, 3), i * 60, dtype=np.uint8)).save(
+                os.path.join(self.input_dir, f"slice_{i}.png"))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_atlas_stages(self):
+        profiler = Profiler()
+        atlas = Atlas(png_loader, profiler=profiler, workers=2)
+        atlas.load(self.input_dir)
+        atlas.convert()
+        atlas.write(os.path.join(self.temp_dir.name, "out"), gradient=True, scaled_outputs=True, levels=[16],
+                    gradient_options={"kernel": "central", "memory_budget": 1})
+        paths = [record["path"] for record in profiler.records]
+        self.assertEqual(paths.count("load/decode"), 4)
+        self.assertIn("write/gradient/gradient chunk", paths)
+        self.assertIn("write/pyramids", paths)
+        self.assertEqual(paths.count("write/encode"), 4)
+        self.assertEqual(paths[-1], "write")
+        decode = next(record for record in profiler.records if record["name"] == "decode")
+        self.assertEqual(decode["bytes_read"], os.path.getsize(decode["file"]))
+        encode = next(record for record in profiler.records if record["name"] == "encode")
+        self.assertEqual(encode["bytes_written"], os.path.getsize(encode["file"]))
+
+    def test_cli_profile(self):
+        output = os.path.join(self.temp_dir.name, "out")
+        self.assertEqual(main([self.input_dir, output, "--profile", output + "_profile.json"]), 0)
+        with open(output + "_profile.json") as f:
+            profile = json.load(f)
+        self.assertEqual(profile["summary"]["load/decode"]["count"], 4)
+        self.assertEqual([record["name"] for record in profile["records"] if "/" not in record["path"]],
+                         ["load", "convert", "write"])
@@ -0,0 +1,48 @@
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from atlas_conversion.pyramid import build_pyramid, build_pyramids, downsample, pyramid_levels
+
+
+class TestPyramid(unittest.TestCase):
+
+    def setUp(self):
+        self.image = np.random.default_rng(0).integers(0, 255, (64, 64, 3), dtype=np.uint8)
+
+    def test_pyramid_levels(self):
+        self.assertEqual(pyramid_levels(11776), [8192, 4096, 2048, 1024, 512])
+        self.assertEqual(pyramid_levels(1024, [256, 1024, 512]), [512, 256])
+
+    def test_box_downsample_matches_pil(self):
+        expected = np.asarray(Image.fromarray(self.image).resize((16, 16), Image.BOX)).astype(int)
+        self.assertTrue(np.abs(downsample(self.image, (16, 16), "box").astype(int) - expected).max() <= 1)
+
+    def test_downsample_rgba(self):
+        # a transparent pixel keeps its color, the alpha channel of a packed atlas is not an opacity
+        image = np.dstack([self.image, np.zeros((64, 64), dtype=np.uint8)])
+        resized = downsample(image, (32, 32), "bicubic")
+        self.assertEqual(resized.shape, (32, 32, 4))
+        self.assertTrue(np.array_equal(resized[..., :3], downsample(self.image, (32, 32), "bicubic")))
+        self.assertFalse(resized[..., 3].any())
+
+    def test_build_pyramid(self):
+        pyramid = build_pyramid(self.image, [48, 32, 16], "bicubic")
+        self.assertEqual([level.shape for level in pyramid], [(48, 48, 3), (32, 32, 3), (16, 16, 3)])
+        self.assertTrue(all(level.dtype == np.uint8 for level in pyramid))
+
+    def test_build_pyramid_keeps_aspect_ratio(self):
+        pyramid = build_pyramid(self.image[:32], [32, 16], "box")
+        self.assertEqual([level.shape for level in pyramid], [(16, 32, 3), (8, 16, 3)])
+        # a page of an atlas whose longest side is 128 is scaled like the rest of the atlas
+        self.assertEqual(build_pyramid(self.image[:32], [32], "box", full_size=128)[0].shape, (8, 16, 3))
+
+    def test_build_pyramid_unknown_filter(self):
+        with self.assertRaises(ValueError):
+            build_pyramid(self.image, [32], "cubic")
+
+    def test_build_pyramids(self):
+        color, gradient = build_pyramids([self.image, 255 - self.image], [32, 16], "box", workers=2)
+        self.assertTrue(np.array_equal(color[1], build_pyramid(self.image, [32, 16], "box")[1]))
+        self.assertEqual(gradient[0].shape, (32, 32, 3))
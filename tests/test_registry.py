@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+import unittest
+from tempfile import TemporaryDirectory
+
+import numpy as np
+from PIL import Image
+
+from atlas_conversion.__main__ import check_and_parse_args, create_parser, run
+from atlas_conversion.registry import LOADERS, get_loader, loader_names, register_loader
+
+# Libraries that only some formats or the gradient need, and which are slow to import
+HEAVY_MODULES = ["pydicom", "nrrd", "dask", "scipy"]
+
+IMPORTED_MODULES = '''
+import sys
+from atlas_conversion.__main__ import main
+try:
+    main(sys.argv[1:])
+except SystemExit:
+    pass
+print("imported:" + ",".join(module for module in {} if module in sys.modules))
+'''.format(HEAVY_MODULES)
+
+
+def constant_loader(path, resize=None, stream=False):
+    """A loader of a made up format: 3 gray 8x4 slices whatever the path."""
+    return np.full((3, 8, 4), 200, dtype=np.uint8)
+
+
+class TestRegistry(unittest.TestCase):
+
+    def tearDown(self):
+        LOADERS.pop("constant", None)
+
+    def imported_modules(self, *argv):
+        """Run the command line in a fresh interpreter and return the heavy modules it imported."""
+        output = subprocess.run([sys.executable, "-c", IMPORTED_MODULES, *argv], capture_output=True, text=True,
+                                check=True).stdout
+        imported = output.splitlines()[-1][len("imported:"):]
+        return imported.split(",") if imported else []
+
+    def test_builtin_loaders(self):
+        self.assertEqual(loader_names()[:4], ["png", "dicom", "nrrd", "raw"])
+        self.assertEqual(get_loader("nrrd").__name__, "nrrd_loader")
+        with self.assertRaises(ValueError):
+            get_loader("tiff")
+
+    def test_register_loader(self):
+        register_loader("constant", "tests.test_registry:constant_loader")
+        self.assertIn("constant", loader_names())
+        with TemporaryDirectory() as tmpdirname:
+            output = os.path.join(tmpdirname, "atlas")
+            run(check_and_parse_args(create_parser(), ["anything", output, "--format", "constant"]))
+            with Image.open(output + "_full.png") as image:
+                self.assertEqual(image.size, (12, 8))
+        # the reference was replaced by the imported function
+        self.assertEqual(LOADERS["constant"].__name__, "constant_loader")
+
+    def test_lazy_imports(self):
+        self.assertEqual(self.imported_modules("--help"), [])
+        with TemporaryDirectory() as tmpdirname:
+            input_dir = os.path.join(tmpdirname, "slices")
+            os.mkdir(input_dir)
+            for i in range(3):
+                Image.fromarray(np.full((8, 8, 3), i * 60, dtype=np.uint8)).save(os.path.join(input_dir, f"{i}.png"))
+            output = os.path.join(tmpdirname, "atlas")
+            self.assertEqual(self.imported_modules(input_dir, output), [])
+            self.assertEqual(self.imported_modules(input_dir, output, "--gradient", "--gradient-kernel", "sobel"),
+                             ["scipy"])
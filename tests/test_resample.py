@@ -0,0 +1,64 @@
+import unittest
+
+import numpy as np
+
+from atlas_conversion.atlas import Atlas
+from atlas_conversion.resample import area_weights, budget_shape, nearest_indices, resample_volume
+from atlas_conversion.tiling import plan_layout
+
+
+class TestResample(unittest.TestCase):
+
+    def setUp(self):
+        self.volume = np.random.default_rng(0).integers(0, 255, (20, 24, 18), dtype=np.uint8)
+
+    def test_area_weights(self):
+        weights = area_weights(10, 4)
+        self.assertEqual(weights.shape, (4, 10))
+        self.assertTrue(np.allclose(weights.sum(axis=1), 1))
+        self.assertTrue(np.allclose(weights[0], [0.4, 0.4, 0.2] + [0] * 7))
+        self.assertTrue(np.array_equal(area_weights(5, 5), np.eye(5)))
+        self.assertEqual(list(nearest_indices(10, 4)), [1, 3, 6, 8])
+
+    def test_integer_factor_is_block_mean(self):
+        resampled = resample_volume(self.volume, (10, 8, 9))
+        blocks = self.volume.reshape(10, 2, 8, 3, 9, 2).astype(np.float64).mean(axis=(1, 3, 5))
+        self.assertEqual(resampled.dtype, np.uint8)
+        self.assertTrue(np.array_equal(resampled, np.rint(blocks)))
+
+    def test_channels_and_parallel(self):
+        rgb = np.stack([self.volume, 255 - self.volume, self.volume // 2], axis=-1)
+        serial = resample_volume(rgb, (7, 11, 5))
+        self.assertEqual(serial.shape, (7, 11, 5, 3))
+        self.assertTrue(np.array_equal(serial[..., 0], resample_volume(self.volume, (7, 11, 5))))
+        self.assertTrue(np.array_equal(resample_volume(rgb, (7, 11, 5), workers=3), serial))
+        nearest = resample_volume(rgb, (7, 11, 5), method="nearest", workers=2)
+        self.assertTrue(np.array_equal(nearest, rgb[nearest_indices(20, 7)][:, nearest_indices(24, 11)]
+                                       [:, :, nearest_indices(18, 5)]))
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            resample_volume(self.volume, (40, 24, 18))
+        with self.assertRaises(ValueError):
+            resample_volume(self.volume, (10, 12, 9), method="cubic")
+
+    def test_budget_shape(self):
+        self.assertEqual(budget_shape((64, 64, 64)), (64, 64, 64))
+        shape = budget_shape((256, 512, 512), max_voxels=2 ** 21)
+        self.assertLessEqual(np.prod(shape), 2 ** 21)
+        self.assertGreater(np.prod(shape), 2 ** 21 * 0.9)
+        shape = budget_shape((1000, 512, 512), max_atlas_size=4096)
+        self.assertLessEqual(max(plan_layout(shape[0], shape[1:]).shape), 4096)
+
+
+class TestAtlasResample(unittest.TestCase):
+
+    def test_resample_before_convert(self):
+        volume = np.random.default_rng(0).integers(0, 255, (64, 32, 32), dtype=np.uint8)
+        atlas = Atlas(lambda path: volume)
+        atlas.load("")
+        atlas.resample(max_atlas_size=128)
+        atlas.convert()
+        self.assertLessEqual(atlas.atlas.shape[0], 128)
+        self.assertEqual(atlas.metadata()["slices"], atlas.slices.shape[0])
+        self.assertEqual(atlas.gradient_atlas().shape, atlas.atlas.shape)
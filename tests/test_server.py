@@ -0,0 +1,124 @@
+import asyncio
+import json
+import os
+import time
+import unittest
+from functools import partial
+from tempfile import TemporaryDirectory
+
+import numpy as np
+from PIL import Image
+
+from atlas_conversion.batch import run_job
+from atlas_conversion.server import ConversionService, check_job, handle_connection
+
+
+def slow_or_crashing_run_job(job, default_memory_limit=None, progress=None):
+    """Run a job like run_job, but wait a while for inputs named slow and kill the worker for inputs named crash."""
+    name = os.path.basename(job["input"])
+    if name == "crash":
+        os._exit(1)
+    if name == "slow":
+        time.sleep(1)
+    return run_job(job, default_memory_limit, progress)
+
+
+class TestServer(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.input_dir = os.path.join(self.temp_dir.name, "slices")
+        os.mkdir(self.input_dir)
+        for i in range(4):
+            image = np.full((16, 16, 3), i * 60, dtype=np.uint8)
+            Image.fromarray(image).save(os.path.join(self.input_dir, f"slice_{i}.png"))
+        self.service = ConversionService(workers=1, max_pending=1, runner=slow_or_crashing_run_job)
+        await self.service.start()
+        self.server = await asyncio.start_server(partial(handle_connection, self.service), "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.service.stop()
+        self.temp_dir.cleanup()
+
+    def output(self, name):
+        return os.path.join(self.temp_dir.name, name)
+
+    async def request(self, method, path, content=None):
+        """Send a request and return the status code, the headers and the body of the response."""
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        body = b"" if content is None else json.dumps(content).encode()
+        writer.write(f"{method} {path} HTTP/1.1\r\nHost: test\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        head, _, body = response.partition(b"\r\n\r\n")
+        status_line, *header_lines = head.decode().split("\r\n")
+        headers = dict(line.lower().split(": ", 1) for line in header_lines)
+        if headers.get("transfer-encoding") == "chunked":
+            chunks = b""
+            while True:
+                size, _, body = body.partition(b"\r\n")
+                if int(size, 16) == 0:
+                    break
+                chunks, body = chunks + body[:int(size, 16)], body[int(size, 16) + 2:]
+            body = chunks
+        return int(status_line.split()[1]), headers, body
+
+    async def test_job_events(self):
+        status, headers, body = await self.request("POST", "/jobs", {
+            "input": self.input_dir, "output": self.output("atlas"), "options": {"gradient": True}})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["content-type"], "application/x-ndjson")
+        events = [json.loads(line) for line in body.splitlines()]
+        kinds = [event["event"] for event in events]
+        self.assertEqual(kinds[:2], ["queued", "started"])
+        self.assertEqual(kinds[-1], "done")
+        self.assertIn("log", kinds)
+        self.assertIn("stage", kinds)
+        self.assertTrue(all(event["job"] == events[0]["job"] for event in events))
+        self.assertEqual(events[-1]["report"]["status"], "ok")
+        self.assertTrue(os.path.exists(self.output("atlas_gradient_full.png")))
+
+        status, _, body = await self.request("GET", "/status")
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), {"workers": 1, "running": 0, "pending": 0, "max_pending": 1,
+                                            "completed": 1, "failed": 0})
+
+    async def test_backpressure(self):
+        slow_input = os.path.join(self.temp_dir.name, "slow")
+        os.rename(self.input_dir, slow_input)
+        slow = asyncio.create_task(self.request("POST", "/jobs", {"input": slow_input, "output": self.output("a")}))
+        while not self.service.pending:
+            await asyncio.sleep(0.01)
+        status, headers, body = await self.request("POST", "/jobs", {"input": slow_input, "output": self.output("b")})
+        self.assertEqual(status, 503)
+        self.assertEqual(headers["retry-after"], "1")
+        status, _, body = await slow
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.splitlines()[-1])["report"]["status"], "ok")
+
+    async def test_worker_crash(self):
+        status, _, body = await self.request("POST", "/jobs", {"input": self.output("crash"), "output": "crash"})
+        self.assertEqual(status, 200)
+        report = json.loads(body.splitlines()[-1])["report"]
+        self.assertEqual(report["status"], "failed")
+        self.assertIn("died", report["error"])
+        # the next job runs in a fresh pool
+        status, _, body = await self.request("POST", "/jobs", {"input": self.input_dir, "output": self.output("a")})
+        self.assertEqual(json.loads(body.splitlines()[-1])["report"]["status"], "ok")
+
+    async def test_invalid_requests(self):
+        status, _, body = await self.request("POST", "/jobs", {"output": "out"})
+        self.assertEqual(status, 400)
+        status, _, body = await self.request("POST", "/jobs", {"input": "in", "output": "out", "format": "gif"})
+        self.assertEqual(status, 400)
+        self.assertIn("gif", json.loads(body)["error"])
+        self.assertEqual((await self.request("GET", "/jobs"))[0], 405)
+        self.assertEqual((await self.request("GET", "/nothing"))[0], 404)
+
+    def test_check_job(self):
+        self.assertIsNone(check_job({"input": "in", "output": "out", "options": "--gradient"}))
+        self.assertIsNotNone(check_job({"input": "in", "output": "out", "options": "--no-such-option"}))
@@ -0,0 +1,94 @@
+import unittest
+
+import numpy as np
+
+from atlas_conversion.tiling import (Layout, grid_size, plan_layout, tile_origin, tile_view, tile_volume,
+                                     untile_atlas)
+
+
+def loop_tile(volume, size, fill=0):
+    height, width = volume.shape[1:3]
+    atlas = np.full((size * height, size * width) + volume.shape[3:], fill, dtype=volume.dtype)
+    for i, slice_ in enumerate(volume):
+        row, col = (i // size) * height, (i % size) * width
+        atlas[row:row + height, col:col + width] = slice_
+    return atlas
+
+
+class TestTiling(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.volume = rng.integers(0, 255, (10, 6, 4, 3), dtype=np.uint8)
+
+    def test_grid_size(self):
+        self.assertEqual(grid_size(1), 1)
+        self.assertEqual(grid_size(9), 3)
+        self.assertEqual(grid_size(10), 4)
+
+    def test_tile_origin(self):
+        self.assertEqual(tile_origin(0, 4, (6, 4)), (0, 0))
+        self.assertEqual(tile_origin(5, 4, (6, 4)), (6, 4))
+
+    def test_tile_volume_matches_loop(self):
+        for num_slices in [1, 4, 9, 10, 16]:
+            volume = self.volume[:num_slices]
+            size = grid_size(num_slices)
+            atlas = tile_volume(volume, fill=7)
+            self.assertTrue(np.array_equal(atlas, loop_tile(volume, size, fill=7)))
+
+    def test_tile_volume_grayscale_into_rgb(self):
+        volume = self.volume[..., 0]
+        atlas = tile_volume(volume, out=np.zeros((24, 16, 3), dtype=np.uint8))
+        self.assertTrue(np.array_equal(atlas, loop_tile(volume[..., np.newaxis].repeat(3, axis=3), 4)))
+
+    def test_tile_volume_non_contiguous(self):
+        transposed = np.ascontiguousarray(self.volume.transpose(1, 2, 0, 3))
+        atlas = tile_volume(transposed.transpose(2, 0, 1, 3))
+        self.assertTrue(np.array_equal(atlas, loop_tile(self.volume, 4)))
+
+    def test_tile_volume_transform(self):
+        atlas = tile_volume(self.volume, transform=lambda block: 255 - block)
+        self.assertTrue(np.array_equal(atlas[:24, :16], loop_tile(255 - self.volume, 4)[:24, :16]))
+
+    def test_untile_round_trip(self):
+        atlas = tile_volume(self.volume)
+        volume = untile_atlas(atlas, 10, (6, 4))
+        self.assertTrue(volume.flags.c_contiguous)
+        self.assertTrue(np.array_equal(volume, self.volume))
+        self.assertTrue(np.array_equal(tile_view(atlas, 9, 4, (6, 4)), self.volume[9]))
+
+    def test_tile_volume_grid(self):
+        # 10 slices in 3 columns, 4 rows
+        atlas = tile_volume(self.volume, 3, fill=7, out=np.zeros((24, 12, 3), dtype=np.uint8))
+        self.assertTrue(np.array_equal(atlas[18:, 4:], np.full((6, 8, 3), 7)))
+        self.assertTrue(np.array_equal(tile_view(atlas, 5, 3, (6, 4)), self.volume[5]))
+        self.assertTrue(np.array_equal(untile_atlas(atlas, 10, (6, 4)), self.volume))
+
+
+class TestLayout(unittest.TestCase):
+
+    def test_plan_layout(self):
+        layout = plan_layout(10, (128, 128))
+        self.assertEqual((layout.rows, layout.columns, layout.pages), (3, 4, 1))
+        self.assertEqual(layout.shape, (384, 512))
+        self.assertEqual(plan_layout(16, (64, 64)).shape, (256, 256))
+        # wide slices are stacked in fewer columns
+        self.assertEqual(plan_layout(8, (32, 128)).columns, 2)
+
+    def test_plan_layout_pages(self):
+        layout = plan_layout(100, (100, 100), max_size=1000)
+        self.assertEqual(layout.pages, 1)
+        layout = plan_layout(250, (100, 100), max_size=1000)
+        self.assertEqual((layout.columns, layout.page_rows, layout.pages), (10, 10, 3))
+        self.assertEqual([page["slices"] for page in layout.describe()["pages"]], [100, 100, 50])
+        self.assertEqual(layout.describe()["pages"][2]["height"], 500)
+        with self.assertRaises(ValueError):
+            plan_layout(4, (100, 200), max_size=150)
+
+    def test_split(self):
+        layout = Layout(10, (6, 4), columns=3, page_rows=3)
+        atlas = tile_volume(np.zeros((10, 6, 4), dtype=np.uint8), 3, out=np.ones(layout.shape, dtype=np.uint8))
+        pages = layout.split(atlas)
+        self.assertEqual([page.shape for page in pages], [(18, 12), (6, 12)])
+        self.assertTrue(all(np.shares_memory(page, atlas) for page in pages))
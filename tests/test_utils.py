@@ -0,0 +1,101 @@
+import importlib.util
+import unittest
+
+import dask.array as da
+import numpy as np
+from PIL import Image
+
+from atlas_conversion.utils import (calculate_gradient, calculate_gradient_out_of_core, calculate_gradient_slices,
+                                    dask_scheduler, gradient_chunks, gradient_graph, gradient_slabs, luminance,
+                                    normalize_rgb)
+
+
+class TestOutOfCoreGradient(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        volume = rng.integers(0, 255, (24, 20, 30), dtype=np.uint8)
+        self.data = da.from_array(volume, chunks=(12, 20, 10)).astype(np.float32)
+
+    def test_gradient_slabs(self):
+        gradient = gradient_graph(self.data)
+        bytes_per_slice = 24 * 20 * 3 * 4 * 3
+        self.assertEqual(gradient_slabs(gradient, 12 * bytes_per_slice), [(0, 10), (10, 20), (20, 30)])
+        self.assertEqual(gradient_slabs(gradient, 1), [(0, 10), (10, 20), (20, 30)])
+        self.assertEqual(gradient_slabs(gradient, 10 ** 9), [(0, 30)])
+
+    def test_out_of_core_matches_in_memory(self):
+        gradient_data, g_background = calculate_gradient(self.data)
+        g_background, gradient_data = normalize_rgb(g_background, gradient_data)
+
+        for memory_budget in [1, 10 ** 5, 10 ** 9]:
+            background, slabs = calculate_gradient_out_of_core(self.data, memory_budget)
+            out_of_core = np.concatenate([slab for _, slab in slabs], axis=2)
+            self.assertEqual(background, g_background)
+            self.assertTrue(np.array_equal(out_of_core, gradient_data))
+
+    def test_out_of_core_rechunks_auto_chunked_volume(self):
+        # a single z chunk, as automatic chunking gives for volumes of a few hundred megabytes
+        data = self.data.rechunk((24, 20, 30))
+        gradient_data, g_background = calculate_gradient(data)
+        g_background, gradient_data = normalize_rgb(g_background, gradient_data)
+
+        background, slabs = calculate_gradient_out_of_core(data, 24 * 20 * 3 * 4 * 3 * 10)
+        slabs = list(slabs)
+        self.assertEqual([start for start, _ in slabs], [0, 10, 20])
+        self.assertEqual(background, g_background)
+        self.assertTrue(np.array_equal(np.concatenate([slab for _, slab in slabs], axis=2), gradient_data))
+
+    def test_gradient_slices(self):
+        expected = gradient_graph(self.data).compute()
+        for first, stop in [(0, 4), (12, 15), (25, 30), (0, 30)]:
+            gradient = calculate_gradient_slices(self.data, first, stop)
+            self.assertTrue(np.array_equal(gradient, expected[:, :, first:stop]))
+        gradient_data, g_background, (minimum, maximum) = calculate_gradient(self.data, return_range=True)
+        self.assertEqual((minimum, maximum), (expected.min(), expected.max()))
+
+    def test_gradient_does_not_depend_on_chunks(self):
+        expected = gradient_graph(self.data.rechunk((24, 20, 30))).compute()
+        for chunks in [(12, 20, 10), (7, 9, 3), (24, 20, 1)]:
+            self.assertTrue(np.array_equal(gradient_graph(self.data.rechunk(chunks)).compute(), expected))
+
+
+class TestDaskScheduler(unittest.TestCase):
+
+    def setUp(self):
+        volume = np.random.default_rng(0).integers(0, 255, (24, 20, 30), dtype=np.uint8)
+        self.data = da.from_array(volume).astype(np.float32)
+        self.expected = calculate_gradient(self.data, chunks=(24, 20, 30))
+
+    def test_gradient_chunks(self):
+        # whole planes, 4 chunks per worker, but never thinner than the kernel radius or MIN_CHUNK_BYTES
+        self.assertEqual(gradient_chunks((24, 20, 30), workers=1), (24, 20, 30))
+        self.assertEqual(gradient_chunks((512, 512, 1024), workers=8), (512, 512, 32))
+        self.assertEqual(gradient_chunks((512, 512, 1024), workers=64), (512, 512, 8))
+        self.assertEqual(gradient_chunks((4096, 4096, 64), workers=1), (4096, 4096, 8))
+        self.assertEqual(gradient_chunks((4096, 4096, 64), workers=1, sigma=0.5), (4096, 4096, 2))
+
+    def test_schedulers_match(self):
+        for scheduler in [None, "threads", "processes"]:
+            gradient, background = calculate_gradient(self.data, scheduler=scheduler, workers=2, chunks=(24, 20, 10))
+            self.assertEqual(background, self.expected[1])
+            self.assertTrue(np.array_equal(gradient, self.expected[0]))
+        with self.assertRaises(ValueError):
+            with dask_scheduler("mpi"):
+                pass
+
+    @unittest.skipUnless(importlib.util.find_spec("distributed"), "dask.distributed is not installed")
+    def test_distributed_scheduler(self):
+        g_background, expected = normalize_rgb(*self.expected[::-1])
+        background, slabs = calculate_gradient_out_of_core(self.data, 24 * 20 * 3 * 4 * 3 * 10,
+                                                           scheduler="distributed", workers=2)
+        self.assertEqual(background, g_background)
+        self.assertTrue(np.array_equal(np.concatenate([slab for _, slab in slabs], axis=2), expected))
+
+
+class TestLuminance(unittest.TestCase):
+
+    def test_matches_pillow(self):
+        rgb = np.random.default_rng(0).integers(0, 255, (20, 8, 9, 3), dtype=np.uint8)
+        expected = np.stack([np.array(Image.fromarray(slice_).convert('L')) for slice_ in rgb])
+        self.assertTrue(np.array_equal(luminance(rgb, chunk_size=3), expected))